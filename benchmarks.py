@@ -0,0 +1,589 @@
+#!/usr/bin/env python
+"""Benchmarks for transmission-hq.
+
+Usage: python benchmarks.py [--count N] [--payload FILE] [--save FILE]
+                            [--compare FILE] [--threshold PERCENT] [name ...]
+
+Without names, all benchmarks are run.  No daemon is needed; torrents are
+synthetic ('torrent-get' responses of transmissionhq.fakedaemon) or a
+recorded 'torrent-get' response given with --payload.
+
+The 'model' and 'client' benchmarks run every case in a forked process and
+report ops/s, net allocations of gc-tracked objects and growth of the peak
+RSS.  --save writes all results as JSON; --compare compares them with a
+saved run and exits with status 1 if anything got slower or bigger by more
+than --threshold percent.
+"""
+import os
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+from multiprocessing import (Process, Queue)
+
+from transmissionhq.rpc import (TransmissionRPC, TransmissionRPCValue, SPEC_INDEX, get_spec)
+from transmissionhq.rpcspec import PROJECTIONS
+from transmissionhq.columnar import ColumnarTorrentStore
+from transmissionhq import stats
+from transmissionhq.client import TransmissionClient
+from transmissionhq.fakedaemon import FakeDaemon
+from transmissionhq.instrument import RPCMetrics
+from transmissionhq.query import Query
+from transmissionhq import formatters
+from transmissionhq.constants import (BYTE_SYMBOLS, BYTE_SIZES, RE_ONE)
+
+# 20 scalar 'torrent-get' fields of various types
+FIELDS = ['activityDate', 'addedDate', 'corruptEver', 'downloadDir',
+          'downloadedEver', 'downloadLimit', 'downloadLimited', 'error',
+          'errorString', 'eta', 'hashString', 'id', 'leftUntilDone', 'name',
+          'percentDone', 'rateDownload', 'rateUpload', 'status', 'totalSize',
+          'uploadRatio']
+
+
+def synthetic_torrent(id, rnd=random):
+    """Return a 'torrent-get' dict with random values for FIELDS."""
+    return {
+        'activityDate': 1350000000 + rnd.randint(0, 10**6),
+        'addedDate': 1340000000 + id,
+        'corruptEver': rnd.randint(0, 10**6),
+        'downloadDir': '/srv/torrents/%d' % (id % 12),
+        'downloadedEver': rnd.randint(0, 10**11),
+        'downloadLimit': rnd.choice((0, 100, 500)),
+        'downloadLimited': rnd.random() < 0.1,
+        'error': 0,
+        'errorString': '',
+        'eta': rnd.randint(-2, 10**5),
+        'hashString': '%040x' % id,
+        'id': id,
+        'leftUntilDone': rnd.randint(0, 10**10),
+        'name': 'Synthetic torrent #%d' % id,
+        'percentDone': rnd.random(),
+        'rateDownload': rnd.randint(0, 10**7),
+        'rateUpload': rnd.randint(0, 10**7),
+        'status': rnd.randint(0, 6),
+        'totalSize': rnd.randint(10**6, 10**11),
+        'uploadRatio': rnd.random() * 3,
+    }
+
+def synthetic_torrents(count, seed=0):
+    rnd = random.Random(seed)
+    return [synthetic_torrent(id, rnd) for id in range(1, count+1)]
+
+
+def timed(func, repeat=3):
+    """Return best wall time of repeat calls to func."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def rss():
+    """Return resident set size of this process in bytes (Linux only)."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def in_child(func, *args):
+    """Run func in a forked process and return its return value."""
+    queue = Queue()
+    child = Process(target=lambda: queue.put(func(*args)))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+def peak_rss():
+    """Return peak resident set size of this process in bytes (Linux only)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+MIN_TIME = 0.5  # Seconds a case of measure() runs at least
+
+def _measure(setup, func, repeat):
+    devnull = open(os.devnull, 'w')
+    def run(state):
+        """Return (seconds, gc allocation counter before func's result is
+        freed)."""
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            start = time.time()
+            result = func(state)
+            return time.time() - start, gc.get_count()[0]
+        finally:
+            sys.stdout = stdout
+    start_rss = rss()
+    # Repeat short cases until they ran for at least MIN_TIME
+    times = []
+    while len(times) < repeat or sum(times) < MIN_TIME and len(times) < 50:
+        times.append(run(setup())[0])
+    # Count allocations in one more run without garbage collections, which
+    # would reset the counter
+    state = setup()
+    gc.collect()
+    gc.disable()
+    try:
+        allocations = run(state)[1]
+    finally:
+        gc.enable()
+    return min(times), allocations, max(0, peak_rss() - start_rss)
+
+def measure(setup, func, repeat=3):
+    """Run func(setup()) repeat times in a forked process.
+
+    Every run gets a fresh setup(); output of func is discarded.  Return
+    (best time, net allocations of gc-tracked objects, growth of peak RSS
+    including setup()).
+    """
+    return in_child(_measure, setup, func, repeat)
+
+
+RESULTS = {}  # Benchmark name -> {metric: value}; see --save and --compare
+
+def report(name, seconds, ops, allocations=None, peak=None):
+    seconds = max(seconds, 1e-9)
+    result = RESULTS[name] = {'seconds': seconds, 'ops_per_sec': ops / seconds}
+    line = '%-48s %8.3f s  %12.0f ops/s' % (name, seconds, ops / seconds)
+    if allocations is not None:
+        result['allocations'] = allocations
+        line += '  %9d allocs' % allocations
+    if peak is not None:
+        result['peak_rss'] = peak
+        line += '  %7.1f MiB peak' % (peak / 1048576.0)
+    print line
+
+def report_memory(name, bytes):
+    RESULTS[name] = {'memory': bytes}
+    print '%-48s %8.1f MiB' % (name, bytes / 1048576.0)
+
+
+def bench_poll(count=10000):
+    """Update count torrents x 20 fields, with and without reading .hr."""
+    cache = dict((t['id'], TransmissionRPC('torrent', t))
+                 for t in synthetic_torrents(count, seed=1))
+    polls = [synthetic_torrents(count, seed=seed) for seed in (2, 3, 4, 5)]
+    def update():
+        for t in polls.pop():
+            cache[t['id']].update(t)
+    def update_and_read():
+        update()
+        for t in cache.values():
+            for key in FIELDS:
+                t[key].hr
+    ops = count * len(FIELDS)
+    report('poll: update (lazy .hr)', timed(update, 2), ops)
+    report('poll: update + read every .hr', timed(update_and_read, 2), ops)
+
+
+def bench_memory(count=10000):
+    """Resident memory of count cached torrents x 20 fields."""
+    def fill(columnar):
+        tlist = synthetic_torrents(count)
+        before = rss()
+        if columnar:
+            cache = ColumnarTorrentStore()
+            for t in tlist:
+                cache[t['id']] = t
+        else:
+            cache = dict((t['id'], TransmissionRPC('torrent', t)) for t in tlist)
+        return rss() - before
+    for name,columnar in (('TransmissionRPC', False), ('ColumnarTorrentStore', True)):
+        report_memory('memory: ' + name, in_child(fill, columnar))
+
+
+def bench_fetch(count=10000):
+    """Fetch count torrents from a FakeDaemon: full, 'recently-active' after
+    churn, and full with 5 ms latency per request.  Small 'session-get'
+    requests show the overhead of RPCMetrics."""
+    def fetch(columnar):
+        daemon = FakeDaemon(torrents=count, seed=1).start()
+        client = TransmissionClient(daemon.url, columnar=columnar)
+        before = rss()
+        results = [timed(lambda: client.torrents(keys='list'), 1)]
+        memory = rss() - before
+        daemon.step(seconds=10)
+        results.append(timed(lambda: client.torrents(ids='recently-active', keys='list'), 1))
+        daemon.latency = 0.005
+        results.append(timed(lambda: client.torrents(keys='list'), 1))
+        daemon.latency = 0
+        sessions = lambda: [client._request('session-get') for i in range(200)]
+        results.append(timed(sessions))
+        client.add_instrument(RPCMetrics())
+        results.append(timed(sessions))
+        daemon.stop()
+        return results, memory
+    for name,columnar in (('rows', False), ('columns', True)):
+        (full, recent, latency, plain, instrumented), memory = in_child(fetch, columnar)
+        report('fetch: torrents(), %s' % name, full, count)
+        report('fetch: recently-active, %s' % name, recent, count)
+        report('fetch: torrents() + latency, %s' % name, latency, count)
+        report_memory('fetch: memory, %s' % name, memory)
+    report('fetch: session-get', plain, 200)
+    report('fetch: session-get + RPCMetrics', instrumented, 200)
+
+
+def bench_stats(count=10000):
+    """Sum/mean of 3 fields per status: row iteration vs. aggregate()."""
+    tlist = synthetic_torrents(count)
+    rows = dict((t['id'], TransmissionRPC('torrent', t)) for t in tlist)
+    store = ColumnarTorrentStore()
+    for t in tlist:
+        store[t['id']] = t
+    fields = ['rateDownload', 'rateUpload', 'uploadRatio']
+    def iterate_rows():
+        groups = {}
+        for t in rows.values():
+            group = groups.setdefault(t['status'].mr, {})
+            for field in fields:
+                group.setdefault(field, []).append(t[field].mr)
+        for group in groups.values():
+            for values in group.values():
+                sum(values) / len(values)
+    report('stats: row iteration', timed(iterate_rows), count)
+    report('stats: aggregate() on rows',
+           timed(lambda: stats.aggregate(rows, fields, by='status', use_numpy=False)), count)
+    report('stats: aggregate() on columns',
+           timed(lambda: stats.aggregate(store, fields, by='status', use_numpy=False)), count)
+    if stats.numpy is not None:
+        report('stats: aggregate() on columns (NumPy)',
+               timed(lambda: stats.aggregate(store, fields, by='status', use_numpy=True)), count)
+
+def bench_query(count=50000):
+    """Filter, sort and page cached torrents: row iteration vs. Query."""
+    tlist = synthetic_torrents(count)
+    rows = dict((t['id'], TransmissionRPC('torrent', t)) for t in tlist)
+    store = ColumnarTorrentStore()
+    for t in tlist:
+        store[t['id']] = t
+    where = ("status in [downloading, seeding] and totalSize > 1GB "
+             "and downloadDir ^= /srv/torrents/1")
+    def iterate_rows():
+        matches = [t for t in rows.values()
+                   if t['status'].mr in ('downloading', 'seeding')
+                   and t['totalSize'].mr > 10**9
+                   and t['downloadDir'].mr.startswith('/srv/torrents/1')]
+        matches.sort(key=lambda t: t['rateDownload'].mr, reverse=True)
+        return matches[:50]
+    report('query: row iteration, top 50', timed(iterate_rows), count)
+    report('query: compile', timed(lambda: Query(where, sort='-rateDownload')), 1)
+    query = Query(where, sort='-rateDownload', limit=50)
+    report('query: Query on rows, top 50', timed(lambda: query.run(rows)), count)
+    report('query: Query on columns, top 50', timed(lambda: query.run(store)), count)
+    query = Query(where, sort=['name', '-uploadRatio'], offset=1000, limit=50)
+    report('query: Query on rows, 2 keys, page 21',
+           timed(lambda: query.run(rows)), count)
+
+def legacy_hr_bytes(bytes, base=1000, lengthy=False, format=None):
+    """rpc.hr_bytes() before transmissionhq.formatters, for comparison."""
+    try:
+        bytes = int(bytes)
+    except TypeError:
+        return u'0 B'
+    if bytes < 0:
+        raise ValueError('bytes < 0: %d' % bytes)
+    try:
+        byte_symbols = BYTE_SYMBOLS[base][('short','long')[lengthy]]
+        byte_sizes = dict(zip(byte_symbols, BYTE_SIZES[base]))
+    except KeyError:
+        raise ValueError('Unknown base for byte conversion: %s' % base)
+    value = bytes
+    symbol = ''
+    for s in reversed(byte_symbols):
+        if bytes >= byte_sizes[s]:
+            value = float(bytes) / byte_sizes[s]
+            symbol = s
+            break
+    value = float('%.2f' % value)
+    if format is None:
+        if value < 10:
+            format = '%(value).2f %(symbol)s'
+        elif value < 100:
+            format = '%(value).1f %(symbol)s'
+        else:
+            format = '%(value)d %(symbol)s'
+    text = (format % dict(symbol=symbol, value=value)).replace('.0 ', ' ')
+    if lengthy:
+        unit_name = 'byte%s' % ('','s')[RE_ONE.match(text) is None]
+    else:
+        unit_name = 'B'
+    return text + unit_name
+
+def bench_formatters(count=100000):
+    """Format byte values: legacy hr_bytes vs. formatters."""
+    rnd = random.Random(0)
+    rates = [rnd.randint(0, 10**7) for i in range(count)]
+    # Sizes and limits: few distinct values
+    sizes = [rnd.choice((0, 100, 500, 10**9, 4700000000, 734003200)) for i in range(count)]
+    ratios = [rnd.random() * 3 for i in range(count)]
+    percents = [rnd.random() for i in range(count)]
+    legacy_ratio = lambda v: unicode(u'%.2f' % v)
+    legacy_percent = lambda v: unicode(u'%d %%' % (v*100))
+
+    for name,values in (('rates', rates), ('sizes', sizes)):
+        report('formatters: legacy hr_bytes, %s' % name,
+               timed(lambda: [unicode(legacy_hr_bytes(v)) for v in values]), count)
+        report('formatters: hr_bytes, %s' % name,
+               timed(lambda: [formatters.hr_bytes(v) for v in values]), count)
+        report('formatters: hr_bytes_cached, %s' % name,
+               timed(lambda: [formatters.hr_bytes_cached(v) for v in values]), count)
+        report('formatters: hr_bytes_column, %s' % name,
+               timed(lambda: formatters.hr_bytes_column(values)), count)
+    report('formatters: legacy hr_ratio', timed(lambda: [legacy_ratio(v) for v in ratios]), count)
+    report('formatters: hr_ratio', timed(lambda: [formatters.hr_ratio(v) for v in ratios]), count)
+    report('formatters: legacy hr_percent',
+           timed(lambda: [legacy_percent(v) for v in percents]), count)
+    report('formatters: hr_percent',
+           timed(lambda: [formatters.hr_percent(v) for v in percents]), count)
+
+
+### Suite: RPC object model and client hot paths
+
+COUNTS = [1000, 10000]  # Torrent counts; see --count
+PAYLOAD = None          # Recorded 'torrent-get' torrents; see --payload
+
+# Fields that change between polls of a recorded payload
+DYNAMIC_FIELDS = ('activityDate', 'downloadedEver', 'eta', 'leftUntilDone',
+                  'peersConnected', 'percentDone', 'rateDownload', 'rateUpload',
+                  'uploadRatio', 'uploadedEver')
+
+class OfflineClient(TransmissionClient):
+    """Answer 'torrent-get' with payload and swallow all other requests."""
+    def __init__(self, columnar=False):
+        TransmissionClient.__init__(self, columnar=columnar)
+        self.payload = []
+    def _request(self, method, **kwargs):
+        if method == 'torrent-get':
+            return {'torrents': self.payload}
+        return {}
+
+def perturbed(torrents, fraction, seed):
+    """Return copies of a fraction of torrents with new DYNAMIC_FIELDS."""
+    rnd = random.Random(seed)
+    result = []
+    for t in rnd.sample(torrents, int(len(torrents) * fraction)):
+        t = dict(t)
+        for key in DYNAMIC_FIELDS:
+            if key in t:
+                t[key] = type(t[key])(t[key] * rnd.uniform(0.5, 1.5))
+        result.append(t)
+    return result
+
+def payloads(count, width):
+    """Return (fields, cold, partial, warm) 'torrent-get' torrents.
+
+    cold is the first fetch, partial has the torrents that changed
+    ('recently-active') and warm is a full fetch after rates of all torrents
+    changed.
+    """
+    if PAYLOAD is not None:
+        cold = PAYLOAD[:count]
+        fields = sorted(set().union(*cold))
+        return fields, cold, perturbed(cold, 0.1, 1), perturbed(cold, 1.0, 2)
+    fields = PROJECTIONS[width]
+    daemon = FakeDaemon(torrents=count, seed=1)
+    daemon.added_per_second = daemon.removed_per_second = 0
+    get = lambda ids=None: daemon.call('torrent-get', {'ids':ids, 'fields':fields})[1]['torrents']
+    cold = get()
+    daemon.activity = 0.1
+    daemon.step(seconds=10)
+    partial = get('recently-active')
+    daemon.activity = 1.0
+    daemon.step(seconds=10)
+    return fields, cold, partial, get()
+
+def filled_client(columnar, payload):
+    client = OfflineClient(columnar)
+    client.payload = payload
+    client.torrents(keys=[])
+    return client
+
+def make_dirty(client, fields, count):
+    """Change count mutable fields spread over the cached torrents."""
+    spec = dict((key, s) for (path, key),s in SPEC_INDEX.items() if path == ('torrent',))
+    mutable = [key for key in fields if spec[key].mutable]
+    torrents = client._cache['torrents'].values()
+    for i in range(count if mutable else 0):
+        t = torrents[i % len(torrents)]
+        key = mutable[i // len(torrents) % len(mutable)]
+        value = t[key].mr
+        t[key] = not value if type(value) is bool else (value or 0) + 1000
+
+def bench_model(count=None):
+    """TransmissionRPCValue construction, get_spec(), update() without
+    changes, change detection of clean torrents and updates of peer lists."""
+    count = count or max(COUNTS)
+    fields, cold, partial, warm = payloads(count, 'detail')
+    spec = dict((key, s) for (path, key),s in SPEC_INDEX.items() if path == ('torrent',))
+    scalars = [(key, value, spec[key]) for t in cold for key,value in t.items()
+               if type(value) not in (dict, list)]
+    def construct(items):
+        from_spec = TransmissionRPCValue.from_spec
+        return [from_spec(key, value, s) for key,value,s in items]
+    results = measure(lambda: scalars, construct)
+    report('model: TransmissionRPCValue.from_spec()', results[0], len(scalars), *results[1:])
+
+    keys = [key for t in cold[:1000] for key in t] * (count // 1000 or 1)
+    def lookup(keys):
+        for key in keys:
+            get_spec(['torrent'], key)
+    results = measure(lambda: keys, lookup)
+    report('model: get_spec()', results[0], len(keys), *results[1:])
+
+    torrents = lambda: [TransmissionRPC('torrent', t) for t in cold]
+    def update(torrents):
+        for torrent,t in zip(torrents, cold):
+            torrent.update(t)
+    results = measure(torrents, update)
+    report('model: update() without changes', results[0], len(scalars), *results[1:])
+    def detect(torrents):
+        for torrent in torrents:
+            torrent.changes()
+    results = measure(torrents, detect)
+    report('model: changes() of clean torrents', results[0], len(scalars), *results[1:])
+
+    # Busy swarms: the first peer leaves, a new one arrives, 5 rates change
+    def peer(n, rate=0):
+        return {'address':'10.0.%d.%d' % (n // 256, n % 256), 'port':51413 + n % 7,
+                'clientName':('Transmission 2.77', 'qBittorrent 3.0.9', 'uTorrent 3.3')[n % 3],
+                'flagStr':('TDEI', 'UXI', 'DE')[n % 3], 'progress':n / 50.0,
+                'rateToClient':rate, 'rateToPeer':n * 100}
+    before = [{'id':id, 'peers':[peer(n) for n in range(50)]} for id in range(200)]
+    after = [{'id':id, 'peers':[peer(n, 1000 if n % 10 == 0 else 0) for n in range(1, 51)]}
+             for id in range(200)]
+    def churn(torrents):
+        for torrent,t in zip(torrents, after):
+            torrent.update(t)
+    results = measure(lambda: [TransmissionRPC('torrent', t) for t in before], churn)
+    report('model: update() of 50 peers with churn', results[0], 200 * 50, *results[1:])
+
+def bench_client(counts=None):
+    """TransmissionClient hot paths per torrent count, field width and cache
+    format: cold fill, warm update, partial update, push of count/10 dirty
+    fields and filtered reads."""
+    counts = counts or COUNTS
+    if PAYLOAD is not None:
+        counts = sorted(set(min(count, len(PAYLOAD)) for count in counts))
+    for count in counts:
+        for width in (('recorded',) if PAYLOAD is not None else ('list', 'detail')):
+            fields, cold, partial, warm = payloads(count, width)
+            ids = [t['id'] for t in partial]
+            dirty = max(1, count // 10)
+            for cache,columnar in (('rows', False), ('columns', True)):
+                name = 'client: %%s, %d x %s, %s' % (len(cold), width, cache)
+                def case(title, setup, func, ops):
+                    results = measure(setup, func)
+                    report(name % title, results[0], ops, *results[1:])
+
+                def cold_setup():
+                    client = OfflineClient(columnar)
+                    client.payload = cold
+                    return client
+                case('cold fill', cold_setup, lambda c: c.torrents(keys=fields), len(cold))
+
+                def warm_setup():
+                    client = filled_client(columnar, cold)
+                    client.payload = warm
+                    return client
+                case('warm update', warm_setup, lambda c: c.torrents(keys=fields), len(warm))
+
+                def partial_setup():
+                    client = filled_client(columnar, cold)
+                    client.payload = partial
+                    return client
+                case('partial update', partial_setup,
+                     lambda c: c.torrents(ids=ids, keys=fields), max(1, len(partial)))
+
+                def push_setup():
+                    client = filled_client(columnar, cold)
+                    make_dirty(client, fields, dirty)
+                    return client
+                case('push %d dirty' % dirty, push_setup, lambda c: c.push_torrents(), dirty)
+
+                def read(client):
+                    for t in client.find_torrents(status=['downloading', 'seeding']):
+                        t['name'].hr, t['id'].mr, t['status'].hr
+                    for t in client.find_torrents(error=0, downloadDir='/srv/torrents/'):
+                        t['name'].hr
+                case('filtered reads', lambda: filled_client(columnar, cold), read, len(cold))
+
+
+def load_payload(path):
+    """Return torrents of a recorded 'torrent-get' response, its arguments
+    or a plain list of torrents."""
+    with open(path) as f:
+        doc = json.load(f)
+    if isinstance(doc, dict):
+        doc = doc.get('arguments', doc)['torrents']
+    return doc
+
+def compare(old, new, threshold):
+    """Print changes between two RESULTS; return number of regressions."""
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        for metric in ('seconds', 'allocations', 'peak_rss', 'memory'):
+            if metric not in old[name] or metric not in new[name]:
+                continue
+            before, after = old[name][metric], new[name][metric]
+            change = (after - before) * 100.0 / before if before else 0.0
+            flag = ''
+            # Ignore noise of tiny absolute differences
+            significant = {'seconds': 0.001, 'allocations': 100}.get(metric, 1024**2)
+            if change > threshold and after - before > significant:
+                flag = '  REGRESSION'
+                regressions += 1
+            print '%-48s %-11s %12.4g -> %12.4g  %+7.1f %%%s' % (
+                name, metric, before, after, change, flag)
+    return regressions
+
+
+BENCHMARKS = {
+    'client': bench_client,
+    'fetch': bench_fetch,
+    'formatters': bench_formatters,
+    'memory': bench_memory,
+    'model': bench_model,
+    'poll': bench_poll,
+    'query': bench_query,
+    'stats': bench_stats,
+}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks for transmission-hq.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='one of %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--count', type=int, action='append',
+                        help='torrent count of the suite, may be repeated '
+                             '(default: %s)' % ' and '.join(map(str, COUNTS)))
+    parser.add_argument('--payload', metavar='FILE',
+                        help="recorded 'torrent-get' response to use instead of synthetic torrents")
+    parser.add_argument('--save', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with a saved run')
+    parser.add_argument('--threshold', type=float, default=10, metavar='PERCENT',
+                        help='change that counts as regression (default: 10)')
+    args = parser.parse_args(argv)
+
+    global PAYLOAD
+    if args.count:
+        COUNTS[:] = args.count
+    if args.payload:
+        PAYLOAD = load_payload(args.payload)
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'time': time.time(), 'python': sys.version, 'results': RESULTS},
+                      f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        print
+        if compare(old, RESULTS, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
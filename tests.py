@@ -1,15 +1,43 @@
 #!/usr/bin/env python
 import unittest
+from transmission import BadRequest
 
 from transmissionhq.client import TransmissionClient
 from transmissionhq.helpers import TransmissionURL
 from transmissionhq.rpc import (TransmissionRPCValue, TransmissionRPCError)
+from transmissionhq.columnar import ColumnarTorrentStore
+from transmissionhq.index import TorrentIndex
+from transmissionhq.rpc import (TransmissionRPC, REMOVED)
+from transmissionhq.rpcspec import (RPC, PROJECTIONS, IDENTITIES)
+from transmissionhq.pieces import (PieceMap, torrent_pieces)
+from transmissionhq.transport import ResponseStream
+from transmissionhq.poller import (TransmissionPoller, RPCBudget)
+from transmissionhq.history import (Series, TorrentHistory)
+from transmissionhq.snapshot import (save_snapshot, load_snapshot, warm_start, SnapshotError)
+from transmissionhq.stats import aggregate
+from transmissionhq import stats
+from transmissionhq.formatters import (hr_bytes, hr_bytes_cached, hr_percent, format_column)
+from transmissionhq.fakedaemon import FakeDaemon
+from transmissionhq.client import (ConnectionError, TransmissionError)
+from transmissionhq.asyncclient import AsyncTransmissionClient
+from transmissionhq.transport import gather
+from transmissionhq.fleet import TransmissionFleet
+from transmissionhq.ingest import (add_torrents_async, iter_torrent_sources, torrent_add_args,
+                                   ADDED, DUPLICATE, ERROR)
+from transmissionhq.instrument import (Instrument, Histogram, RPCMetrics, Exporter)
+from transmissionhq.query import (Query, QueryError)
 
 import time
 import os
+import random
+import socket
+import base64
+import threading
 from subprocess import (Popen, call)
 import signal
 from shutil import rmtree
+from tempfile import mkdtemp
+import datetime
 
 daemon_cmd = {
     'binary': '/usr/bin/transmission-daemon',
@@ -41,9 +69,15 @@ rpctypes = [
 
 
 daemon_pid = None
+fake_daemon = None
 def setUpModule():
+    global daemon_pid, fake_daemon
+    if not os.path.exists(daemon_cmd['binary']):
+        print 'No %s, starting fake daemon' % daemon_cmd['binary']
+        fake_daemon = FakeDaemon(torrents=0, host=daemon_cmd['rpc_ip'],
+                                 port=int(daemon_cmd['rpc_port'])).start()
+        return
     print 'Starting Transmission daemon: %s' % daemon_cmd
-    global daemon_pid
     daemon_pid = Popen([
             daemon_cmd['binary'], '--foreground',
             '--logfile', daemon_cmd['logfile'], '--config-dir', daemon_cmd['config_dir'],
@@ -53,13 +87,16 @@ def setUpModule():
     time.sleep(1)  # Wait for daemon to wake up
 
 def tearDownModule():
+    if fake_daemon is not None:
+        print 'Stopping fake daemon'
+        fake_daemon.stop()
+        return
     print 'Stopping Transmission daemon: %d' % daemon_pid
     os.kill(daemon_pid, signal.SIGTERM)
     os.waitpid(daemon_pid, 0)
     print 'Deleting temporary config dir: %s' % daemon_cmd['config_dir']
     rmtree(daemon_cmd['config_dir'])
 
-
 class TransmissionURLTests(unittest.TestCase):
     def testURLDefaults(self):
         url = TransmissionURL()
@@ -124,6 +161,982 @@ class TransmissionRPCValueTests(unittest.TestCase):
             self.assertEqual(rpcval.mr, None)
             self.assertEqual(rpcval.hr, u'Snow White')
 
+    def testTransmissionRPCValueLazyPrettify(self):
+        calls = []
+        rpcval = TransmissionRPCValue('TEST', value=1, type='int', mutable=True)
+        rpcval.prettify(lambda val: calls.append(val) or unicode(val))
+        rpcval.update(2)
+        rpcval.set(3)
+        self.assertEqual(calls, [])
+        self.assertEqual(rpcval.hr, u'3')
+        self.assertEqual(len(rpcval), 1)
+        self.assertEqual(calls, [3])
+        rpcval.update(4)
+        self.assertEqual(str(rpcval), '4')
+        self.assertEqual(calls, [3, 4])
+
+
+class RPCSpecTests(unittest.TestCase):
+    def testProjectionsAreValid(self):
+        for name,fields in PROJECTIONS.items():
+            self.assertIn('id', fields)
+            for field in fields:
+                self.assertIn(field, RPC['torrent'], '%s: %s' % (name, field))
+
+    def testIdentitiesAreValid(self):
+        for (section, key),fields in IDENTITIES.items():
+            for field in fields:
+                self.assertIn(field, RPC[section][key]['subspec'])
+
+class DirtySetTests(unittest.TestCase):
+    def testNestedChanges(self):
+        s = TransmissionRPC('session', {'peer-port':51413,
+                                        'units':{'speed-bytes':1000, 'size-bytes':1000}})
+        self.assertFalse(s.needs_push)
+        s['units']['size-bytes'] = 1024
+        s['peer-port'] = 51414
+        changes = {'peer-port':51414, 'units':{'size-bytes':1024}}
+        self.assertEqual(s.changes(), changes)
+        self.assertEqual(s.changes(clear=True), changes)
+        self.assertEqual((s.changes(), s.needs_push, s['units'].needs_push), ({}, False, False))
+        # Sections without mutable values don't track anything
+        t = TransmissionRPC('torrent', {'id':1, 'files':[{'name':'a', 'length':1}]})
+        self.assertEqual(t['files']._dirty, None)
+
+
+class ListReconcileTests(unittest.TestCase):
+    def peers(self, *ports):
+        return [{'address':'10.0.0.1', 'port':port, 'rateToClient':port % 2} for port in ports]
+
+    def testPeers(self):
+        t = TransmissionRPC('torrent', {'id':1, 'peers':self.peers(1, 2, 3)})
+        third = t['peers'][2]
+        peers = self.peers(2, 3, 5)
+        peers[1]['rateToClient'] = 7
+        self.assertEqual(t.update({'peers':peers}), {'peers':{u'10.0.0.1:1':REMOVED, u'10.0.0.1:3':{'rateToClient':1},
+                                            u'10.0.0.1:5':None}})
+        self.assertTrue(t['peers'][1] is third)
+        self.assertEqual([p['port'] for p in t.mr['peers']], [2, 3, 5])
+        self.assertEqual(t.update({'peers':self.peers(2, 3, 5)}),
+                         {'peers':{u'10.0.0.1:3':{'rateToClient':7}}})
+
+    def testRestoredAndPositional(self):
+        t = TransmissionRPC.restore('torrent', {'id':1, 'priorities':[0, 1, 2],
+                                                'files':[{'name':'a', 'length':1}]})
+        self.assertEqual(t.update({'priorities':[0, 1], 'files':[{'name':'b', 'length':1}]}),
+                         {'priorities':{2:REMOVED}, 'files':{'a':REMOVED, 'b':None}})
+        self.assertEqual(t.mr['priorities'], [0, 1])
+        store = ColumnarTorrentStore()
+        store[1] = {'id':1, 'trackers':[{'id':0}, {'id':1}]}
+        self.assertEqual(store[1].update({'trackers':[{'id':1}]}), {'trackers':{0:REMOVED}})
+        self.assertEqual(store[1].value('trackers'), [{'id':1}])
+
+class ColumnarTorrentStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.pushed = []
+        self.store = ColumnarTorrentStore(setter=lambda **items: self.pushed.append(items))
+        self.store[1] = { 'id':1, 'name':'foo', 'totalSize':1073741824, 'status':4,
+                          'isFinished':False, 'uploadLimit':100 }
+        self.store[2] = { 'id':2, 'name':'bar', 'totalSize':0, 'status':6,
+                          'isFinished':True, 'uploadLimit':0 }
+
+    def testValues(self):
+        t = self.store[1]
+        self.assertEqual(t['name'].mr, 'foo')
+        self.assertEqual(t['status'].mr, 'downloading')
+        self.assertEqual(t['isFinished'].mr, False)
+        self.assertEqual(t['isFinished'].hr, u'false')
+        self.assertEqual(t['uploadLimit'].mr, 100000)
+        self.assertEqual(t['totalSize'].hr, u'1.07 GB')
+        self.assertRaises(KeyError, t.__getitem__, 'eta')
+
+    def testUpdateAndDelete(self):
+        self.store[1].update({ 'id':1, 'name':'baz' })
+        self.assertEqual(self.store[1]['name'].hr, u'baz')
+        del self.store[1]
+        self.assertNotIn(1, self.store)
+        self.store[3] = { 'id':3 }
+        self.assertRaises(KeyError, self.store[3].__getitem__, 'name')
+        self.assertEqual(self.store[2]['name'].mr, 'bar')
+
+    def testPush(self):
+        t = self.store[2]
+        t['uploadLimit'] = 5000
+        self.assertRaises(TransmissionRPCError, t.__setitem__, 'name', 'x')
+        t.push()
+        self.assertEqual(self.pushed, [{ 'id':2, 'uploadLimit':5 }])
+
+
+class TorrentIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = TorrentIndex()
+        for id,status,dir in ((1, 4, '/a'), (2, 6, '/a'), (3, 6, '/b')):
+            t = TransmissionRPC('torrent', { 'id':id, 'status':status, 'downloadDir':dir,
+                                             'labels':['x%d' % id, 'all'] })
+            self.index.reindex(id, t)
+
+    def testFind(self):
+        self.assertEqual(self.index.find(status='seeding'), set([2, 3]))
+        self.assertEqual(self.index.find(status='seeding', downloadDir='/a'), set([2]))
+        self.assertEqual(self.index.find(downloadDir=['/a', '/b']), set([1, 2, 3]))
+        self.assertEqual(self.index.find(labels='all'), set([1, 2, 3]))
+        self.assertEqual(self.index.find(labels='x1'), set([1]))
+        self.assertEqual(self.index.find(status='paused'), set())
+        self.assertRaises(ValueError, self.index.find, name='foo')
+
+    def testReindexAndRemove(self):
+        t = TransmissionRPC('torrent', { 'id':2, 'status':0, 'labels':['x2'] })
+        self.index.reindex(2, t, ['status', 'labels'])
+        self.assertEqual(self.index.find(status='seeding'), set([3]))
+        self.assertEqual(self.index.find(status='paused'), set([2]))
+        self.assertEqual(self.index.find(labels='all'), set([1, 3]))
+        self.assertEqual(self.index.find(downloadDir='/a'), set([1, 2]))
+        self.index.remove(1)
+        self.assertEqual(self.index.find(downloadDir='/a'), set([2]))
+        self.assertEqual(self.index.find(), set([2, 3]))
+
+
+class PieceMapTests(unittest.TestCase):
+    def setUp(self):
+        self.pieces = PieceMap.from_base64('/+A=', count=12)  # 11111111 1110
+
+    def testCount(self):
+        self.assertEqual(len(self.pieces), 12)
+        self.assertEqual(self.pieces.have(), 11)
+        self.assertEqual(self.pieces.have(6, 12), 5)
+        self.assertEqual(self.pieces.missing(), 1)
+        self.assertTrue(self.pieces[10])
+        self.assertFalse(self.pieces[-1])
+
+    def testRunsAndHeatmap(self):
+        self.assertEqual(self.pieces.runs(), [(True, 0, 11), (False, 11, 1)])
+        self.assertEqual(self.pieces.heatmap(3), [1.0, 1.0, 0.75])
+
+    def testDiff(self):
+        old = PieceMap.from_base64('/wA=', count=12)
+        gained, lost = self.pieces.diff(old)
+        self.assertEqual([i for i,have in enumerate(gained) if have], [8, 9, 10])
+        self.assertEqual(lost.have(), 0)
+
+    def testSpec(self):
+        t = TransmissionRPC('torrent', {'id':1, 'pieces':'/+A=', 'pieceCount':12})
+        self.assertEqual(torrent_pieces(t), self.pieces)
+        self.assertEqual(t.update({'pieces':'/+A='}), {})
+        self.assertEqual(t['pieces'].hr, u'11/16 pieces')
+
+class CannedResponse(object):
+    will_close = False
+    connection = None
+    def __init__(self, body):
+        self.body = body
+    def read(self, size):
+        data, self.body = self.body[:size], self.body[size:]
+        return data
+
+class CannedTransport(object):
+    def __init__(self):
+        self.stats = {'bytes_received':0}
+        self.released = []
+    def _release(self, connection, reusable):
+        self.released.append(reusable)
+
+class ResponseStreamTests(unittest.TestCase):
+    def stream(self, body, tag=1):
+        transport = CannedTransport()
+        # Tiny chunks put item boundaries everywhere
+        return ResponseStream(transport, CannedResponse(body), tag, 'torrents', chunk_size=3), transport
+
+    def testItems(self):
+        stream, transport = self.stream('{"arguments": {"removed": [4, 5], "torrents": '
+                                        '[{"id": 1, "name": "f\u00f6\u00f6"}, {"id": 22}]},'
+                                        ' "result": "success", "tag": 1}\n')
+        self.assertEqual(list(stream), [{'id':1, 'name':u'f\xf6\xf6'}, {'id':22}])
+        self.assertEqual(stream.arguments, {'removed':[4, 5]})
+        self.assertEqual(transport.released, [True])
+        self.assertTrue(transport.stats['bytes_received'] > 0)
+
+    def testEmpty(self):
+        stream, transport = self.stream('{"arguments":{"torrents":[]},"result":"success","tag":1}')
+        self.assertEqual(list(stream), [])
+
+    def testErrors(self):
+        stream, transport = self.stream('{"arguments":{},"result":"no such method","tag":1}')
+        self.assertRaises(BadRequest, list, stream)
+        stream, transport = self.stream('{"arguments":{"torrents":[{"id":1},')
+        self.assertRaises(BadRequest, list, stream)
+        self.assertEqual(transport.released, [False])
+
+class CannedClient(TransmissionClient):
+    """Answer 'torrent-get' with a list of torrents instead of asking a daemon."""
+    def __init__(self):
+        TransmissionClient.__init__(self)
+        self.daemon_torrents = []
+    def _request(self, method, **kwargs):
+        ids = kwargs.get('ids')
+        return {'torrents':[dict((k, v) for k,v in t.items() if k in kwargs['fields'])
+                            for t in self.daemon_torrents if ids is None or t['id'] in ids]}
+
+class TransmissionPollerTests(unittest.TestCase):
+    def setUp(self):
+        self.client = CannedClient()
+        self.poller = TransmissionPoller(self.client, session_interval=None,
+                                         intervals={'name':10, 'status':1, 'percentDone':1})
+        self.events = []
+        for event in ('added', 'removed', 'status-changed', 'finished', 'error'):
+            self.poller.subscribe(event, lambda *args, **kw: self.events.append(args))
+        self.client.daemon_torrents = [{'id':1, 'name':'foo', 'status':4,
+                                        'percentDone':0.5, 'error':0}]
+
+    def testUpdateReportsChanges(self):
+        t = TransmissionRPC('torrent', {'id':1, 'status':4, 'name':'foo'})
+        self.assertEqual(t.update({'id':1, 'status':6, 'name':'foo', 'eta':3}),
+                         {'status':'downloading', 'eta':None})
+        self.assertEqual(t.update({'status':6}), {})
+
+    def testEvents(self):
+        self.poller.poll(now=0)
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.client.torrents(ids=[1])[0]['name'].mr, 'foo')
+        self.client.daemon_torrents[0].update(status=6, percentDone=1.0, error=2)
+        del self.events[:]
+        self.poller.poll(now=1)
+        self.assertEqual(self.events[0][1], 'downloading')
+        self.assertEqual(len(self.events), 3)  # status-changed, finished, error
+        self.client.daemon_torrents = []
+        self.poller.poll(now=2)
+        self.assertEqual(self.events[-1], (1,))
+        self.assertEqual(self.client.torrents(), [])
+
+    def testIntervals(self):
+        self.assertIn('name', self.poller.due(now=0))
+        self.poller.poll(now=0)
+        self.assertNotIn('name', self.poller.due(now=5))
+        self.assertIn('status', self.poller.due(now=5))
+        self.assertNotIn('files', self.poller.due(now=100))
+        self.poller.fetch(['files'])
+        self.assertIn('files', self.poller.due(now=5))
+
+    def testOnDemandOnly(self):
+        poller = TransmissionPoller(self.client, session_interval=None,
+                                    intervals=dict((f, None) for f in self.poller.intervals))
+        self.assertEqual(poller.intervals['id'], None)
+        self.assertEqual(poller.due(now=0), [])
+        self.assertEqual(poller.next_poll(), None)
+        self.assertEqual(poller.poll(now=0), [])
+        polled = threading.Event()
+        poller.subscribe('polled', lambda poller, fields: fields and polled.set())
+        poller.start()
+        try:
+            poller.fetch(['name'])
+            self.assertEqual(polled.wait(1), True)
+            self.assertEqual(self.client.torrents(ids=[1])[0]['name'].mr, 'foo')
+            self.assertEqual(poller.next_poll(), None)
+        finally:
+            poller.stop(1)
+
+    def testAdaptive(self):
+        self.poller.adaptive = True
+        self.poller.poll(now=0)  # Torrent added
+        self.assertEqual(self.poller.backoff, 1)
+        self.poller.poll(now=1)
+        self.poller.poll(now=3)
+        self.assertEqual(self.poller.backoff, 4)
+        self.assertNotIn('status', self.poller.due(now=6))
+        self.client.daemon_torrents[0]['status'] = 6
+        self.poller.poll(now=7)
+        self.assertEqual(self.poller.backoff, 1)
+
+    def testBudget(self):
+        budget = RPCBudget(requests=0.5)
+        budget.charge(2, 1000, now=10)
+        self.assertFalse(budget.ready(now=13))
+        self.assertTrue(budget.ready(now=14))
+        self.poller.budget = budget
+        self.assertEqual(self.poller.poll(now=13), [])
+        self.assertNotEqual(self.poller.poll(now=14), [])
+
+class HistoryTests(unittest.TestCase):
+    def testSeries(self):
+        s = Series(size=3)
+        for t,v in ((0, 10), (5, 20), (10, 0), (15, 5)):
+            s.append(t, v)
+        self.assertEqual(s.samples(), [(5, 20), (10, 0), (15, 5)])
+        self.assertEqual(s.last(), (15, 5))
+        self.assertEqual(s.value_at(12), 0)
+        self.assertEqual(s.downsample(0, 20, buckets=2),
+                         [(0, 20, 20, 20), (10, 0, 5, 2.5)])
+        self.assertEqual(s.downsample(0, 4, buckets=1), [(0, None, None, None)])
+
+    def testPolled(self):
+        client = CannedClient()
+        client.daemon_torrents = [{'id':1, 'rateDownload':100}]
+        poller = TransmissionPoller(client, session_interval=None)
+        history = TorrentHistory(size=10)
+        history.attach(poller)
+        self.assertEqual(poller.intervals['uploadedEver'], 1)
+        poller.poll(now=0)
+        poller.poll(now=1)
+        client.daemon_torrents[0]['rateDownload'] = 300
+        poller.poll(now=2)
+        self.assertEqual(history.get(1, 'rateDownload').samples(), [(0, 100), (2, 300)])
+        self.assertEqual(history.query(1, 'rateDownload', since=0, until=4, buckets=1),
+                         [(0, 100, 300, 200)])
+        client.daemon_torrents = []
+        poller.poll(now=3)
+        self.assertEqual(history.get(1, 'rateDownload'), None)
+
+    def testHorizon(self):
+        client = CannedClient()
+        client.daemon_torrents = [{'id':1, 'rateDownload':0}]
+        poller = TransmissionPoller(client, session_interval=None)
+        history = TorrentHistory(horizon=60)
+        history.attach(poller)
+        for now in range(0, 200, poller.intervals['rateDownload']):
+            client.daemon_torrents[0]['rateDownload'] = now
+            poller.poll(now=now)
+        samples = history.get(1, 'rateDownload').samples()
+        self.assertEqual(samples[0][0] <= 199 - 60, True)
+        self.assertEqual(len(samples), 60 // poller.intervals['rateDownload'] + 1)
+
+class FormattersTests(unittest.TestCase):
+    def testBytes(self):
+        for bytes,text in ((None, u'0 B'), (0, u'0.00 B'), (50, u'50 B'), (999, u'999 B'),
+                           (1000, u'1.00 kB'), (12000, u'12 kB'), (12340, u'12.3 kB'),
+                           (999999, u'1000 kB'), (4700000000, u'4.70 GB')):
+            self.assertEqual(hr_bytes(bytes), text)
+            self.assertEqual(hr_bytes_cached(bytes), text)
+        self.assertEqual(hr_bytes(1023, base=1024), u'1023 B')
+        self.assertEqual(hr_bytes(1073741824, base=1024), u'1.00 GiB')
+        self.assertEqual(hr_bytes(1000, lengthy=True), u'1.00 kilobyte')
+        self.assertEqual(hr_bytes(10000, lengthy=True), u'10 kilobytes')
+        self.assertEqual(hr_bytes(1500, format='%(value).1f %(symbol)s'), u'1.5 kB')
+        self.assertRaises(ValueError, hr_bytes, -1)
+        self.assertRaises(ValueError, hr_bytes, 1, base=1001)
+
+    def testColumn(self):
+        values = [None, 0, 2500, 2500, 10**12]
+        self.assertEqual(format_column('bytes_rate', values),
+                         [hr_bytes(v) + u'/s' for v in values])
+        self.assertEqual(format_column('percent', [0.5, None, 1.2]), [u'50 %', u'0 %', u'120 %'])
+        store = ColumnarTorrentStore()
+        store[1] = {'id':1, 'totalSize':1000, 'name':'foo'}
+        store[2] = {'id':2, 'totalSize':0, 'name':'bar'}
+        self.assertEqual(store.get_pretty_column('totalSize', [2, 1]), [u'0.00 B', u'1.00 kB'])
+        self.assertEqual(store.get_pretty_column('name', [1]), [u'foo'])
+        store[1] = {'id':1, 'seedRatioLimit':1.5}
+        self.assertEqual(store[1]['seedRatioLimit'].hr, u'1.50')
+        store[1]['seedRatioLimit'].set(2)
+        self.assertEqual(store[1]['seedRatioLimit'].hr, u'2.00')
+
+class StatsTests(unittest.TestCase):
+    torrents = [
+        { 'id':1, 'status':6, 'rateUpload':100, 'labels':['a', 'b'],
+          'trackers':[{'id':0, 'announce':'http://t1.example/announce'}] },
+        { 'id':2, 'status':6, 'rateUpload':300, 'labels':['a'],
+          'trackers':[{'id':0, 'announce':'udp://t2.example:80'}] },
+        { 'id':3, 'status':4, 'rateUpload':0, 'labels':[], 'trackers':[] },
+        { 'id':4, 'status':6, 'labels':[], 'trackers':[] },
+    ]
+
+    def caches(self):
+        rows = dict((t['id'], TransmissionRPC('torrent', t)) for t in self.torrents)
+        store = ColumnarTorrentStore()
+        for t in self.torrents:
+            store[t['id']] = t
+        return rows, store
+
+    def testAggregate(self):
+        for cache in self.caches():
+            result = aggregate(cache, ['rateUpload'], by='status', percentiles=(50,),
+                               use_numpy=False)
+            self.assertEqual(result['seeding']['count'], 3)
+            self.assertEqual(result['seeding']['rateUpload'],
+                             {'count':2, 'sum':400.0, 'mean':200.0, 'min':100.0,
+                              'max':300.0, 'p50':200.0})
+            self.assertEqual(result['downloading']['rateUpload']['max'], 0.0)
+            self.assertEqual(aggregate(cache, ['rateUpload'], use_numpy=False)[None]['count'], 4)
+
+    def testGroupByList(self):
+        for cache in self.caches():
+            result = aggregate(cache, ['rateUpload'], by='labels', use_numpy=False)
+            self.assertEqual(sorted((k, v['count']) for k,v in result.items()),
+                             [(None, 2), ('a', 2), ('b', 1)])
+            result = aggregate(cache, ['rateUpload'], by='tracker', use_numpy=False)
+            self.assertEqual(result['t2.example']['rateUpload']['sum'], 300.0)
+            self.assertEqual(result[None]['count'], 2)
+
+    @unittest.skipIf(stats.numpy is None, 'NumPy is not installed')
+    def testNumpy(self):
+        rnd = random.Random(1)
+        torrents = self.torrents + [{'id':id, 'status':rnd.choice((0, 4, 6)),
+                                     'rateUpload':rnd.randint(0, 1000),
+                                     'uploadRatio':rnd.random() * 3,
+                                     'labels':rnd.choice(([], ['a'], ['a', 'b']))}
+                                    for id in range(5, 60)]
+        del torrents[20]['rateUpload']
+        rows = dict((t['id'], TransmissionRPC('torrent', t)) for t in torrents)
+        store = ColumnarTorrentStore()
+        for t in torrents:
+            store[t['id']] = t
+        for cache in (rows, store):
+            for by in (None, 'status', 'labels'):
+                args = (cache, ['rateUpload', 'uploadRatio'], by, (10, 50, 95))
+                expected = aggregate(*args, use_numpy=False)
+                result = aggregate(*args, use_numpy=True)
+                self.assertEqual(sorted(result), sorted(expected))
+                for group in expected:
+                    self.assertEqual(result[group]['count'], expected[group]['count'])
+                    for field in ('rateUpload', 'uploadRatio'):
+                        self.assertEqual(sorted(result[group][field]),
+                                         sorted(expected[group][field]))
+                        for key,value in expected[group][field].items():
+                            self.assertAlmostEqual(result[group][field][key], value)
+
+class QueryTests(unittest.TestCase):
+    def setUp(self):
+        self.tlist = [{'id':id, 'name':'Torrent %d' % (id % 10), 'status':(0, 4, 6)[id % 3],
+                       'totalSize':id * 10**8, 'downloadDir':'/data/%s/' % ('tv', 'film')[id % 2],
+                       'labels':[['tv'], [], ['film', 'new']][id % 3], 'isPrivate':id % 5 == 0,
+                       'addedDate':datetime.datetime(2012, 1, 1) + datetime.timedelta(days=id),
+                       'activityDate':1325376000 + id * 3600}
+                      for id in range(1, 101)]
+        self.rows = dict((t['id'], TransmissionRPC('torrent', t)) for t in self.tlist)
+        self.store = ColumnarTorrentStore()
+        for t in self.tlist:
+            self.store[t['id']] = t
+
+    def ids(self, query):
+        ids = [t['id'].mr for t in query.run(self.rows)]
+        self.assertEqual([t['id'].mr for t in query.run(self.store)], ids)
+        return ids
+
+    def testParse(self):
+        q = Query('status == downloading and (totalSize >= 1.5GB or labels in [tv, "x y"])',
+                  sort=['-totalSize', 'name'])
+        self.assertEqual(q.fields, ['id', 'status', 'totalSize', 'labels', 'name'])
+        for where in ('nosuchfield == 1', 'totalSize > lots', 'name ==', '(eta < 1',
+                      'eta < 1 eta', 'pieces == 1', 'name ! a', 'eta ^= 1'):
+            self.assertRaises(QueryError, Query, where)
+        self.assertRaises(QueryError, Query, sort='-nosuchfield')
+
+    def testRun(self):
+        expected = [t['id'] for t in self.tlist if t['status'] == 4 and t['totalSize'] > 1.5e9]
+        self.assertEqual(self.ids(Query('status == downloading and totalSize > 1.5GB')),
+                         expected)
+        expected = [t['id'] for t in self.tlist if 'film' in t['labels'] or t['isPrivate']]
+        self.assertEqual(self.ids(Query('labels == film or isPrivate')), expected)
+        expected = [t['id'] for t in self.tlist
+                    if not t['downloadDir'].startswith('/data/tv') and t['name'] != 'Torrent 3']
+        self.assertEqual(self.ids(Query('not downloadDir == /data/tv and not name = "Torrent 3"')),
+                         expected)
+        self.assertEqual(self.ids(Query('name ~ "ENT 7" and status in [paused, seeding]')),
+                         [t['id'] for t in self.tlist if t['id'] % 10 == 7
+                          and t['status'] in (0, 6)])
+        self.assertEqual(Query('totalSize < 1GiB').count(self.rows), 10)
+
+    def testDates(self):
+        # Decoded dates are datetimes, synthetic ones Unix times
+        self.assertEqual(self.ids(Query('addedDate < 2012-01-05T12:00')), [1, 2, 3, 4])
+        self.assertEqual(self.ids(Query('addedDate >= 2012-04-09 and addedDate < 2012-04-12')),
+                         [99, 100])
+        self.assertEqual(len(self.ids(Query('activityDate >= 0'))), 100)
+        self.assertEqual(self.ids(Query('activityDate < 2012-01-01T03:00')), [1, 2])
+        self.assertEqual(self.ids(Query('activityDate > 1325376000', sort='-activityDate',
+                                        limit=2)), [100, 99])
+        self.assertEqual(self.ids(Query(sort='-addedDate', limit=1)), [100])
+
+    def testSortAndPage(self):
+        expected = sorted(self.tlist, key=lambda t: (t['name'], -t['totalSize']))
+        expected = [t['id'] for t in expected]
+        self.assertEqual(self.ids(Query(sort=['name', '-totalSize'])), expected)
+        self.assertEqual(self.ids(Query(sort=['name', '-totalSize'], offset=10, limit=5)),
+                         expected[10:15])
+        # Top n with a heap
+        self.assertEqual(self.ids(Query('labels == tv', sort='-totalSize', offset=2, limit=3)),
+                         [93, 90, 87])
+
+
+class SnapshotTests(unittest.TestCase):
+    torrents = [{'id':1, 'name':'foo', 'status':6, 'pieces':'/+A=', 'labels':['a'],
+                 'activityDate':datetime.datetime(2012, 10, 1)},
+                {'id':2, 'name':'bar', 'status':0, 'percentDone':0.5,
+                 'trackerStats':[{'id':0, 'host':'http://tracker:80'}]}]
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'snapshot')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def roundtrip(self, columnar):
+        client = TransmissionClient(columnar=columnar)
+        client._update_torrents(self.torrents)
+        client._cache['session'].update({'rpc-version':15})
+        save_snapshot(client, self.path)
+        restored = TransmissionClient(columnar=columnar)
+        header = load_snapshot(restored, self.path)
+        self.assertEqual(header['rpc-version'], 15)
+        self.assertEqual(header['count'], 2)
+        for id in (1, 2):
+            old, new = client._cache['torrents'][id], restored._cache['torrents'][id]
+            self.assertEqual(sorted(old.keys()), sorted(new.keys()))
+            for key in old.keys():
+                self.assertEqual(old.value(key), new.value(key))
+        self.assertEqual(restored.find_torrents(status='seeding')[0]['status'].hr, 'seeding')
+        self.assertEqual(restored.find_torrents(labels='a')[0]['id'], 1)
+        self.assertEqual(restored._cache['session']['rpc-version'].mr, 15)
+
+    def testRoundtrip(self):
+        self.roundtrip(False)
+
+    def testRoundtripColumnar(self):
+        self.roundtrip(True)
+
+    def testWrongDaemon(self):
+        save_snapshot(TransmissionClient(), self.path)
+        self.assertRaises(SnapshotError, load_snapshot,
+                          TransmissionClient({'host':'elsewhere'}), self.path)
+        self.assertRaises(SnapshotError, load_snapshot,
+                          TransmissionClient(columnar=True), self.path)
+        open(self.path, 'w').close()
+        self.assertRaises(SnapshotError, load_snapshot, TransmissionClient(), self.path)
+
+    def testWarmStart(self):
+        daemon = FakeDaemon(torrents=20, seed=1).start()
+        try:
+            client = TransmissionClient(daemon.url)
+            client.torrents(keys=['id', 'name', 'status', 'downloadDir'])
+            client.session()
+            save_snapshot(client, self.path)
+            for id in range(1, 11):
+                daemon.remove(id)
+            new = [daemon.add()['id'], daemon.add()['id']]
+            requests = []
+            daemon.METHODS = dict(FakeDaemon.METHODS)
+            daemon.METHODS['torrent-get'] = lambda daemon, args: \
+                requests.append(args) or FakeDaemon.METHODS['torrent-get'](daemon, args)
+            client = TransmissionClient(daemon.url)
+            thread = warm_start(client, self.path)
+            # Reads are safe while the cache is reconciled
+            while thread.is_alive():
+                for t in client.find_torrents(status=['downloading', 'seeding', 'paused']):
+                    t['id']
+            thread.join()
+            del daemon.METHODS
+            self.assertEqual(sorted(client._cache['torrents']), sorted(daemon.torrents))
+            # Only new torrents are fetched with all fields of the snapshot
+            self.assertEqual([(sorted(args.get('ids', [])), sorted(args['fields']))
+                              for args in requests],
+                             [([], ['hashString', 'id']),
+                              (sorted(new), ['downloadDir', 'id', 'name', 'status']),
+                              (range(11, 21), ['id', 'name', 'status'])])
+            for id in new:
+                self.assertEqual(client._cache['torrents'][id]['downloadDir'].mr,
+                                 daemon.value(daemon.torrents[id], 'downloadDir'))
+            # A new rpc-version drops the snapshot; keys are fetched instead
+            daemon.session['rpc-version'] = 16
+            client = TransmissionClient(daemon.url)
+            warm_start(client, self.path, keys=['id', 'totalSize']).join()
+            self.assertEqual(sorted(client._cache['torrents']), sorted(daemon.torrents))
+            self.assertEqual(sorted(client._cache['torrents'][11].keys()), ['id', 'totalSize'])
+        finally:
+            daemon.stop()
+
+class FakeDaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.daemon = FakeDaemon(torrents=50, seed=1).start()
+        self.client = TransmissionClient(self.daemon.url)
+
+    def tearDown(self):
+        self.daemon.stop()
+
+    def testTorrents(self):
+        tlist = self.client.torrents(keys='list')
+        self.assertEqual(len(tlist), 50)
+        t = self.client.torrents(ids=[3], keys=['id', 'pieces', 'pieceCount', 'files',
+                                                'percentDone', 'totalSize'])[0]
+        self.assertEqual(t['pieces'].mr.percent() >= t['percentDone'].mr - 0.01, True)
+        self.assertEqual(sum(f['length'].mr for f in t['files']), t['totalSize'].mr)
+        self.assertEqual(self.client.transport.stats['session_id_retries'], 1)
+        self.daemon.rotate_session_id()
+        self.client.session()
+        self.assertEqual(self.client.transport.stats['session_id_retries'], 2)
+
+    def testChurn(self):
+        self.client.torrents(keys=['id', 'status'])
+        self.daemon.added_per_second = self.daemon.removed_per_second = 1
+        self.daemon.step(seconds=3)
+        self.assertEqual(len(self.daemon.torrents), 50)
+        self.client.torrents(ids='recently-active', keys=['id', 'status'])
+        self.assertEqual(sorted(self.client._cache['torrents']), sorted(self.daemon.torrents))
+        self.assertEqual(self.daemon.call('torrent-get', {'ids':'recently-active',
+                                                          'fields':['id']})[1],
+                         {'torrents':[], 'removed':[]})
+
+    def testRecentlyActive(self):
+        # Without a cache, everything is fetched
+        tlist = self.client.torrents(ids='recently-active', keys=['id', 'status'])
+        self.assertEqual(sorted(t['id'].mr for t in tlist), sorted(self.daemon.torrents))
+        self.assertEqual(self.daemon.requests['torrent-get'], 1)
+        # Changed torrents are merged, removed ones dropped
+        cache = self.client._cache['torrents']
+        id = [id for id in sorted(cache) if cache[id]['status'].mr != 'will verify'][0]
+        changed, unchanged = cache[id], cache[id + 1]
+        self.daemon.call('torrent-verify', {'ids':[id]})
+        self.daemon.remove(id + 2)
+        tlist = self.client.torrents(ids='recently-active', keys=['id', 'status'])
+        self.assertEqual(sorted(t['id'].mr for t in tlist), sorted(self.daemon.torrents))
+        self.assertEqual(self.daemon.requests['torrent-get'], 2)
+        self.assertIs(cache[id], changed)
+        self.assertEqual(changed['status'].mr, 'will verify')
+        self.assertIn(id, [t['id'].mr for t in self.client.find_torrents(status='will verify')])
+        self.assertIs(cache[id + 1], unchanged)
+        self.assertEqual(id + 2 in cache, False)
+        self.assertEqual(id + 2 in self.client.index.find(status=list(set(
+            t['status'].mr for t in tlist))), False)
+
+    def testPush(self):
+        for n,columnar in enumerate((False, True)):
+            client = TransmissionClient(self.daemon.url, columnar=columnar)
+            client.torrents(keys=['id', 'downloadLimit', 'downloadLimited'])
+            self.assertEqual(client.dirty_torrents(), [])
+            for id,limit in ((2, 100), (3, 100), (4, 200)):
+                client._cache['torrents'][id]['downloadLimit'] = (limit + n) * 1000
+            self.assertEqual(sorted(t['id'] for t in client.dirty_torrents()), [2, 3, 4])
+            self.assertEqual(client.push_torrents(), 2)
+            self.assertEqual(client.dirty_torrents(), [])
+            self.assertEqual([self.daemon.value(self.daemon.torrents[id], 'downloadLimit')
+                              for id in (2, 3, 4)], [100 + n, 100 + n, 200 + n])
+
+    def testErrors(self):
+        self.daemon.fail_requests = 1
+        self.assertRaises(TransmissionError, self.client.session)
+        self.client.session()
+        self.daemon.error_status = 200
+        self.daemon.fail_requests = 1
+        self.assertRaises(TransmissionError, self.client.session)
+        self.daemon.stop()
+        self.assertRaises(ConnectionError, self.client.session)
+
+class HTTPTransportTests(unittest.TestCase):
+    def setUp(self):
+        self.daemon = FakeDaemon(torrents=5, seed=1).start()
+        self.client = TransmissionClient(self.daemon.url)
+        self.stats = self.client.transport.stats
+
+    def tearDown(self):
+        self.daemon.stop()
+
+    def testReuse(self):
+        for i in range(3):
+            self.client.session()
+        # The first request is answered with a session ID
+        self.assertEqual((self.stats['requests'], self.stats['connections'],
+                          self.stats['reused'], self.stats['session_id_retries']), (4, 1, 3, 1))
+        self.daemon.rotate_session_id()
+        self.client.session()
+        self.assertEqual(self.stats['session_id_retries'], 2)
+        self.assertEqual(self.client.transport.headers['X-Transmission-Session-Id'],
+                         self.daemon.session_id)
+        self.assertEqual(self.stats['connections'], 1)
+
+    def testClosedConnection(self):
+        self.client.session()
+        self.daemon.close_connections()
+        time.sleep(0.05)
+        self.client.session()
+        self.assertEqual((self.stats['connections'], self.stats['reused'],
+                          self.stats['retries']), (2, 1, 0))
+
+    def testNoRepeatAfterSending(self):
+        self.client.session()
+        self.daemon.drop_responses = 1
+        self.assertRaises(ConnectionError, self.client.add_torrent,
+                          'magnet:?xt=urn:btih:%s' % ('ab' * 20))
+        self.assertEqual(self.daemon.requests['torrent-add'], 1)
+
+    def testMaxConnections(self):
+        client = TransmissionClient(self.daemon.url, max_connections=2)
+        client.session()
+        self.daemon.latency = 0.05
+        threads = [threading.Thread(target=client.session) for i in range(6)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(client.transport.stats['connections'] <= 2, True)
+        self.assertEqual(time.time() - start >= 0.15, True)
+
+    def testUnixSocket(self):
+        tmpdir = mkdtemp()
+        daemon = FakeDaemon(torrents=5, socket_path=os.path.join(tmpdir, 'rpc.sock')).start()
+        try:
+            client = TransmissionClient(daemon.url)
+            self.assertEqual(str(client.transport.url)[:12], 'http+unix://')
+            self.assertEqual(len(client.torrents(keys=['id'])), 5)
+            client.session()
+            self.assertEqual(client.transport.stats['connections'], 1)
+        finally:
+            daemon.stop()
+            rmtree(tmpdir)
+
+
+class AsyncClientTests(unittest.TestCase):
+    def setUp(self):
+        self.daemon = FakeDaemon(torrents=20, seed=1).start()
+        self.client = self.connect()
+        self.stats = self.client._pool.stats
+
+    def tearDown(self):
+        self.daemon.stop()
+
+    def connect(self, url=None, **kwargs):
+        return AsyncTransmissionClient(url or self.daemon.url, map={}, **kwargs)
+
+    def testSessionId(self):
+        self.client.session().result(timeout=5)
+        self.assertEqual((self.stats['requests'], self.stats['session_id_retries']), (2, 1))
+        self.daemon.rotate_session_id()
+        session = self.client.session().result(timeout=5)
+        self.assertEqual(session['rpc-version'].mr, 15)
+        self.assertEqual(self.stats['session_id_retries'], 2)
+        self.assertEqual((self.stats['connections'], self.stats['reused']), (1, 3))
+
+    def testTimeout(self):
+        client = self.connect(timeout=0.1)
+        self.daemon.latency = 0.5
+        start = time.time()
+        self.assertRaises(ConnectionError, client.session().result, 5)
+        self.assertEqual(time.time() - start < 0.5, True)
+
+    def testClosedConnection(self):
+        self.client.session().result(timeout=5)
+        self.daemon.close_connections()
+        time.sleep(0.05)
+        self.client.session().result(timeout=5)
+        self.assertEqual(self.stats['connections'], 2)
+        # A request the daemon got is never repeated
+        self.daemon.drop_responses = 1
+        future = self.client.add_torrent('magnet:?xt=urn:btih:%s' % ('ab' * 20))
+        self.assertRaises(ConnectionError, future.result, 5)
+        self.assertEqual(self.daemon.requests['torrent-add'], 1)
+
+    def testQueue(self):
+        client = self.connect(max_connections=2)
+        client.session().result(timeout=5)
+        self.daemon.latency = 0.05
+        futures = [client.session() for i in range(6)]
+        self.assertEqual(len(client._pool._queue), 4)
+        start = time.time()
+        gather(futures, client._pool.map).result(timeout=5)
+        self.assertEqual(time.time() - start >= 0.15, True)
+        self.assertEqual(client._pool.stats['connections'], 2)
+
+    def testUnixSocket(self):
+        tmpdir = mkdtemp()
+        daemon = FakeDaemon(torrents=5, socket_path=os.path.join(tmpdir, 'rpc.sock')).start()
+        try:
+            client = self.connect(daemon.url)
+            self.assertEqual(len(client.torrents(keys=['id']).result(timeout=5)), 5)
+        finally:
+            daemon.stop()
+            rmtree(tmpdir)
+
+    def testMethods(self):
+        client = self.client
+        self.assertEqual(len(client.torrents(keys=['id', 'downloadLimit']).result(timeout=5)), 20)
+        for id in (2, 3):
+            client._cache['torrents'][id]['downloadLimit'] = 100000
+        self.assertEqual(client.push_torrents().result(timeout=5), 1)
+        self.assertEqual([self.daemon.value(self.daemon.torrents[id], 'downloadLimit')
+                          for id in (2, 3)], [100, 100])
+        client.delete_torrents([3]).result(timeout=5)
+        self.assertEqual((3 in self.daemon.torrents, 3 in client._cache['torrents']),
+                         (False, False))
+        self.assertRaises(TransmissionError, client.delete_torrents([3]).result, 5)
+        self.assertEqual(client.download_limit(50000).result(timeout=5).mr, 50000)
+        self.assertEqual(self.daemon.session['speed-limit-down'], 50)
+        self.assertEqual(client.upload_limit(20000, id=4).result(timeout=5).mr, 20000)
+        self.assertEqual(client.upload_limit(False, id=[4, 5]).result(timeout=5)[0].mr, False)
+
+    def testQuery(self):
+        future = self.client.query('status == downloading', sort='name', refresh=True)
+        self.assertEqual(self.client._cache['torrents'], {})
+        tlist = future.result(timeout=5)
+        self.assertEqual(len(tlist) > 0, True)
+        self.assertEqual(set(t['status'].mr for t in tlist), set(['downloading']))
+        self.assertEqual(len(self.client.query('status == downloading').result()), len(tlist))
+
+    def testInstruments(self):
+        metrics = RPCMetrics()
+        self.client.add_instrument(metrics)
+        self.daemon.latency = 0.05
+        self.client.torrents(keys=['id']).result(timeout=5)
+        self.client.session().result(timeout=5)
+        summary = dict((row['method'], row) for row in metrics.summary())
+        self.assertEqual(sorted(summary), ['session-get', 'torrent-get'])
+        self.assertEqual(summary['torrent-get']['requests'], 1)
+        self.assertEqual(summary['torrent-get']['seconds'] >= 0.05, True)
+        self.assertEqual(summary['torrent-get']['bytes_received'] > 0, True)
+
+
+class IngestTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'b', 'c'))
+        self.paths = []
+        for name in ('b/c/2.torrent', '1.torrent', 'b/3.torrent'):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'wb') as f:
+                f.write('d4:infod4:name%d:%see' % (len(name), name))
+            self.paths.append(path)
+        open(os.path.join(self.tmpdir, 'b', 'notes.txt'), 'w').close()
+        self.daemon = FakeDaemon(torrents=0).start()
+
+    def tearDown(self):
+        self.daemon.stop()
+        rmtree(self.tmpdir)
+
+    def add(self, items):
+        client = AsyncTransmissionClient(self.daemon.url, map={})
+        return [(status, result if status != ERROR else type(result))
+                for item, status, result in add_torrents_async(client, items, inflight=2)]
+
+    def testSources(self):
+        magnet = 'magnet:?xt=urn:btih:%s' % ('ab' * 20)
+        self.assertEqual(list(iter_torrent_sources([magnet, self.tmpdir])),
+                         [magnet] + sorted(self.paths))
+        with open(self.paths[0], 'rb') as f:
+            self.assertEqual(base64.b64decode(torrent_add_args(self.paths[0])['metainfo']),
+                             f.read())
+        self.assertEqual(torrent_add_args(magnet), {'filename':magnet})
+
+    def testAdd(self):
+        magnet = 'magnet:?xt=urn:btih:%s' % ('ab' * 20)
+        missing = os.path.join(self.tmpdir, 'missing.torrent')
+        results = self.add([self.tmpdir, magnet, missing])
+        self.assertEqual(sorted(results), [(ADDED, 1), (ADDED, 2), (ADDED, 3), (ADDED, 4),
+                                           (ERROR, IOError)])
+        results = self.add([self.paths[0], magnet])
+        self.assertEqual(sorted(status for status, id in results), [DUPLICATE, DUPLICATE])
+        self.daemon.fail_requests = 1
+        self.daemon.error_status = 200
+        self.assertEqual(self.add([magnet]), [(ERROR, TransmissionError)])
+        # A response without arguments is an error, too
+        self.daemon.METHODS = dict(FakeDaemon.METHODS)
+        self.daemon.METHODS['torrent-add'] = lambda daemon, args: {}
+        self.assertEqual(self.add([magnet]), [(ERROR, TransmissionError)])
+        # So is a malformed body, and the other items still get results
+        del self.daemon.METHODS
+        self.daemon.corrupt_responses = 1
+        magnets = ['magnet:?xt=urn:btih:%040x' % i for i in range(3)]
+        self.assertEqual(sorted(status for status, error in self.add(magnets)),
+                         [ADDED, ADDED, ERROR])
+
+
+class FleetTests(unittest.TestCase):
+    def setUp(self):
+        self.daemons = [FakeDaemon(torrents=5, seed=i).start() for i in range(3)]
+        self.daemons[2].latency = 5  # Hung
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead = TransmissionURL(host='127.0.0.1', port=sock.getsockname()[1])
+        sock.close()
+        self.fleet = TransmissionFleet([d.url for d in self.daemons] + [dead], timeout=0.5)
+        self.healthy = [str(d.url) for d in self.daemons[:2]]
+        self.failing = [str(self.daemons[2].url), str(dead)]
+
+    def tearDown(self):
+        self.fleet.close()
+        for daemon in self.daemons:
+            daemon.stop()
+
+    def testTorrents(self):
+        start = time.time()
+        merged = self.fleet.torrents(keys=['id'])
+        self.assertEqual(time.time() - start < 1, True)
+        self.assertEqual(sorted(set(daemon for daemon, hash in merged)), sorted(self.healthy))
+        self.assertEqual(len(merged), 10)
+        for (daemon, hash), t in merged.items():
+            self.assertEqual(t['hashString'].mr, hash)
+        self.assertEqual(sorted(self.fleet.errors), sorted(self.failing))
+        # The hung daemon's read timeout freed its worker
+        time.sleep(0.3)
+        self.fleet.session()
+        self.assertEqual(sorted(self.fleet.errors), sorted(self.failing))
+        self.assertEqual('busy' in str(self.fleet.errors[self.failing[0]]), False)
+
+    def testBusy(self):
+        event = threading.Event()
+        slow = self.fleet.clients[self.healthy[0]]
+        def func(client):
+            if client is slow:
+                event.wait()
+            return 1
+        self.assertEqual(sorted(self.fleet.map(func)), sorted(self.healthy[1:] + self.failing))
+        self.assertEqual(sorted(self.fleet.errors), [self.healthy[0]])
+        results = self.fleet.map(func)
+        self.assertEqual('busy' in str(self.fleet.errors[self.healthy[0]]), True)
+        self.assertEqual(self.healthy[0] in results, False)
+        event.set()
+        time.sleep(0.1)
+        self.assertEqual(self.healthy[0] in self.fleet.map(func), True)
+
+    def testQueued(self):
+        # Each daemon's timeout starts when a worker picks it up
+        fleet = TransmissionFleet([d.url for d in self.daemons] + [TransmissionURL(port=1)],
+                                  workers=2, timeout=0.5)
+        try:
+            results = fleet.map(lambda client: time.sleep(0.3) or 1)
+            self.assertEqual(sorted(results), sorted(fleet.clients))
+            self.assertEqual(fleet.errors, {})
+        finally:
+            fleet.close()
+
+
+class InstrumentTests(unittest.TestCase):
+    def testHistogram(self):
+        h = Histogram((1, 2, 4), window=20, resolution=10)
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            h.observe(value, now=100)
+        self.assertEqual(h.buckets, [1, 2, 1, 1])
+        self.assertEqual(h.quantile(0.5, now=100), 1.75)
+        self.assertEqual(h.quantile(1, now=100), 4)
+        h.observe(1, now=120)
+        self.assertEqual(h.recent(now=120), ([1, 0, 0, 0], 1, 1))
+        self.assertEqual(h.count, 6)
+
+    def testMetrics(self):
+        daemon = FakeDaemon(torrents=10, seed=1).start()
+        try:
+            client = TransmissionClient(daemon.url)
+            calls = []
+            class Recorder(Instrument):
+                def before(self, call): calls.append(call.method)
+                def after(self, call): calls.append(call.error)
+            metrics = RPCMetrics()
+            client.add_instrument(Recorder())
+            client.add_instrument(metrics)
+            client.torrents(keys=['id', 'name'])
+            daemon.fail_requests = 1
+            self.assertRaises(TransmissionError, client.session)
+            self.assertEqual(calls[:3], ['torrent-get', None, 'session-get'])
+            self.assertTrue(isinstance(calls[3], TransmissionError))
+        finally:
+            daemon.stop()
+        summary = dict((entry['method'], entry) for entry in metrics.summary())
+        self.assertEqual(summary['torrent-get']['requests'], 1)
+        self.assertEqual(summary['torrent-get']['retries'], 1)  # Session ID
+        self.assertTrue(summary['torrent-get']['bytes_received'] > 100)
+        self.assertEqual(summary['session-get']['errors'], 1)
+        text = metrics.prometheus()
+        self.assertTrue('transmissionhq_rpc_errors_total{daemon="%s",method="session-get"} 1'
+                        % daemon.url in text)
+        exporter = Exporter(metrics, format='statsd', path='/dev/null')
+        self.assertTrue('.torrent-get.requests:1|c\n' in exporter.render())
+        self.assertFalse('.torrent-get.requests:' in exporter.render())
 
 class TransmissionClientTests(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,239 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+A non-blocking counterpart to TransmissionClient.
+
+Every method returns an RPCFuture immediately.  Requests to any number of
+daemons are multiplexed on one event loop (asyncore) that runs whenever
+RPCFuture.result() or transport.poll() is called.
+
+Classes:
+    AsyncTransmissionClient:
+        >>> from transmissionhq.asyncclient import AsyncTransmissionClient
+        >>> from transmissionhq.transport import gather
+        >>> clients = [AsyncTransmissionClient('host%d:9091' % i) for i in range(40)]
+        >>> futures = [c.torrents(keys=['name', 'rateDownload']) for c in clients]
+        >>> for tlist in gather(futures).result():
+        ...     print len(tlist)
+"""
+
+import os
+import socket
+from transmission import BadRequest  # transmission-fluid
+from client import (TransmissionClient, ConnectionError, TransmissionError,
+                    RECENTLY_ACTIVE, group_changes,
+                    set_torrent_limit, torrent_limit)
+from helpers import TransmissionURL
+from transport import (AsyncRPCPool, RPCFuture, gather)
+from query import Query
+
+
+class AsyncTransmissionClient(TransmissionClient):
+
+    """Handle communication between user interface and daemon without
+    blocking.
+
+    The cache is the same TransmissionRPC structure TransmissionClient uses;
+    it is updated when a response arrives.
+    """
+
+    def __init__(self, url=None, max_connections=4, timeout=30, map=None,
+                 columnar=False, track_fields=False):
+        """Create a new client instance.
+
+        Arguments:
+            url, columnar, track_fields: See TransmissionClient.  The url
+                 may name a Unix domain socket ('socket' key).
+            max_connections: Maximum number of concurrent HTTP connections
+                             to the daemon.  Further requests are queued.
+            timeout: Seconds to wait for a response.
+            map: Optional asyncore socket map.  The global one is used by
+                 default, so all clients share one event loop.
+        """
+        if url is None:
+            url = TransmissionURL()
+        elif not isinstance(url, TransmissionURL):
+            url = TransmissionURL(url)
+        if url['ssl']:
+            raise ValueError('SSL is not supported by %s' % self.__class__.__name__)
+        TransmissionClient.__init__(self, url, columnar, track_fields)
+        self._pool = AsyncRPCPool(url['host'], url['port'], url['path'],
+                                  self.headers, url['username'], url['password'],
+                                  max_connections=max_connections,
+                                  timeout=timeout, map=map, socket_path=url['socket'])
+
+    def _request(self, method, **kwargs):
+        if self._instruments:
+            # Instruments see the time from sending until the future resolves
+            finish = self._observe(method, kwargs, self._pool.stats)
+            future = self._send(method, kwargs)
+            future.add_done_callback(lambda f: finish(f._error))
+            return future
+        return self._send(method, kwargs)
+
+    def _send(self, method, kwargs):
+        def translate(err):
+            if isinstance(err, (socket.error, socket.timeout)):
+                raise ConnectionError("Can't connect to %s: %s" % (self.url, err))
+            elif isinstance(err, BadRequest):
+                raise TransmissionError(err)
+            raise err
+        return self._pool.request(method, **kwargs).then(lambda r: r, translate)
+
+    def session(self, **settings):
+        """Get or set session settings.
+
+        Like TransmissionClient.session(), but return an RPCFuture.
+        """
+        if settings:
+            return self._request('session-set', **settings)
+        def update(response):
+            self._update_session(response)
+            return self._cache['session']
+        return self._request('session-get').then(update)
+
+    def torrents(self, ids=None, keys=[]):
+        """Get a list of torrents.
+
+        Like TransmissionClient.torrents(), but return an RPCFuture.
+        """
+        keys = self.fields(keys)
+
+        if ids == RECENTLY_ACTIVE:
+            if not self._cache['torrents']:
+                return self.torrents(keys=keys)
+            def update_recent(response):
+                self._update_torrents(response['torrents'])
+                for id in response.get('removed', []):
+                    self._forget_torrent(id)
+                return self._cache['torrents'].values()
+            return self._request('torrent-get', ids=ids, fields=keys).then(update_recent)
+
+        if ids is None:
+            param = { 'fields':keys }
+        else:
+            param = { 'ids':ids, 'fields':keys }
+        def update(response):
+            self._update_torrents(response['torrents'], complete=ids is None)
+            if ids is None:
+                return self._cache['torrents'].values()
+            return self._select(ids)
+        return self._request('torrent-get', **param).then(update)
+
+    def query(self, where=None, sort=None, offset=0, limit=None, refresh=False):
+        """Return cached torrents that match a query, sorted and paged.
+
+        Like TransmissionClient.query(), but return an RPCFuture.  With
+        refresh, the query runs once the fields it needs have arrived.
+        """
+        if not isinstance(where, Query):
+            where = Query(where, sort=sort, offset=offset, limit=limit)
+        def run(response=None):
+            with self.lock:
+                return where.run(self._cache['torrents'])
+        if refresh:
+            return self.torrents(keys=where.fields).then(run)
+        future = RPCFuture(self._pool.map)
+        future.set_result(run())
+        return future
+
+    def push_torrents(self, torrents=None):
+        """Send altered values of many torrents to the daemon.
+
+        Like TransmissionClient.push_torrents(), but return an RPCFuture.
+        """
+        groups = group_changes(self.dirty_torrents() if torrents is None else torrents)
+        def sent(response, tlist):
+            for t in tlist:
+                t.changes(clear=True)
+        futures = [self._request('torrent-set', ids=[t['id'].mr for t in tlist],
+                                 **tlist[0].changes()).then(lambda r, tlist=tlist: sent(r, tlist))
+                   for tlist in groups.values()]
+        return gather(futures, self._pool.map).then(lambda results: len(results))
+
+    def add_torrent(self, torrent):
+        """Submit torrent via filepath, weblink or magnetlink.
+
+        Return an RPCFuture for the ID of the added torrent.
+        """
+        if os.path.exists(torrent):
+            torrent = os.path.abspath(torrent)
+        def failed(err):
+            if isinstance(err, TransmissionError):
+                raise TransmissionError('Could not add torrent %s: %s' % (torrent, err))
+            raise err
+        return self._request('torrent-add', filename=torrent).then(
+            lambda response: response['torrent-added']['id'], failed)
+
+    def move_torrents(self, ids, location):
+        """Move torrents to another directory.
+
+        Like TransmissionClient.move_torrents(), but return an RPCFuture.
+        """
+        return self._request('torrent-set-location', ids=ids, location=location, move=True)
+
+    def delete_torrents(self, ids, delete_files=False):
+        """Delete torrents.
+
+        Like TransmissionClient.delete_torrents(), but return an RPCFuture.
+        """
+        def remove(tlist):
+            if not tlist:
+                raise TransmissionError('No torrents found')
+            return self._request('torrent-remove', ids=ids,
+                                 delete_local_data=delete_files).then(forget)
+        def forget(response):
+            for id in ids:
+                self._forget_torrent(id)
+        return self.torrents(ids=ids, keys=['id']).then(remove)
+
+    def _rate_limit(self, dir, limit, id):
+        if id is None:  # Global limit
+            def change(session):
+                if limit is True or limit is False:
+                    session['speed-limit-'+dir+'-enabled'].set(limit)
+                elif type(limit) is int:
+                    session['speed-limit-'+dir].set(limit)
+                    session['speed-limit-'+dir+'-enabled'].set(True)
+                return session.push()
+            def result(session):
+                if session['speed-limit-'+dir+'-enabled'].mr:
+                    return session['speed-limit-'+dir]
+                else:
+                    return session['speed-limit-'+dir+'-enabled']
+            return self.session().then(change).then(
+                lambda response: self.session()).then(result)
+
+        elif type(id) is int:
+            def change(tlist):
+                t = tlist[0]
+                set_torrent_limit(t, dir, limit)
+                pushed = t.push()
+                if pushed is None:
+                    return torrent_limit(t, dir)
+                return pushed.then(lambda response: torrent_limit(t, dir))
+            return self.torrents(ids=[id], keys=[dir+'loadLimit', dir+'loadLimited']).then(change)
+
+        elif type(id) is list:
+            def change(tlist):
+                for t in tlist:
+                    set_torrent_limit(t, dir, limit)
+                by_id = dict((t['id'].mr, t) for t in tlist)
+                return self.push_torrents(tlist).then(
+                    lambda count: [torrent_limit(by_id[i], dir) for i in id if i in by_id])
+            return self.torrents(ids=id, keys=[dir+'loadLimit', dir+'loadLimited']).then(change)
+
+        else:
+            raise ValueError('Invalid ID: %s' % id)
@@ -40,13 +40,26 @@ Classes:
 """
 
 import os
+import time
+import threading
 from transmission import (Transmission, BadRequest)  # transmission-fluid
 from helpers import TransmissionURL
-from rpc import TransmissionRPC
-import requests.exceptions
+from transport import HTTPTransport
+from rpc import (TransmissionRPC, FieldUsageTracker, DirtySet)
+from rpcspec import PROJECTIONS
+from columnar import ColumnarTorrentStore
+from index import TorrentIndex
+from instrument import RPCCall
+from query import Query
+import socket
+import httplib
 from operator import itemgetter
 
 
+# Special value for the 'ids' argument of 'torrent-get'
+RECENTLY_ACTIVE = 'recently-active'
+
+
 class ConnectionError(Exception): pass
 class TransmissionError(Exception): pass
 
@@ -54,30 +67,104 @@ class TransmissionClient(Transmission):
 
     """Handle communication between user interface and daemon."""
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, columnar=False, track_fields=False, **transport):
         """Create a new client instance.
 
         The url argument can be a TransmissionURL object or dict with any
         combination of the following keys:
             host, port, path, username, password, ssl
+
+        Connection settings (see TransmissionURL) can be given as url keys or
+        keyword arguments, e.g. max_connections=8 or
+        socket='/run/transmission/rpc.sock'.  Connection counters are
+        available in transport.stats.
+
+        If columnar is True, torrents are cached in a ColumnarTorrentStore,
+        which needs a fraction of the memory for large numbers of torrents.
+
+        If track_fields is True, the field_usage attribute is a
+        FieldUsageTracker that records which fields of cached torrents are
+        read.  torrents(keys='auto') then requests only those fields.
+
+        Changes of the torrent cache and its index hold the lock attribute,
+        and so do find_torrents() and query(), so they can be used while
+        another thread updates the cache.
         """
-        if url is None:
-            url = TransmissionURL()
-        Transmission.__init__(self, **url)
+        url = TransmissionURL(url)
+        url.update(transport)
+        Transmission.__init__(self, **url.url_parts())
+        self.transport = HTTPTransport(url, self.headers)
+        self._columnar = columnar
+        self.field_usage = FieldUsageTracker() if track_fields else None
         self._cache = {}
         self._cache['session'] = TransmissionRPC('session', setter=self.session)
-        self._cache['torrents'] = {}
+        self._dirty = DirtySet()  # IDs of cached torrents with changes
+        if columnar:
+            self._cache['torrents'] = ColumnarTorrentStore(setter=self._torrentsetter,
+                                                           tracker=self.field_usage)
+        else:
+            self._cache['torrents'] = {}
+        self.index = TorrentIndex()
+        self.lock = threading.RLock()
+        self._observers = []
+        self._instruments = []
 
     def _request(self, method, **kwargs):
+        if self._instruments:
+            return self._instrumented_request(method, kwargs)
+        return self._send(method, kwargs)
+
+    def _send(self, method, kwargs):
         try:
-            response = self.__call__(method, **kwargs)
-        except (requests.ConnectionError, requests.Timeout) as err:
+            response = self.transport.request(method, **kwargs)
+        except (socket.error, httplib.HTTPException) as err:
             raise ConnectionError("Can't connect to %s: %s" % (self.url, err))
         except BadRequest as err:
             raise TransmissionError(err)
         else:
             return response
 
+    def _instrumented_request(self, method, kwargs):
+        finish = self._observe(method, kwargs, self.transport.stats)
+        try:
+            response = self._send(method, kwargs)
+        except Exception as err:
+            finish(err)
+            raise
+        finish(None)
+        return response
+
+    def _observe(self, method, kwargs, stats):
+        """Tell instruments about an RPC that starts now.
+
+        Return a function to call with the exception the RPC failed with (or
+        None) when it is over.  Bytes and retries are taken from stats.
+        """
+        call = RPCCall(str(self.transport.url), method, kwargs)
+        instruments = list(self._instruments)
+        for instrument in instruments:
+            instrument.before(call)
+        sent, received = stats['bytes_sent'], stats['bytes_received']
+        retries = stats['retries'] + stats['session_id_retries']
+        call.start = time.time()
+        def finish(error):
+            call.duration = time.time() - call.start
+            call.error = error
+            call.bytes_sent = stats['bytes_sent'] - sent
+            call.bytes_received = stats['bytes_received'] - received
+            call.retries = stats['retries'] + stats['session_id_retries'] - retries
+            for instrument in instruments:
+                instrument.after(call)
+        return finish
+
+    def add_instrument(self, instrument):
+        """Call instrument.before() and instrument.after() with an RPCCall
+        around every request (see the instrument module)."""
+        self._instruments.append(instrument)
+
+    def remove_instrument(self, instrument):
+        self._instruments.remove(instrument)
+
     def session(self, **settings):
         """Get or set session settings.
 
@@ -88,9 +175,34 @@ class TransmissionClient(Transmission):
         if settings:
             self._request('session-set', **settings)
         else:
-            self._cache['session'].update(self._request('session-get'))
+            self._update_session(self._request('session-get'))
             return self._cache['session']
 
+    def add_observer(self, observer):
+        """Call observer whenever the cache changes.
+
+        observer is called with (event, id, item, changes):
+            'added', id, torrent, None
+            'changed', id, torrent, changes
+            'removed', id, None, None
+            'session', None, session, changes
+        changes is the return value of TransmissionRPC.update().  Only values
+        that really changed are reported.
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+    def _notify(self, event, id, item, changes):
+        for observer in list(self._observers):
+            observer(event, id, item, changes)
+
+    def _update_session(self, data):
+        changes = self._cache['session'].update(data)
+        if changes:
+            self._notify('session', None, self._cache['session'], changes)
+
     def _torrentsetter(self, **items):
         """ A callback provided to TransmissionRPC 'torrent' instances to send
         value changes back to the daemon."""
@@ -100,31 +212,224 @@ class TransmissionClient(Transmission):
         """Get a list of torrents.
 
         Arguments:
-            ids:  A list of torrent IDs.  Invalid IDs are ignored.
+            ids:  A list of torrent IDs or hashStrings.  Invalid IDs are
+                  ignored.  If ids is 'recently-active', only torrents that
+                  changed since the last request are fetched and merged into
+                  the cache, and torrents the daemon reports as removed are
+                  dropped from it.  All cached torrents are returned in that
+                  case.
             keys: A list of 'torrent-get' keys.  (See rpc-spec.txt in the
-                  Transmission docs.)  Invalid keys will be ignored.
+                  Transmission docs.)  Invalid keys will be ignored.  Can
+                  also be the name of a projection in rpcspec.PROJECTIONS
+                  (e.g. 'list' or 'peers') or 'auto'.  See fields().
         """
+        keys = self.fields(keys)
+
+        if ids == RECENTLY_ACTIVE:
+            # Without a populated cache there is nothing to apply deltas to
+            if not self._cache['torrents']:
+                return self.torrents(keys=keys)
+            response = self._request('torrent-get', ids=ids, fields=keys)
+            self._update_torrents(response['torrents'])
+            for id in response.get('removed', []):
+                self._forget_torrent(id)
+            return self._cache['torrents'].values()
 
         if ids is None:
             param = { 'fields':keys }
         else:
             param = { 'ids':ids, 'fields':keys }
 
-        # We need 'id' internally
-        if 'id' not in param['fields']:
-            param['fields'].append('id')
+        self._update_torrents(self._request('torrent-get', **param)['torrents'],
+                              complete=ids is None)
+        # Return only requested torrents
+        if ids is None:
+            return self._cache['torrents'].values()
+        return self._select(ids)
 
-        tlist = self._request('torrent-get', **param)['torrents']
-        # Update/Add requested torrents in our cache
-        for t in tlist:
+    def iter_torrents(self, ids=None, keys=[]):
+        """Like torrents(), but yield each torrent as soon as it arrives.
+
+        The response is decoded incrementally, so even huge 'files' or
+        'peers' lists need memory for only one torrent at a time on top of
+        the cache.  Torrents are yielded in the daemon's order; for
+        'recently-active', removed torrents are dropped after the last one.
+        Closing the generator early abandons the connection.
+        """
+        keys = self.fields(keys)
+        if ids is None:
+            param = { 'fields':keys }
+        else:
+            param = { 'ids':ids, 'fields':keys }
+        try:
+            stream = self.transport.stream('torrent-get', **param)
+        except (socket.error, httplib.HTTPException) as err:
+            raise ConnectionError("Can't connect to %s: %s" % (self.url, err))
+        except BadRequest as err:
+            raise TransmissionError(err)
+        seen = set()
+        try:
+            for t in stream:
+                seen.add(t['id'])
+                yield self._update_torrent(t)
+        except (socket.error, httplib.HTTPException) as err:
+            raise ConnectionError("Can't connect to %s: %s" % (self.url, err))
+        except BadRequest as err:
+            raise TransmissionError(err)
+        finally:
+            stream.close()
+        if ids is None:
+            self._prune_torrents(seen)
+        elif ids == RECENTLY_ACTIVE:
+            for id in stream.arguments.get('removed', []):
+                self._forget_torrent(id)
+
+    def _select(self, ids):
+        """Return cached torrents by IDs or hashStrings."""
+        cache = self._cache['torrents']
+        seen = set()
+        tlist = []
+        with self.lock:
+            for id in ids:
+                if id not in cache:
+                    found = self.index.lookup('hashString', id)
+                    if not found:
+                        continue
+                    id = next(iter(found))
+                if id not in seen:
+                    seen.add(id)
+                    tlist.append(cache[id])
+        return tlist
+
+    def find_torrents(self, **criteria):
+        """Return cached torrents that match all criteria.
+
+        Keywords are fields in index.fields (by default hashString, status,
+        downloadDir, error and labels).  Values are either single values or
+        lists of values, e.g.:
+            client.find_torrents(status=['downloading', 'seeding'], error=0)
+        Only the cache is searched; call torrents() to refresh it.
+        """
+        cache = self._cache['torrents']
+        with self.lock:
+            return [cache[id] for id in self.index.find(**criteria)]
+
+    def query(self, where=None, sort=None, offset=0, limit=None, refresh=False):
+        """Return cached torrents that match a query, sorted and paged.
+
+        where is a Query or an expression (see query module), e.g.:
+            client.query('status == downloading and totalSize > 1GB',
+                         sort='-rateDownload', limit=50)
+        With refresh, the fields the query needs are requested first.
+        """
+        if not isinstance(where, Query):
+            where = Query(where, sort=sort, offset=offset, limit=limit)
+        if refresh:
+            self.torrents(keys=where.fields)
+        with self.lock:
+            return where.run(self._cache['torrents'])
+
+    def fields(self, keys):
+        """Return list of 'torrent-get' fields for keys.
+
+        keys can be a list of fields, the name of a projection in
+        rpcspec.PROJECTIONS or 'auto'.  'auto' means all fields that have been
+        read from cached torrents so far (see track_fields argument of
+        __init__), or the 'list' projection if there are none yet.  'id' is
+        always included.
+        """
+        if keys == 'auto':
+            if self.field_usage is None:
+                raise ValueError("keys='auto' needs a client with track_fields=True")
+            if self.field_usage.used:
+                return self.field_usage.suggest()
+            keys = 'list'
+        if isinstance(keys, basestring):
             try:
-                self._cache['torrents'][t['id']].update(t)
+                keys = PROJECTIONS[keys]
             except KeyError:
-                self._cache['torrents'][t['id']] = \
-                    TransmissionRPC('torrent', t,
-                                    setter=self._torrentsetter)
-        # Return only requested torrents
-        return [t for t in self._cache['torrents'].values() if ids is None or t['id'] in ids]
+                raise ValueError('Unknown projection: %s' % keys)
+        keys = list(keys)
+        # We need 'id' internally
+        if 'id' not in keys:
+            keys.append('id')
+        return keys
+
+    def _update_torrents(self, tlist, complete=False):
+        """Update/Add torrents in our cache.
+
+        If complete is True, tlist contains all of the daemon's torrents and
+        cached torrents that are missing from it are forgotten.
+        """
+        with self.lock:
+            for t in tlist:
+                self._update_torrent(t)
+            if complete:
+                self._prune_torrents(set(t['id'] for t in tlist))
+
+    def _update_torrent(self, t):
+        """Update/Add one torrent in our cache and return it."""
+        cache = self._cache['torrents']
+        id = t['id']
+        with self.lock:
+            if id in cache:
+                torrent = cache[id]
+                changes = torrent.update(t)
+                if changes:
+                    self.index.reindex(id, torrent, changes)
+                    if self._observers:
+                        self._notify('changed', id, torrent, changes)
+            else:
+                cache[id] = self._new_torrent(t)
+                torrent = cache[id]
+                self.index.reindex(id, torrent, t)
+                if self._observers:
+                    self._notify('added', id, torrent, None)
+        return torrent
+
+    def _prune_torrents(self, ids):
+        """Forget all cached torrents that are not in ids."""
+        with self.lock:
+            for id in set(self._cache['torrents']) - ids:
+                self._forget_torrent(id)
+
+    def _forget_torrent(self, id):
+        """Remove torrent from cache and index."""
+        with self.lock:
+            if self._cache['torrents'].pop(id, None) is None:
+                return
+            self._dirty.discard(id)
+            self.index.remove(id)
+        self._notify('removed', id, None, None)
+
+    def _new_torrent(self, t):
+        if self._columnar:
+            return t  # ColumnarTorrentStore copies it into its columns
+        return TransmissionRPC('torrent', t, setter=self._torrentsetter,
+                               tracker=self.field_usage, dirty=self._dirty.child(t['id']))
+
+    def dirty_torrents(self):
+        """Return list of cached torrents with changes that need a push."""
+        cache = self._cache['torrents']
+        if self._columnar:
+            return cache.dirty()
+        return [cache[id] for id in self._dirty if id in cache]
+
+    def push_torrents(self, torrents=None):
+        """Send altered values of many torrents to the daemon.
+
+        Torrents with identical changes share one 'torrent-set' request.
+        torrents defaults to dirty_torrents(), so the cost depends on the
+        number of changed torrents, not on the size of the cache.  Return
+        the number of requests made.
+        """
+        groups = group_changes(self.dirty_torrents() if torrents is None else torrents)
+        for tlist in groups.values():
+            self._request('torrent-set', ids=[t['id'].mr for t in tlist],
+                          **tlist[0].changes())
+            for t in tlist:
+                t.changes(clear=True)
+        return len(groups)
 
     def add_torrent(self, torrent):
         """Submit torrent via filepath, weblink or magnetlink.
@@ -161,7 +466,7 @@ class TransmissionClient(Transmission):
             raise TransmissionError('No torrents found')
         self._request('torrent-remove', ids=ids, delete_local_data=delete_files)
         for id in ids:  # Delete from internal cache
-            del self._cache['torrents'][id]
+            self._forget_torrent(id)
 
     def upload_limit(self, limit=None, id=None):
         """Get or set global or torrent specific upload limit.
@@ -196,24 +501,53 @@ class TransmissionClient(Transmission):
 
         elif type(id) is int:
             t = self.torrents(ids=[id], keys=[dir+'loadLimit', dir+'loadLimited'])[0]
-            if limit is True or limit is False:
-                t[dir+'loadLimited'].set(limit)
-            elif type(limit) is int:
-                t[dir+'loadLimit'].set(limit)
-                t[dir+'loadLimited'].set(True)
+            set_torrent_limit(t, dir, limit)
             t.push()
-            if t[dir+'loadLimited'].mr:
-                return t[dir+'loadLimit']
-            else:
-                return t[dir+'loadLimited']
+            return torrent_limit(t, dir)
 
         elif type(id) is list:
-            retvals = []
-            for i in id:
-                retvals.append(self._rate_limit(dir, limit, i))
-            return retvals
+            # Changes are pushed in bulk, so identical limits for any number
+            # of torrents cost one 'torrent-get' and one 'torrent-set'.
+            tlist = self.torrents(ids=id, keys=[dir+'loadLimit', dir+'loadLimited'])
+            for t in tlist:
+                set_torrent_limit(t, dir, limit)
+            self.push_torrents(tlist)
+            by_id = dict((t['id'].mr, t) for t in tlist)
+            return [torrent_limit(by_id[i], dir) for i in id if i in by_id]
 
         else:
             raise ValueError('Invalid ID: %s' % id)
 
-
+def group_changes(torrents):
+    """Map each distinct set of pending changes to the torrents that have
+    it.  Keys are frozensets of (field, value) pairs; nested lists and dicts
+    are frozen into tuples and frozensets."""
+    groups = {}
+    for t in torrents:
+        changes = t.changes()
+        if changes:
+            groups.setdefault(freeze(changes), []).append(t)
+    return groups
+
+def freeze(value):
+    """Return hashable version of a changes() value."""
+    if type(value) is dict:
+        return frozenset((k, freeze(v)) for k,v in value.items())
+    if type(value) is list:
+        return tuple(freeze(v) for v in value)
+    return value
+
+def set_torrent_limit(t, dir, limit):
+    """Change rate limit of torrent t locally."""
+    if limit is True or limit is False:
+        t[dir+'loadLimited'].set(limit)
+    elif type(limit) is int:
+        t[dir+'loadLimit'].set(limit)
+        t[dir+'loadLimited'].set(True)
+
+def torrent_limit(t, dir):
+    """Return rate limit of torrent t or False if it isn't limited."""
+    if t[dir+'loadLimited'].mr:
+        return t[dir+'loadLimit']
+    else:
+        return t[dir+'loadLimited']
@@ -0,0 +1,354 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+A compact torrent cache that stores one column per 'torrent' field.
+
+Instead of one TransmissionRPCValue per field and torrent, every field in
+rpcspec.RPC['torrent'] gets one array (numbers, booleans) or list (anything
+else) indexed by a torrent slot.  Rows and values are lightweight views
+that are created on access and offer the usual .mr/.hr interface.
+
+Classes:
+    ColumnarTorrentStore: Dict-like {id: ColumnarRow} mapping.
+    ColumnarRow: View on one torrent.
+    ColumnarValue: View on one field of one torrent.
+"""
+
+from array import array
+from rpc import (TransmissionRPC, TransmissionRPCError, SPEC_INDEX, get_items)
+from constants import ENCODING
+from formatters import (FORMATTERS, format_column)
+
+# Spec types that fit into typed arrays
+ARRAY_TYPECODES = {
+    'int': 'l', 'timespan': 'l', 'bytes_size': 'l', 'bytes_rate': 'l',
+    'float': 'd', 'ratio': 'd', 'percent': 'd',
+    'boolean': 'b',
+}
+
+
+class ColumnarValue(object):
+
+    """Look like a TransmissionRPCValue, but read from a column."""
+
+    __slots__ = ('_store', '_slot', '_key')
+
+    def __init__(self, store, slot, key):
+        self._store = store
+        self._slot = slot
+        self._key = key
+
+    def set(self, new_value):
+        self._store.set(self._slot, self._key, new_value)
+
+    def _get_value(self):
+        return self._store.get(self._slot, self._key)
+    def _get_pretty(self):
+        return self._store.get_pretty(self._slot, self._key)
+
+    hr = property(fget=_get_pretty)
+    mr = property(fget=_get_value)
+    needs_push = property(fget=lambda self: self._key in \
+                              self._store._dirty.get(self._slot, ()))
+
+    def __unicode__(self): return self.hr
+    def __str__(self): return self.hr.encode(ENCODING)
+    def __repr__(self): return repr(self.mr)
+    def __trunc__(self): return int(self.mr)
+    def __float__(self): return float(self.mr)
+    def __len__(self): return len(self.hr)
+    def __eq__(self, other): return self.mr == other
+    def __ne__(self, other): return self.mr != other
+    def __lt__(self, other): return self.mr < other
+    def __le__(self, other): return self.mr <= other
+    def __gt__(self, other): return self.mr > other
+    def __ge__(self, other): return self.mr >= other
+    def lower(self): return self.hr.lower()
+    def upper(self): return self.hr.upper()
+
+
+class ColumnarRow(object):
+
+    """Look like a TransmissionRPC 'torrent', but read from columns."""
+
+    __slots__ = ('_store', '_slot')
+
+    def __init__(self, store, slot):
+        self._store = store
+        self._slot = slot
+
+    def update(self, new):
+        """See TransmissionRPC.update()."""
+        return self._store.write(self._slot, new)
+
+    def changes(self, clear=False):
+        """See TransmissionRPC.changes()."""
+        return self._store.changes(self._slot, clear)
+
+    def push(self):
+        """Send altered values to the daemon.  See TransmissionRPC.push()."""
+        return self._store.push(self._slot)
+
+    def __getitem__(self, key):
+        if self._store.tracker is not None:
+            self._store.tracker.add(key)
+        if not self._store.has(self._slot, key):
+            raise KeyError(key)
+        value = self._store.get(self._slot, key)
+        if isinstance(value, TransmissionRPC):
+            return value
+        return ColumnarValue(self._store, self._slot, key)
+    def __setitem__(self, key, value):
+        self[key].set(value)
+    def __iter__(self):
+        return iter(self.keys())
+
+    def value(self, key, default=None):
+        """See TransmissionRPC.value()."""
+        if not self._store.has(self._slot, key):
+            return default
+        value = self._store.get(self._slot, key)
+        if isinstance(value, TransmissionRPC):
+            return value.mr
+        return value
+    def __repr__(self):
+        return repr(dict((key, self._store.get(self._slot, key)) for key in self.keys()))
+    def keys(self):
+        return [key for key in self._store.columns if self._store.has(self._slot, key)]
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+class ColumnarTorrentStore(object):
+
+    """Map torrent IDs to ColumnarRows.
+
+    Assigning a 'torrent-get' dict to an ID adds or replaces a torrent:
+        >>> store = ColumnarTorrentStore()
+        >>> store[1] = {'id':1, 'name':'foo', 'totalSize':1048576}
+        >>> store[1]['totalSize'].hr
+        u'1.05 MB'
+    """
+
+    def __init__(self, setter=None, tracker=None):
+        """Create an empty store.
+
+        setter is called with changed values of a torrent by push().  tracker
+        is an optional FieldUsageTracker that records read keys.
+        """
+        self._setter = setter
+        self.tracker = tracker
+        self._spec = dict((key, spec) for (path, key),spec in SPEC_INDEX.items()
+                          if path == ('torrent',))
+        self._ids = {}      # id -> slot
+        self._free = []     # Reusable slots of removed torrents
+        self._size = 0      # Number of slots
+        self.columns = {}   # key -> array or list
+        self._present = {}  # key -> bytearray; 1 if slot has a value
+        self._dirty = {}    # slot -> set of keys that need a push
+
+    def _column(self, key):
+        try:
+            return self.columns[key]
+        except KeyError:
+            pass
+        spec = self._spec.get(key)
+        if spec is None:
+            raise TransmissionRPCError('Missing RPC specifications: torrent:%s' % key)
+        typecode = ARRAY_TYPECODES.get(spec.type)
+        if typecode is not None:
+            column = array(typecode, [0]) * self._size
+        else:
+            column = [None] * self._size
+        self.columns[key] = column
+        self._present[key] = bytearray(self._size)
+        return column
+
+    def _store(self, slot, key, value):
+        column = self._column(key)
+        try:
+            column[slot] = value
+        except (TypeError, OverflowError):
+            # Value doesn't fit (e.g. None or a string from an onupdate
+            # hook); fall back to a plain list for good.
+            column = self.columns[key] = list(column)
+            column[slot] = value
+        self._present[key][slot] = 1
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        slot = self._size
+        self._size += 1
+        for key,column in self.columns.items():
+            column.append(0 if isinstance(column, array) else None)
+            self._present[key].append(0)
+        return slot
+
+    def write(self, slot, data):
+        """Assimilate values from the daemon.
+
+        Return changed keys like TransmissionRPC.update().
+        """
+        changed = {}
+        for key,value in get_items(data):
+            self._column(key)
+            spec = self._spec[key]
+            if spec.type in ('dict', 'list'):
+                if self.has(slot, key):
+                    nested = self.columns[key][slot].update(value)
+                    if nested:
+                        changed[key] = nested
+                    continue
+                value = TransmissionRPC(['torrent', key], value)
+            else:
+                value = spec.onupdate(value)
+                if self.has(slot, key) and self.columns[key][slot] == value:
+                    continue
+            changed[key] = self.get(slot, key)
+            self._store(slot, key, value)
+        return changed
+
+    def has(self, slot, key):
+        return key in self._present and self._present[key][slot] == 1
+
+    def get(self, slot, key):
+        if not self.has(slot, key):
+            return None
+        column = self.columns[key]
+        if isinstance(column, array) and column.typecode == 'b':
+            return bool(column[slot])
+        return column[slot]
+
+    def get_pretty(self, slot, key):
+        # Not memoized per cell; FORMATTERS keep their own bounded memos
+        return self._spec[key].prettify(self.get(slot, key))
+
+    def get_pretty_column(self, key, ids=None):
+        """Return list of human-readable values of key for ids (all IDs in
+        the order of keys() by default), formatted in one go."""
+        slots = [self._ids[id] for id in (self._ids.keys() if ids is None else ids)]
+        values = [self.get(slot, key) for slot in slots]
+        spec = self._spec[key]
+        if spec.prettify is FORMATTERS.get(spec.type):
+            return format_column(spec.type, values)
+        return [spec.prettify(value) for value in values]
+
+    def set(self, slot, key, value):
+        """Change a value locally; push() sends it to the daemon."""
+        if not self._spec[key].mutable:
+            raise TransmissionRPCError("Can't alter %s" % key)
+        if value != self.get(slot, key):
+            self._store(slot, key, value)
+            self._dirty.setdefault(slot, set()).add(key)
+
+    def changes(self, slot, clear=False):
+        if clear:
+            keys = self._dirty.pop(slot, ())
+        else:
+            keys = self._dirty.get(slot, ())
+        return dict((key, self._spec[key].onwrite(self.get(slot, key))) for key in keys)
+
+    def dirty(self):
+        """Return list of rows with changes that need a push."""
+        return [ColumnarRow(self, slot) for slot,keys in self._dirty.items() if keys]
+
+    def push(self, slot):
+        if not callable(self._setter):
+            return
+        changed_items = self.changes(slot, clear=True)
+        if changed_items:
+            changed_items['id'] = self.get(slot, 'id')
+            return self._setter(**changed_items)
+
+    def dump(self):
+        """Return the contents as a dict of plain values for snapshots.
+
+        Array columns are byte strings, other columns lists of
+        machine-readable values.
+        """
+        columns = {}
+        for key,column in self.columns.items():
+            if isinstance(column, array):
+                data = (column.typecode, column.tostring())
+            else:
+                data = (None, [value.mr if isinstance(value, TransmissionRPC) else value
+                               for value in column])
+            columns[key] = data + (str(self._present[key]),)
+        return {'ids':self._ids, 'size':self._size, 'free':self._free, 'columns':columns}
+
+    def restore(self, state):
+        """Replace contents with the return value of dump().
+
+        Values are taken as they are; onupdate hooks are not applied again.
+        """
+        self._ids = dict(state['ids'])
+        self._size = state['size']
+        self._free = list(state['free'])
+        self.columns = {}
+        self._present = {}
+        self._dirty = {}
+        for key,(typecode, data, present) in state['columns'].items():
+            if typecode is None:
+                if self._spec[key].type in ('dict', 'list'):
+                    data = [None if value is None else
+                            TransmissionRPC.restore(['torrent', key], value)
+                            for value in data]
+                column = list(data)
+            else:
+                column = array(typecode)
+                column.fromstring(data)
+            self.columns[key] = column
+            self._present[key] = bytearray(present)
+
+    # Dict interface
+    def __getitem__(self, id):
+        return ColumnarRow(self, self._ids[id])
+    def __setitem__(self, id, data):
+        if id in self._ids:
+            del self[id]
+        slot = self._allocate()
+        self._ids[id] = slot
+        self.write(slot, data)
+    def __delitem__(self, id):
+        slot = self._ids.pop(id)
+        for key,column in self.columns.items():
+            column[slot] = 0 if isinstance(column, array) else None
+            self._present[key][slot] = 0
+        self._dirty.pop(slot, None)
+        self._free.append(slot)
+    def __contains__(self, id):
+        return id in self._ids
+    def __iter__(self):
+        return iter(self._ids)
+    def __len__(self):
+        return len(self._ids)
+    def pop(self, id, *default):
+        """Remove torrent and return its values as a plain dict."""
+        try:
+            row = self[id]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        values = dict((key, self.get(row._slot, key)) for key in row.keys())
+        del self[id]
+        return values
+    def keys(self):
+        return self._ids.keys()
+    def values(self):
+        return [ColumnarRow(self, slot) for slot in self._ids.values()]
+    def items(self):
+        return [(id, ColumnarRow(self, slot)) for id,slot in self._ids.items()]
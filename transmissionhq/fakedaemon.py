@@ -0,0 +1,645 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+An in-process stand-in for transmission-daemon's RPC interface.
+
+It speaks HTTP with the session ID handshake and implements the methods
+TransmissionClient uses on a synthetic torrent population.  Only a few
+values are stored per torrent (sizes, progress, rates, ...); all other
+'torrent-get' fields are derived from them on request, so populations of
+100000 torrents and more fit into memory.  Everything random comes from a
+seeded generator, so runs are reproducible.
+
+Classes:
+    FakeDaemon:
+        >>> daemon = FakeDaemon(torrents=100000, seed=1).start()
+        >>> client = TransmissionClient(daemon.url)
+        >>> len(client.torrents(keys='list'))
+        100000
+        >>> daemon.latency = 0.05    # Seconds per request
+        >>> daemon.error_rate = 0.1  # Fraction of requests that fail
+        >>> daemon.step(seconds=10)  # Progress, rate changes, added/removed torrents
+        >>> daemon.stop()
+"""
+
+import os
+import re
+import copy
+import json
+import time
+import random
+import socket
+import sys
+import base64
+import hashlib
+import threading
+import BaseHTTPServer
+import SocketServer
+from rpcspec import RPC
+from helpers import TransmissionURL
+from pieces import PieceMap
+
+# Values of 'status'
+STOPPED, CHECK_WAIT, CHECK, DOWNLOAD_WAIT, DOWNLOAD, SEED_WAIT, SEED = range(7)
+
+# Values of fields that are neither stored nor derived, by spec type
+TYPE_DEFAULTS = {
+    'int': 0, 'number': 0, 'timespan': 0, 'date': 0,
+    'bytes_size': 0, 'bytes_rate': 0,
+    'float': 0.0, 'ratio': 0.0, 'percent': 0.0,
+    'boolean': False, 'str': '', 'url': '', 'path_dir': '/', 'path_file': '',
+    'list': [], 'dict': {}, 'pieces': '',
+}
+
+SESSION = {
+    'rpc-version': 15,
+    'rpc-version-minimum': 1,
+    'version': '2.84 (fake)',
+    'config-dir': '/var/lib/transmission',
+    'download-dir': '/srv/torrents',
+    'download-dir-free-space': 3 * 10**12,
+    'peer-limit-global': 200,
+    'peer-limit-per-torrent': 50,
+    'peer-port': 51413,
+    'speed-limit-down': 100,
+    'speed-limit-up': 100,
+    'seedRatioLimit': 2.0,
+    'start-added-torrents': True,
+    'encryption': 'preferred',
+    'dht-enabled': True, 'pex-enabled': True, 'lpd-enabled': False, 'utp-enabled': True,
+    'download-queue-enabled': True, 'download-queue-size': 5,
+    'seed-queue-enabled': False, 'seed-queue-size': 10,
+    'cache-size-mb': 4,
+    'units': { 'speed-bytes': 1000, 'speed-units': ['kB/s', 'MB/s', 'GB/s', 'TB/s'],
+               'memory-bytes': 1024, 'memory-units': ['KiB', 'MiB', 'GiB', 'TiB'],
+               'size-bytes': 1000, 'size-units': ['kB', 'MB', 'GB', 'TB'] },
+}
+
+TRACKER_HOSTS = ('tracker.example.org', 'open.example.net:6969', 'bt.example.com',
+                 'announce.example.io', 'private.example.org')
+DOWNLOAD_DIRS = ('/srv/torrents', '/srv/torrents/music', '/srv/torrents/video',
+                 '/srv/torrents/iso', '/srv/archive')
+LABELS = ('linux', 'music', 'video', 'archive', 'keep')
+
+RE_BTIH = re.compile(r'xt=urn:btih:([0-9a-fA-F]{40})')
+RE_DN = re.compile(r'[?&]dn=([^&]+)')
+
+
+### Fields computed from the stored values of a torrent
+
+def _percent_done(t):
+    return t['haveValid'] / float(t['totalSize']) if t['totalSize'] else 0.0
+
+def _left(t):
+    return t['totalSize'] - t['haveValid']
+
+def _eta(t):
+    if not _left(t):
+        return -1
+    return _left(t) // t['rateDownload'] if t['rateDownload'] else -2
+
+def _piece_size(t):
+    # Aim for about 2000 pieces between 32 KiB and 16 MiB
+    return 1 << max(15, min(24, t['totalSize'].bit_length() - 11))
+
+def _piece_count(t):
+    return -(-t['totalSize'] // _piece_size(t))
+
+def _pieces(t):
+    count = _piece_count(t)
+    have = t['haveValid'] // _piece_size(t) if _left(t) else count
+    return PieceMap.from_int(((1 << have) - 1) << (count - have), count).to_base64()
+
+def _peer_count(t):
+    return min(50, (t['rateDownload'] + t['rateUpload'] + 99999) // 100000)
+
+def _peers(t):
+    count = _peer_count(t)
+    return [{ 'address': '10.%d.%d.%d' % ((t['id'] >> 8) & 255, t['id'] & 255, i + 1),
+              'port': 51413 + i, 'clientName': 'Transmission 2.84',
+              'clientIsChoked': False, 'clientIsInterested': bool(t['rateDownload']),
+              'peerIsChoked': False, 'peerIsInterested': bool(t['rateUpload']),
+              'flagStr': 'TDEI', 'isDownloadingFrom': bool(t['rateDownload']),
+              'isUploadingTo': bool(t['rateUpload']), 'isEncrypted': True,
+              'isIncoming': i % 2 == 1, 'isUTP': i % 3 == 0, 'progress': 0.5,
+              'rateToClient': t['rateDownload'] // count,
+              'rateToPeer': t['rateUpload'] // count }
+            for i in range(count)]
+
+def _file_sizes(t):
+    count = 1 + t['id'] % 3
+    size = t['totalSize'] // count
+    return [size] * (count - 1) + [t['totalSize'] - size * (count - 1)]
+
+def _files(t):
+    done = _percent_done(t)
+    return [{ 'name': '%s/file%d.bin' % (t['name'], i), 'length': size,
+              'bytesCompleted': int(size * done) }
+            for i,size in enumerate(_file_sizes(t))]
+
+def _file_stats(t):
+    return [{ 'bytesCompleted': f['bytesCompleted'], 'wanted': True, 'priority': 0 }
+            for f in _files(t)]
+
+def _trackers(t):
+    host = TRACKER_HOSTS[t['tracker']]
+    return [{ 'id': 0, 'tier': 0, 'announce': 'http://%s/announce' % host,
+              'scrape': 'http://%s/scrape' % host }]
+
+def _tracker_stats(t):
+    stats = []
+    for tracker in _trackers(t):
+        stats.append(dict(tracker, host=tracker['announce'].split('/')[2],
+                          announceState=1, scrapeState=1, isBackup=False,
+                          hasAnnounced=True, hasScraped=True,
+                          lastAnnounceSucceeded=not t['error'], lastAnnounceTimedOut=False,
+                          lastAnnounceResult=t['errorString'] or 'Success',
+                          lastAnnouncePeerCount=_peer_count(t),
+                          lastAnnounceTime=t['activityDate'],
+                          lastAnnounceStartTime=t['activityDate'],
+                          nextAnnounceTime=t['activityDate'] + 1800,
+                          lastScrapeSucceeded=True, lastScrapeTimedOut=False,
+                          lastScrapeResult='', lastScrapeTime=t['activityDate'],
+                          lastScrapeStartTime=t['activityDate'],
+                          nextScrapeTime=t['activityDate'] + 1800,
+                          seederCount=t['id'] % 97, leecherCount=t['id'] % 13,
+                          downloadCount=t['id'] % 1009))
+    return stats
+
+DERIVED = {
+    'percentDone': _percent_done,
+    'leftUntilDone': _left,
+    'desiredAvailable': _left,
+    'sizeWhenDone': lambda t: t['totalSize'],
+    'downloadedEver': lambda t: t['haveValid'],
+    'isFinished': lambda t: t['status'] == STOPPED and not _left(t),
+    'isStalled': lambda t: t['status'] in (DOWNLOAD, SEED) and \
+                           not t['rateDownload'] and not t['rateUpload'],
+    'eta': _eta,
+    'uploadRatio': lambda t: t['uploadedEver'] / float(t['haveValid']) if t['haveValid'] else -1,
+    'metadataPercentComplete': lambda t: 1.0,
+    'pieceSize': _piece_size,
+    'pieceCount': _piece_count,
+    'pieces': _pieces,
+    'peersConnected': _peer_count,
+    'peersGettingFromUs': lambda t: _peer_count(t) if t['rateUpload'] else 0,
+    'peersSendingToUs': lambda t: _peer_count(t) if t['rateDownload'] else 0,
+    'peersFrom': lambda t: { 'fromCache': 0, 'fromDht': 0, 'fromIncoming': 0,
+                             'fromLpd': 0, 'fromLtep': 0, 'fromPex': 0,
+                             'fromTracker': _peer_count(t) },
+    'peers': _peers,
+    'files': _files,
+    'fileStats': _file_stats,
+    'priorities': lambda t: [0] * len(_file_sizes(t)),
+    'wanted': lambda t: [True] * len(_file_sizes(t)),
+    'trackers': _trackers,
+    'trackerStats': _tracker_stats,
+    'magnetLink': lambda t: 'magnet:?xt=urn:btih:%s' % t['hashString'],
+    'startDate': lambda t: t['addedDate'],
+    'dateCreated': lambda t: t['addedDate'] - 86400,
+    'torrentFile': lambda t: '/var/lib/transmission/torrents/%s.torrent' % t['hashString'],
+    'creator': lambda t: 'mktorrent 1.0',
+    'maxConnectedPeers': lambda t: SESSION['peer-limit-per-torrent'],
+}
+
+def _getter(key):
+    """Return function that returns the value of key for stored values."""
+    try:
+        return DERIVED[key]
+    except KeyError:
+        default = TYPE_DEFAULTS.get(RPC['torrent'][key]['type'])
+        return lambda t: t.get(key, default)
+
+
+class FakeDaemon(object):
+
+    """Answer RPCs like transmission-daemon with synthetic torrents.
+
+    Attributes that can be changed at any time:
+        latency: Seconds every request is delayed or a function that
+                 returns them.
+        error_rate: Fraction of requests that fail with error_status (an
+                    HTTP status; 200 means an RPC 'result' other than
+                    'success').
+        fail_requests: The next fail_requests requests fail.
+        drop_responses: The next drop_responses requests are carried out,
+                        but the connection is closed instead of answering.
+        corrupt_responses: The next corrupt_responses requests are carried
+                           out, but answered with half of the JSON body.
+        activity: Fraction of torrents whose rates change per step().
+        added_per_second, removed_per_second: Churn of step().
+    """
+
+    def __init__(self, torrents=1000, seed=0, host='127.0.0.1', port=0,
+                 path='/transmission/rpc', socket_path=None):
+        """Create torrents synthetic torrents; port 0 picks a free port.
+
+        With socket_path, serve on a Unix domain socket instead of a port.
+        """
+        self.host = host
+        self.port = port
+        self.path = path
+        self.socket_path = socket_path
+        self.latency = 0
+        self.error_rate = 0.0
+        self.error_status = 500
+        self.fail_requests = 0
+        self.drop_responses = 0
+        self.corrupt_responses = 0
+        self.activity = 0.05
+        self.added_per_second = 0.1
+        self.removed_per_second = 0.1
+        self.requests = {}       # method -> number of requests
+        self.now = int(time.time())
+        self._random = random.Random(seed)
+        self._error_random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._next_id = 1
+        self._churn = [0.0, 0.0]  # Fractions of torrents to add and remove
+        self._active = set()      # IDs for 'recently-active'
+        self._removed = []
+        self.session = dict((key, TYPE_DEFAULTS.get(spec['type'])) for key,spec
+                            in RPC['session'].items())
+        self.session.update(copy.deepcopy(SESSION))
+        self.rotate_session_id()
+        self.torrents = {}        # ID -> dict of stored values
+        for i in range(torrents):
+            self.add()
+        self._active.clear()
+
+    @property
+    def url(self):
+        """TransmissionURL of the daemon (once it is started)."""
+        return TransmissionURL(host=self.host, port=self.port, path=self.path,
+                               socket=self.socket_path)
+
+    def rotate_session_id(self):
+        """Make clients repeat the session ID handshake."""
+        self.session_id = '%032x' % self._random.getrandbits(128)
+
+    ### Population
+
+    def add(self, name=None, hash=None, paused=False):
+        """Add a synthetic torrent and return its stored values.
+
+        Without name and hash, the torrent is in a random state; otherwise
+        it is new (nothing downloaded yet).
+        """
+        rnd = self._random
+        id = self._next_id
+        self._next_id += 1
+        size = int(10 ** rnd.uniform(7, 10.5))
+        t = { 'id': id,
+              'hashString': hash or '%040x' % rnd.getrandbits(160),
+              'name': name or 'Synthetic torrent #%d' % id,
+              'totalSize': size, 'haveValid': 0, 'uploadedEver': 0,
+              'rateDownload': 0, 'rateUpload': 0,
+              'status': STOPPED if paused else DOWNLOAD,
+              'queuePosition': id - 1,
+              'downloadDir': self.session['download-dir'],
+              'addedDate': self.now, 'activityDate': self.now, 'doneDate': 0,
+              'error': 0, 'errorString': '', 'labels': [],
+              'tracker': rnd.randrange(len(TRACKER_HOSTS)) }
+        if name is None and hash is None:
+            status = rnd.random()
+            if status < 0.6:
+                t['status'] = SEED
+            elif status < 0.85:
+                t['status'] = STOPPED
+            elif status < 0.95:
+                t['status'] = DOWNLOAD
+            else:
+                t['status'] = rnd.choice((CHECK_WAIT, CHECK, DOWNLOAD_WAIT, SEED_WAIT))
+            complete = t['status'] in (SEED, SEED_WAIT) or \
+                       t['status'] == STOPPED and rnd.random() < 0.5
+            t['haveValid'] = size if complete else int(size * rnd.random())
+            if complete:
+                t['uploadedEver'] = int(size * rnd.uniform(0, 3))
+                t['doneDate'] = self.now - rnd.randint(0, 10**7)
+            if t['status'] == DOWNLOAD:
+                t['rateDownload'] = rnd.randint(0, 5 * 10**6)
+            if t['status'] == SEED and rnd.random() < 0.3:
+                t['rateUpload'] = rnd.randint(0, 2 * 10**6)
+            t['addedDate'] = t['activityDate'] = self.now - rnd.randint(0, 3 * 10**7)
+            t['downloadDir'] = rnd.choice(DOWNLOAD_DIRS)
+            t['labels'] = rnd.sample(LABELS, rnd.choice((0, 0, 0, 1, 2)))
+            if rnd.random() < 0.02:
+                t['error'] = 2
+                t['errorString'] = 'Tracker gave HTTP response code 404 (Not Found)'
+        self.torrents[id] = t
+        self._active.add(id)
+        return t
+
+    def remove(self, id):
+        del self.torrents[id]
+        self._active.discard(id)
+        self._removed.append(id)
+
+    def step(self, seconds=1.0):
+        """Let seconds pass.
+
+        Downloading torrents progress and finish, seeding torrents upload,
+        the rates of a fraction of torrents (activity) change and torrents
+        are added and removed.
+        """
+        with self._lock:
+            rnd = self._random
+            self.now += int(seconds)
+            changed = self._active
+            for t in rnd.sample(self.torrents.values(),
+                                int(len(self.torrents) * self.activity)):
+                if t['status'] == DOWNLOAD:
+                    t['rateDownload'] = rnd.randint(0, 5 * 10**6)
+                if t['status'] in (DOWNLOAD, SEED):
+                    t['rateUpload'] = rnd.randint(0, 2 * 10**6) if rnd.random() < 0.5 else 0
+                t['activityDate'] = self.now
+                changed.add(t['id'])
+            for t in self.torrents.itervalues():
+                if t['rateDownload']:
+                    t['haveValid'] = min(t['totalSize'],
+                                         t['haveValid'] + int(t['rateDownload'] * seconds))
+                    if t['haveValid'] == t['totalSize']:
+                        t['status'] = SEED
+                        t['rateDownload'] = 0
+                        t['doneDate'] = self.now
+                    changed.add(t['id'])
+                if t['rateUpload']:
+                    t['uploadedEver'] += int(t['rateUpload'] * seconds)
+                    changed.add(t['id'])
+
+            self._churn[0] += self.added_per_second * seconds
+            self._churn[1] += self.removed_per_second * seconds
+            while self._churn[0] >= 1:
+                self._churn[0] -= 1
+                self.add()
+            while self._churn[1] >= 1 and self.torrents:
+                self._churn[1] -= 1
+                self.remove(rnd.choice(self.torrents.keys()))
+
+    ### RPC methods
+
+    def value(self, t, key):
+        """Return 'torrent-get' value of key for stored values t."""
+        return _getter(key)(t)
+
+    def _select(self, ids):
+        if ids is None:
+            return [self.torrents[id] for id in sorted(self.torrents)]
+        if not isinstance(ids, list):
+            ids = [ids]
+        hashes = None
+        selected = []
+        for id in ids:
+            if isinstance(id, basestring):
+                if hashes is None:
+                    hashes = dict((t['hashString'], t) for t in self.torrents.itervalues())
+                t = hashes.get(id.lower())
+            else:
+                t = self.torrents.get(id)
+            if t is not None:
+                selected.append(t)
+        return selected
+
+    def _session_get(self, args):
+        fields = args.get('fields')
+        if fields:
+            return dict((k, v) for k,v in self.session.items() if k in fields)
+        return dict(self.session)
+
+    def _session_set(self, args):
+        for key,value in args.items():
+            if RPC['session'].get(key, {}).get('mutable'):
+                self.session[key] = value
+
+    def _torrent_get(self, args):
+        fields = [f for f in args.get('fields') or () if f in RPC['torrent']]
+        if not fields:
+            raise ValueError('no fields specified')
+        ids = args.get('ids')
+        result = {}
+        if ids == 'recently-active':
+            torrents = [self.torrents[id] for id in sorted(self._active)
+                        if id in self.torrents]
+            result['removed'], self._removed = self._removed, []
+            self._active = set()
+        else:
+            torrents = self._select(ids)
+        getters = [(f, _getter(f)) for f in fields]
+        result['torrents'] = [dict([(f, get(t)) for f,get in getters]) for t in torrents]
+        return result
+
+    def _torrent_set(self, args):
+        for t in self._select(args.get('ids')):
+            for key,value in args.items():
+                if RPC['torrent'].get(key, {}).get('mutable') or key == 'labels':
+                    t[key] = value
+            self._active.add(t['id'])
+
+    def _torrent_add(self, args):
+        if args.get('metainfo'):
+            data = base64.b64decode(args['metainfo'])
+            hash, name = hashlib.sha1(data).hexdigest(), None
+        elif args.get('filename'):
+            filename = args['filename']
+            match = RE_BTIH.search(filename)
+            hash = match.group(1).lower() if match else hashlib.sha1(filename).hexdigest()
+            match = RE_DN.search(filename)
+            name = match.group(1) if match else filename.rsplit('/', 1)[-1]
+        else:
+            raise ValueError('no filename or metainfo specified')
+        for t in self.torrents.itervalues():
+            if t['hashString'] == hash:
+                return { 'torrent-duplicate': { 'id':t['id'], 'name':t['name'],
+                                                'hashString':hash } }
+        paused = args.get('paused', not self.session['start-added-torrents'])
+        t = self.add(name=name or hash, hash=hash, paused=paused)
+        if args.get('download-dir'):
+            t['downloadDir'] = args['download-dir']
+        return { 'torrent-added': { 'id':t['id'], 'name':t['name'], 'hashString':hash } }
+
+    def _torrent_remove(self, args):
+        for t in self._select(args.get('ids')):
+            self.remove(t['id'])
+
+    def _torrent_set_location(self, args):
+        for t in self._select(args.get('ids')):
+            t['downloadDir'] = args['location']
+            self._active.add(t['id'])
+
+    def _set_status(self, args, status):
+        for t in self._select(args.get('ids')):
+            t['status'] = status
+            if status == STOPPED:
+                t['rateDownload'] = t['rateUpload'] = 0
+            self._active.add(t['id'])
+
+    METHODS = {
+        'session-get': _session_get,
+        'session-set': _session_set,
+        'torrent-get': _torrent_get,
+        'torrent-set': _torrent_set,
+        'torrent-add': _torrent_add,
+        'torrent-remove': _torrent_remove,
+        'torrent-set-location': _torrent_set_location,
+        'torrent-start': lambda self, args: self._set_status(args, DOWNLOAD),
+        'torrent-stop': lambda self, args: self._set_status(args, STOPPED),
+        'torrent-verify': lambda self, args: self._set_status(args, CHECK_WAIT),
+    }
+
+    def call(self, method, arguments=None):
+        """Run an RPC without HTTP; return (result, arguments)."""
+        self.requests[method] = self.requests.get(method, 0) + 1
+        func = self.METHODS.get(method)
+        if func is None:
+            return 'method name not recognized', None
+        with self._lock:
+            try:
+                return 'success', func(self, arguments or {}) or {}
+            except (ValueError, TypeError, KeyError) as err:
+                return str(err), None
+
+    def _inject_error(self):
+        """Return True if the current request should fail."""
+        with self._lock:
+            if self.fail_requests > 0:
+                self.fail_requests -= 1
+                return True
+            return self.error_rate > 0 and self._error_random.random() < self.error_rate
+
+    def _countdown(self, name):
+        """Decrease attribute name and return True if it was positive."""
+        with self._lock:
+            if getattr(self, name) > 0:
+                setattr(self, name, getattr(self, name) - 1)
+                return True
+            return False
+
+    ### HTTP server
+
+    def start(self):
+        """Serve in a daemon thread; return self."""
+        if self.socket_path:
+            self._server = _UnixServer(self.socket_path, _Handler)
+        else:
+            self._server = _Server((self.host, self.port), _Handler)
+            self.port = self._server.server_address[1]
+        self._server.fake = self
+        thread = threading.Thread(target=self._server.serve_forever, name='FakeDaemon')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close all connections."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self.close_connections()
+            self._server = None
+            if self.socket_path:
+                os.unlink(self.socket_path)
+
+    def close_connections(self):
+        """Close all open keep-alive connections, like an idle timeout."""
+        for conn in list(self._server.connections):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.connections = set()  # Open keep-alive connections
+
+    def process_request_thread(self, request, client_address):
+        self.connections.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connections.discard(request)
+
+    def handle_error(self, request, client_address):
+        # Clients closing keep-alive connections are no error
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class _UnixServer(_Server):
+
+    address_family = socket.AF_UNIX
+    allow_reuse_address = False
+
+    def server_bind(self):
+        # HTTPServer.server_bind() expects a (host, port) address
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1  # Send each response at once instead of line by line
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body='', headers={}):
+        self.send_response(status)
+        for name,value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_POST(self):
+        daemon = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != daemon.path:
+            return self._reply(404)
+        if self.headers.get('X-Transmission-Session-Id') != daemon.session_id:
+            return self._reply(409, headers={'X-Transmission-Session-Id': daemon.session_id})
+        latency = daemon.latency() if callable(daemon.latency) else daemon.latency
+        if latency:
+            time.sleep(latency)
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return self._reply(400)
+        tag = request.get('tag')
+        if daemon._inject_error():
+            if daemon.error_status != 200:
+                return self._reply(daemon.error_status)
+            result, arguments = 'injected error', None
+        else:
+            result, arguments = daemon.call(request.get('method'), request.get('arguments'))
+            if daemon._countdown('drop_responses'):
+                self.close_connection = 1
+                return
+        response = { 'result': result, 'tag': tag }
+        if arguments is not None:
+            response['arguments'] = arguments
+        body = json.dumps(response, separators=(',', ':'))
+        if daemon._countdown('corrupt_responses'):
+            body = body[:len(body) // 2]
+        self._reply(200, body)
@@ -0,0 +1,206 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Talk to many Transmission daemons at once.
+
+Classes:
+    TransmissionFleet:
+        >>> from transmissionhq.fleet import TransmissionFleet
+        >>> fleet = TransmissionFleet(['host1:9091', 'host2:9091', 'host3:9091'])
+        >>> torrents = fleet.torrents(keys=['name', 'rateDownload'])
+        >>> torrents[('http://host1:9091/transmission/rpc', 'a1b2...')]['name'].hr
+        u'Some torrent'
+        >>> fleet.errors
+        {'http://host3:9091/transmission/rpc': ConnectionError(...)}
+"""
+
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from client import (TransmissionClient, ConnectionError)
+from helpers import TransmissionURL
+
+
+class TransmissionFleet(object):
+
+    """Fan out requests to many daemons on a bounded pool of threads.
+
+    Results are dicts keyed by daemon (the str() of its TransmissionURL) or,
+    for torrents, by (daemon, hashString).  Daemons that failed or didn't
+    answer within timeout are left out of the result; their exceptions are
+    available in the errors attribute until the next request.
+    """
+
+    def __init__(self, urls, workers=16, timeout=30):
+        """Create a new fleet.
+
+        Arguments:
+            urls: A list of TransmissionURLs or anything TransmissionURL
+                  accepts.
+            workers: Maximum number of daemons that are talked to at once.
+            timeout: Seconds to wait for the slowest daemon.  Connect and
+                     read timeouts of the daemons' connections are at most
+                     that long, so a hung daemon doesn't keep its worker
+                     thread busy.
+        """
+        self.timeout = timeout
+        self.clients = {}
+        self._daemons = {}
+        for url in urls:
+            url = TransmissionURL(url)  # A copy that gets the timeouts
+            for key in ('connect_timeout', 'read_timeout'):
+                if url[key] is None or url[key] > timeout:
+                    url[key] = timeout
+            client = TransmissionClient(url)
+            self.clients[str(url)] = client
+            self._daemons[client] = str(url)
+        self.errors = {}
+        self._pool = ThreadPool(max(1, min(workers, len(self.clients))))
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)  # A call started or ended
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add_instrument(self, instrument):
+        """Attach instrument to the clients of all daemons.  An RPCMetrics
+        instance shows which daemons take the most time."""
+        for client in self.clients.values():
+            client.add_instrument(instrument)
+
+    def close(self):
+        """Stop the worker threads."""
+        self._pool.terminate()
+
+    def _run(self, daemon, call, func, args, kwargs):
+        with self._changed:
+            call['started'] = time.time()
+            self._changed.notify_all()
+        try:
+            call['result'] = func(self.clients[daemon], *args, **kwargs)
+        except Exception as err:
+            call['error'] = err
+        finally:
+            with self._changed:
+                self._busy.discard(daemon)
+                call['done'] = True
+                self._changed.notify_all()
+
+    def map(self, func, *args, **kwargs):
+        """Call func(client, *args, **kwargs) for each daemon concurrently.
+
+        Return a dict that maps daemons to return values.  A daemon that is
+        still busy with a previous, timed out call is skipped.
+        """
+        self.errors = {}
+        calls = {}
+        for daemon in self.clients:
+            with self._lock:
+                if daemon in self._busy:
+                    self.errors[daemon] = ConnectionError('%s is still busy' % daemon)
+                    continue
+                self._busy.add(daemon)
+            calls[daemon] = call = {'started':None, 'done':False}
+            self._pool.apply_async(self._run, (daemon, call, func, args, kwargs))
+        # A daemon's timeout starts when a worker picks it up, so daemons
+        # queued behind hung ones aren't given up before they had a chance.
+        results = {}
+        with self._changed:
+            while calls:
+                now = time.time()
+                deadline = None
+                for daemon,call in calls.items():
+                    if call['done']:
+                        if 'error' in call:
+                            self.errors[daemon] = call['error']
+                        else:
+                            results[daemon] = call['result']
+                    elif call['started'] is None:
+                        continue
+                    elif now < call['started'] + self.timeout:
+                        deadline = min(deadline or now + self.timeout,
+                                       call['started'] + self.timeout)
+                        continue
+                    else:
+                        self.errors[daemon] = ConnectionError(
+                            '%s timed out after %s seconds' % (daemon, self.timeout))
+                    del calls[daemon]
+                if calls:
+                    self._changed.wait(None if deadline is None else deadline - now)
+        return results
+
+    def session(self):
+        """Return session settings of each daemon."""
+        return self.map(lambda client: client.session())
+
+    def torrents(self, ids=None, keys=[]):
+        """Return torrents of all daemons keyed by (daemon, hashString).
+
+        See TransmissionClient.torrents() for arguments.
+        """
+        keys = list(keys)
+        if 'hashString' not in keys:
+            keys.append('hashString')
+        merged = {}
+        for daemon,tlist in self.map(lambda client: client.torrents(ids, keys)).items():
+            for t in tlist:
+                merged[(daemon, t['hashString'].mr)] = t
+        return merged
+
+    def _by_daemon(self, keys):
+        """Group (daemon, hashString) keys by daemon."""
+        grouped = {}
+        for daemon,hash in keys:
+            grouped.setdefault(daemon, []).append(hash)
+        return grouped
+
+    def _bulk(self, keys, func):
+        grouped = self._by_daemon(keys)
+        def run(client):
+            hashes = grouped.get(self._daemons[client])
+            if hashes:
+                return func(client, hashes)
+        return self.map(run)
+
+    def move_torrents(self, keys, location):
+        """Move torrents to another directory.
+
+        Arguments:
+            keys: List of (daemon, hashString) tuples.
+            location: Path to directory.
+        """
+        return self._bulk(keys, lambda client, hashes: client.move_torrents(hashes, location))
+
+    def delete_torrents(self, keys, delete_files=False):
+        """Delete torrents.
+
+        Arguments:
+            keys: List of (daemon, hashString) tuples.
+            delete_files: Delete torrents' files if True.
+        """
+        def delete(client, hashes):
+            ids = [t['id'].mr for t in client.torrents(ids=hashes, keys=['id', 'hashString'])]
+            if ids:
+                client.delete_torrents(ids, delete_files)
+        return self._bulk(keys, delete)
+
+    def upload_limit(self, limit=None):
+        """Get or set the global upload limit of each daemon."""
+        return self.map(lambda client: client.upload_limit(limit))
+
+    def download_limit(self, limit=None):
+        """Get or set the global download limit of each daemon."""
+        return self.map(lambda client: client.download_limit(limit))
@@ -0,0 +1,226 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Converters from machine-readable to human-readable values.
+
+Unit thresholds and symbols are computed once per base; the unit is picked
+with bisect and numbers below the smallest unit come from a lookup table.
+Sizes and limits rarely change, so 'bytes_size' values are memoized.
+
+Functions:
+    hr_bytes:
+        >>> hr_bytes(1073741824), hr_bytes(1073741824, base=1024)
+        (u'1.07 GB', u'1.00 GiB')
+        >>> hr_bytes(12000, lengthy=True)
+        u'12 kilobytes'
+
+    hr_ratio, hr_percent:
+        >>> hr_ratio(1.5), hr_ratio(-2), hr_percent(0.256)
+        (u'1.50', u'inf', u'25 %')
+
+    format_column: Format a list of values of one spec type at once.
+        >>> format_column('bytes_rate', [0, 2500, 2500])
+        [u'0.00 B/s', u'2.50 kB/s', u'2.50 kB/s']
+"""
+
+from bisect import bisect_right
+from constants import (BYTE_SYMBOLS, BYTE_SIZES, RE_HOMEDIR)
+
+# Maximum number of memoized values of hr_bytes_cached()
+MEMO_SIZE = 4096
+
+_TABLES = {}  # (base, lengthy) -> _ByteTable
+_MEMO = {}    # bytes -> hr_bytes(bytes)
+_PERCENT = tuple(u'%d %%' % p for p in range(101))
+
+
+class _ByteTable(object):
+
+    """Unit thresholds, suffixes and small numbers of one base/notation."""
+
+    __slots__ = ('sizes', 'symbols', 'singular', 'plural', 'small')
+
+    def __init__(self, base, lengthy):
+        try:
+            symbols = ('',) + BYTE_SYMBOLS[base][('short','long')[lengthy]]
+            self.sizes = (1,) + BYTE_SIZES[base]
+        except KeyError:
+            raise ValueError('Unknown base for byte conversion: %s' % base)
+        self.symbols = symbols
+        unit, units = ('byte', 'bytes') if lengthy else ('B', 'B')
+        self.singular = tuple(u' %s%s' % (s, unit) for s in symbols)
+        self.plural = tuple(u' %s%s' % (s, units) for s in symbols)
+        # Numbers below the smallest unit are looked up
+        self.small = tuple(self.text(b, 0) for b in range(self.sizes[1]))
+
+    def text(self, bytes, index):
+        """Return bytes in units of sizes[index] with reasonable precision."""
+        # Cut everything after two decimal points first
+        number = u'%.2f' % (float(bytes) / self.sizes[index])
+        value = float(number)
+        if value < 10:      # 'n.nn' between 0 and 10
+            if value == 1:
+                return number + self.singular[index]
+        elif value < 100:   # 'n.n' between 10 and 100
+            number = u'%.1f' % value
+            if number[-1] == u'0':
+                number = number[:-2]
+        else:               # 'n' between 100 and 1000/1024
+            number = number[:-3]
+        return number + self.plural[index]
+
+def _table(base, lengthy):
+    try:
+        return _TABLES[(base, lengthy)]
+    except KeyError:
+        table = _TABLES[(base, lengthy)] = _ByteTable(base, lengthy)
+        return table
+
+def hr_bytes(bytes, base=1000, lengthy=False, format=None):
+    """Return number of bytes as unicode with unit (e.g. u'1.07 GB').
+
+    format is a %-format string with 'value' and 'symbol' keys; by default
+    the precision depends on the magnitude.  lengthy spells out units
+    ('kilobytes').
+    """
+    try:
+        bytes = int(bytes)
+    except TypeError:
+        return u'0 B'
+    if bytes < 0:
+        raise ValueError('bytes < 0: %d' % bytes)
+    table = _TABLES.get((base, lengthy)) or _table(base, lengthy)
+    if format is None:
+        if bytes < len(table.small):
+            return table.small[bytes]
+        return table.text(bytes, bisect_right(table.sizes, bytes) - 1)
+
+    index = max(0, bisect_right(table.sizes, bytes) - 1)
+    value = float('%.2f' % (float(bytes) / table.sizes[index]))
+    text = format % dict(symbol=table.symbols[index], value=value)
+    unit = (table.plural, table.singular)[value == 1][0]  # Unit without symbol
+    return text.replace('.0 ', ' ') + unit[1:]
+
+def hr_bytes_cached(bytes):
+    """Memoizing hr_bytes() for values that rarely change (sizes, limits).
+
+    The memo is cleared when it holds MEMO_SIZE values.
+    """
+    try:
+        text = _MEMO.get(bytes)
+    except TypeError:  # Unhashable
+        return hr_bytes(bytes)
+    if text is None:
+        if len(_MEMO) >= MEMO_SIZE:
+            _MEMO.clear()
+        text = _MEMO[bytes] = hr_bytes(bytes)
+    return text
+
+def hr_rate(bytes):
+    return hr_bytes(bytes) + u'/s'
+
+def hr_ratio(v):
+    if v == -1: return u'n/a'
+    if v == -2: return u'inf'
+    try:
+        return u'%.2f' % v
+    except TypeError:
+        return u'0.00'
+
+def hr_percent(v):
+    try:
+        if 0 <= v <= 1:
+            return _PERCENT[int(v*100)]
+        return u'%d %%' % (v*100)
+    except TypeError:
+        return u'0 %'
+
+def hr_path(path):
+    try:
+        if RE_HOMEDIR.match(path):
+            path = '~' + RE_HOMEDIR.sub('', path, 1)
+        return path.rstrip('/')
+    except TypeError:
+        return u''
+
+def hr_boolean(v):
+    return unicode(v).lower()
+
+def hr_path_dir(v):
+    return unicode(hr_path(v) + '/')
+
+def hr_path_file(v):
+    return unicode(hr_path(v))
+
+
+# Spec type -> function that returns human-readable unicode
+FORMATTERS = {
+    'ratio':      hr_ratio,
+    'percent':    hr_percent,
+    'boolean':    hr_boolean,
+    'path_dir':   hr_path_dir,
+    'path_file':  hr_path_file,
+    'bytes_size': hr_bytes_cached,
+    'bytes_rate': hr_rate,
+}
+
+def prettify(type, value):
+    """Return human-readable unicode of value according to its spec type."""
+    return FORMATTERS.get(type, unicode)(value)
+
+
+### Column variants
+
+def hr_bytes_column(values, base=1000, suffix=u''):
+    """Return list of hr_bytes() of values with suffix appended.
+
+    Equal values are formatted once; None becomes u'0 B'.
+    """
+    table = _table(base, False)
+    small, sizes, text = table.small, table.sizes, table.text
+    nsmall = len(small)
+    seen = {}
+    result = []
+    append = result.append
+    for bytes in values:
+        pretty = seen.get(bytes)
+        if pretty is None:
+            if bytes is None:
+                pretty = u'0 B' + suffix
+            else:
+                number = int(bytes)
+                if number < 0:
+                    raise ValueError('bytes < 0: %d' % number)
+                if number < nsmall:
+                    pretty = small[number] + suffix
+                else:
+                    pretty = text(number, bisect_right(sizes, number) - 1) + suffix
+            seen[bytes] = pretty
+        append(pretty)
+    return result
+
+# Spec type -> function that formats a list of values
+COLUMN_FORMATTERS = {
+    'bytes_size': hr_bytes_column,
+    'bytes_rate': lambda values: hr_bytes_column(values, suffix=u'/s'),
+}
+
+def format_column(type, values):
+    """Return list of prettify(type, value) of all values."""
+    try:
+        return COLUMN_FORMATTERS[type](values)
+    except KeyError:
+        formatter = FORMATTERS.get(type, unicode)
+        return [formatter(v) for v in values]
@@ -13,6 +13,9 @@
 # http://www.gnu.org/licenses/gpl-3.0.txt                              #
 ########################################################################
 
+# Keys of TransmissionURL that make up the actual URL
+URL_KEYS = ('host', 'port', 'path', 'ssl', 'username', 'password')
+
 class TransmissionURL(dict):
 
     """Parse Transmission daemon URL.
@@ -22,12 +25,19 @@ class TransmissionURL(dict):
     port, path, username, password and ssl.  If parts are missing, their
     defaults will be filled in.  If argument is None, the default URL will be
     used.
+
+    The following keys configure the connection to the daemon (see
+    transport.HTTPTransport): max_connections, keepalive, connect_timeout,
+    read_timeout, retries and socket.
     """
 
     def __init__(self, url_str=None, **url_dict):
         super(TransmissionURL, self)
         defaults = { 'host':'localhost', 'port':9091, 'path':'/transmission/rpc',
-                     'ssl':False, 'username':'', 'password':'' }
+                     'ssl':False, 'username':'', 'password':'',
+                     'max_connections':4, 'keepalive':True,
+                     'connect_timeout':10, 'read_timeout':60, 'retries':0,
+                     'socket':None }
         self.update(defaults)
         if url_str is not None:
             self.update(url_str)
@@ -62,12 +72,19 @@ class TransmissionURL(dict):
         else:
             self['host'] = urltxt
 
+    def url_parts(self):
+        """Return dict of only the URL_KEYS."""
+        return dict((key, self[key]) for key in URL_KEYS)
+
     def __str__(self):
         auth = ''
         if self['username'] and self['password']:
             auth = '%s:%s@' % (self['username'], '***')
         elif self['username']:
             auth = '%s@' % self['username']
+        if self['socket']:
+            return 'http+unix://%s%s%s' % (auth, self['socket'].replace('/', '%2F'),
+                                          self['path'])
         string = 'http%s://%s%s:%s%s' % (('','s')[self['ssl']], auth,
                                          self['host'], self['port'],
                                          self['path'])
@@ -0,0 +1,247 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Short-term history of numeric torrent and session values.
+
+Only changes are recorded; a value is assumed to stay the same until the
+next sample.  Every series is a fixed-size ring buffer of two arrays, so
+memory doesn't grow with time.
+
+Classes:
+    Series:
+        >>> s = Series(size=3)
+        >>> s.append(0, 10); s.append(5, 20); s.append(10, 0); s.append(15, 5)
+        >>> s.samples()
+        [(5.0, 20.0), (10.0, 0.0), (15.0, 5.0)]
+        >>> s.downsample(0, 20, buckets=2)   # (start, min, max, avg)
+        [(0.0, 20.0, 20.0, 20.0), (10.0, 0.0, 5.0, 2.5)]
+
+    TorrentHistory:
+        >>> history = TorrentHistory(horizon=3600)  # Keep an hour
+        >>> history.attach(poller)  # Record changes found by poller
+        >>> history.query(1, 'rateDownload', since=time.time()-3600, buckets=60)
+        [(1350000000.0, 0.0, 52000.0, 23412.5), ...]
+"""
+
+import math
+import time
+from array import array
+
+# Fields recorded by TorrentHistory by default
+HISTORY_FIELDS = ('rateDownload', 'rateUpload', 'uploadedEver', 'percentDone')
+SESSION_FIELDS = ('download-dir-free-space',)
+
+
+class Series(object):
+
+    """Ring buffer of (time, value) samples of one value."""
+
+    __slots__ = ('times', 'values', 'size', 'count', 'end')
+
+    def __init__(self, size=720):
+        self.times = array('d', [0]) * size
+        self.values = array('d', [0]) * size
+        self.size = size
+        self.count = 0  # Number of valid samples
+        self.end = 0    # Index of the next sample
+
+    def append(self, t, value):
+        """Add a sample; t must not be older than the last one."""
+        self.times[self.end] = t
+        self.values[self.end] = value
+        self.end = (self.end + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def last(self):
+        """Return latest (time, value) or None."""
+        if not self.count:
+            return None
+        i = (self.end - 1) % self.size
+        return (self.times[i], self.values[i])
+
+    def _ordered(self, data):
+        start = (self.end - self.count) % self.size
+        if start + self.count <= self.size:
+            return data[start:start+self.count]
+        return data[start:] + data[:self.end]
+
+    def samples(self, since=None, until=None):
+        """Return list of (time, value) between since and until, oldest first."""
+        return [(t, v) for t,v in zip(self._ordered(self.times), self._ordered(self.values))
+                if (since is None or t >= since) and (until is None or t <= until)]
+
+    def value_at(self, t):
+        """Return value at time t or None if t is before the oldest sample."""
+        value = None
+        for st,v in zip(self._ordered(self.times), self._ordered(self.values)):
+            if st > t:
+                break
+            value = v
+        return value
+
+    def downsample(self, since, until, buckets):
+        """Split since..until into buckets and summarize each.
+
+        Return list of (bucket start, min, max, time-weighted average) per
+        bucket.  min, max and average are None for buckets before the
+        oldest sample.
+        """
+        times = self._ordered(self.times)
+        values = self._ordered(self.values)
+        width = (until - since) / float(buckets)
+        result = []
+        i = 0
+        n = len(times)
+        current = None  # Value at the start of the bucket
+        for b in range(buckets):
+            start = since + b * width
+            end = start + width
+            while i < n and times[i] <= start:
+                current = values[i]
+                i += 1
+            lo = hi = current
+            area = 0.0
+            covered = 0.0
+            t = start
+            while True:
+                if i < n and times[i] < end:
+                    next_t, next_v = times[i], values[i]
+                    i += 1
+                else:
+                    next_t, next_v = end, None
+                if current is not None:
+                    area += current * (next_t - t)
+                    covered += next_t - t
+                if next_v is None:
+                    break
+                current = next_v
+                t = next_t
+                lo = current if lo is None else min(lo, current)
+                hi = current if hi is None else max(hi, current)
+            result.append((start, lo, hi, area / covered if covered else lo))
+        return result
+
+
+class TorrentHistory(object):
+
+    """Series of numeric fields of all torrents and of the session.
+
+    Series are created on the first change of a value and dropped when the
+    torrent is removed.
+    """
+
+    def __init__(self, fields=HISTORY_FIELDS, session_fields=SESSION_FIELDS, size=720,
+                 horizon=None):
+        """Create an empty history.
+
+        size is the number of changes kept per series.  A value that
+        changes at every poll (like the rate of a busy torrent) is covered
+        for size times the poll interval: 720 changes are 12 minutes at 1
+        second.  Alternatively, horizon is the number of seconds to cover;
+        attach() then sizes each field's series from its poll interval.
+        Every sample needs 16 bytes.
+        """
+        self.fields = tuple(fields)
+        self.session_fields = tuple(session_fields)
+        self.size = size
+        self.horizon = horizon
+        self.sizes = {}   # field -> size of its series if not size
+        self.series = {}  # (torrent ID or None for session, field) -> Series
+        self._poller = None
+
+    def attach(self, poller):
+        """Record changes seen by a TransmissionPoller.
+
+        Fields the poller doesn't poll yet are polled at its fastest
+        interval.
+        """
+        self._poller = poller
+        fastest = min(i for i in poller.intervals.values() if i)
+        for field in self.fields:
+            if not poller.intervals.get(field):
+                poller.intervals[field] = fastest
+        if self.horizon is not None:
+            intervals = dict((field, poller.intervals[field]) for field in self.fields)
+            for field in self.session_fields:
+                intervals[field] = poller.session_interval or fastest
+            for field,interval in intervals.items():
+                self.sizes[field] = int(math.ceil(self.horizon / float(interval))) + 1
+        poller.subscribe('added', self._added)
+        poller.subscribe('changed', self._changed)
+        poller.subscribe('removed', self.forget)
+        poller.subscribe('session-changed', self._session_changed)
+
+    def detach(self):
+        poller, self._poller = self._poller, None
+        poller.unsubscribe('added', self._added)
+        poller.unsubscribe('changed', self._changed)
+        poller.unsubscribe('removed', self.forget)
+        poller.unsubscribe('session-changed', self._session_changed)
+
+    def _now(self):
+        if self._poller is not None and self._poller.now is not None:
+            return self._poller.now
+        return time.time()
+
+    def record(self, id, field, value, t=None):
+        """Add a sample; id is None for session values."""
+        if value is None:
+            return
+        try:
+            series = self.series[(id, field)]
+        except KeyError:
+            series = self.series[(id, field)] = Series(self.sizes.get(field, self.size))
+        series.append(self._now() if t is None else t, value)
+
+    def _added(self, torrent):
+        id = torrent.value('id')
+        for field in self.fields:
+            self.record(id, field, torrent.value(field))
+
+    def _changed(self, torrent, changes):
+        id = torrent.value('id')
+        for field in self.fields:
+            if field in changes:
+                self.record(id, field, torrent.value(field))
+
+    def _session_changed(self, session, changes):
+        for field in self.session_fields:
+            if field in changes:
+                self.record(None, field, session.value(field))
+
+    def forget(self, id):
+        """Drop all series of a torrent."""
+        for field in self.fields:
+            self.series.pop((id, field), None)
+
+    def get(self, id, field):
+        """Return Series of a torrent field (id None: session) or None."""
+        return self.series.get((id, field))
+
+    def query(self, id, field, since, until=None, buckets=60):
+        """Return downsampled history of a field, see Series.downsample().
+
+        Return an empty list if nothing was recorded.
+        """
+        series = self.series.get((id, field))
+        if series is None:
+            return []
+        if until is None:
+            until = self._now()
+        return series.downsample(since, until, buckets)
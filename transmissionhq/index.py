@@ -0,0 +1,125 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Secondary indexes over cached torrents.
+
+Classes:
+    TorrentIndex:
+        >>> index = TorrentIndex()
+        >>> index.reindex(1, torrent)  # After every update of torrent 1
+        >>> index.find(status='seeding', downloadDir=['/srv/a', '/srv/b'])
+        set([1, 7, 12])
+"""
+
+# Fields that are indexed by default; values of list fields (e.g. labels)
+# are indexed individually.
+INDEXED_FIELDS = ('hashString', 'status', 'downloadDir', 'error', 'labels')
+
+
+class TorrentIndex(object):
+
+    """Map values of some torrent fields to sets of torrent IDs."""
+
+    def __init__(self, fields=INDEXED_FIELDS):
+        self.fields = tuple(fields)
+        self._index = dict((field, {}) for field in self.fields)
+        self._entries = {}  # id -> {field: indexed values}
+
+    def reindex(self, id, torrent, keys=None):
+        """Update index entries of torrent.
+
+        torrent must provide value(key, default).  If keys is given, only
+        those fields are looked at, e.g. the keys of a partial update.
+        """
+        entries = self._entries.setdefault(id, {})
+        for field in self.fields:
+            if keys is not None and field not in keys:
+                continue
+            values = torrent.value(field)
+            if values is None:
+                continue
+            if type(values) is list:
+                values = frozenset(values)
+            else:
+                values = frozenset([values])
+            old = entries.get(field, frozenset())
+            if old == values:
+                continue
+            index = self._index[field]
+            for value in old - values:
+                ids = index[value]
+                ids.discard(id)
+                if not ids:
+                    del index[value]
+            for value in values - old:
+                index.setdefault(value, set()).add(id)
+            entries[field] = values
+
+    def remove(self, id):
+        """Remove torrent from all indexes."""
+        for field,values in self._entries.pop(id, {}).items():
+            index = self._index[field]
+            for value in values:
+                ids = index[value]
+                ids.discard(id)
+                if not ids:
+                    del index[value]
+
+    def dump(self):
+        """Return the index as plain values, e.g. for snapshots."""
+        return {'fields':self.fields, 'index':self._index, 'entries':self._entries}
+
+    def restore(self, state):
+        """Replace the index with the return value of dump().
+
+        Return False (and leave the index alone) if state covers other fields.
+        """
+        if tuple(state['fields']) != self.fields:
+            return False
+        self._index = state['index']
+        self._entries = state['entries']
+        return True
+
+    def values(self, field):
+        """Return all distinct values of an indexed field."""
+        return self._index[field].keys()
+
+    def lookup(self, field, value):
+        """Return set of IDs of torrents whose field matches value."""
+        return self._index[field].get(value, set())
+
+    def find(self, **criteria):
+        """Return set of IDs of torrents that match all criteria.
+
+        Each keyword is an indexed field.  Its value is either a single value
+        or a list/tuple/set of values, any of which must match.
+        """
+        candidates = []
+        for field,wanted in criteria.items():
+            if field not in self._index:
+                raise ValueError('Field is not indexed: %s' % field)
+            if isinstance(wanted, (list, tuple, set, frozenset)):
+                ids = set()
+                for value in wanted:
+                    ids.update(self.lookup(field, value))
+            else:
+                ids = self.lookup(field, wanted)
+            if not ids:
+                return set()
+            candidates.append(ids)
+        if not candidates:
+            return set(self._entries)
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:])
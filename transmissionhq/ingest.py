@@ -0,0 +1,130 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Add large numbers of torrents with many requests in flight.
+
+Local .torrent files are sent base64-encoded as 'metainfo', so the daemon
+doesn't need access to our filesystem.  Magnet links and URLs are passed
+as 'filename'.
+
+Functions:
+    add_torrents:
+        >>> from transmissionhq.ingest import add_torrents
+        >>> for item, status, result in add_torrents(['/srv/new', 'magnet:?xt=...'],
+        ...                                          url='seedbox:9091'):
+        ...     print status, item, result
+        added /srv/new/a.torrent 17
+        duplicate /srv/new/b.torrent 3
+        error magnet:?xt=... Could not add torrent magnet:?xt=...: invalid or corrupt torrent file
+"""
+
+import os
+import base64
+from collections import deque
+from asyncclient import AsyncTransmissionClient
+from client import (ConnectionError, TransmissionError)
+from transport import poll
+
+ADDED = 'added'
+DUPLICATE = 'duplicate'
+ERROR = 'error'
+
+
+def is_link(item):
+    """Return True if item is a magnet link or URL rather than a path."""
+    return item.startswith('magnet:') or '://' in item
+
+def iter_torrent_sources(items):
+    """Yield magnet links, URLs and paths of .torrent files from items.
+
+    Directories are searched recursively for files ending with '.torrent'.
+    """
+    for item in items:
+        if not is_link(item) and os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.endswith('.torrent'):
+                        yield os.path.join(dirpath, name)
+        else:
+            yield item
+
+def torrent_add_args(item):
+    """Return 'torrent-add' arguments for a link or .torrent file."""
+    if is_link(item):
+        return { 'filename':item }
+    with open(item, 'rb') as f:
+        return { 'metainfo':base64.b64encode(f.read()) }
+
+
+def add_torrents_async(client, items, inflight=16):
+    """Add torrents via an AsyncTransmissionClient.
+
+    Keep up to inflight 'torrent-add' requests running and yield an
+    (item, status, result) tuple for each torrent as soon as its response
+    arrives.  status is one of ADDED and DUPLICATE (result is the torrent's
+    ID) or ERROR (result is the exception).
+    """
+    sources = iter_torrent_sources(items)
+    finished = deque()
+    active = [0]
+
+    def done(item, future):
+        # Runs inside the event loop; every item must get exactly one result
+        active[0] -= 1
+        try:
+            response = future.result()
+            if not isinstance(response, dict):
+                response = {}  # No arguments
+            if 'torrent-duplicate' in response:
+                finished.append((item, DUPLICATE, response['torrent-duplicate']['id']))
+            elif 'torrent-added' in response:
+                finished.append((item, ADDED, response['torrent-added']['id']))
+            else:
+                raise TransmissionError('Could not add torrent %s: unexpected '
+                                        'response %r' % (item, response))
+        except Exception as err:
+            finished.append((item, ERROR, err))
+
+    exhausted = False
+    while True:
+        while not exhausted and active[0] < inflight:
+            try:
+                item = next(sources)
+            except StopIteration:
+                exhausted = True
+                break
+            try:
+                args = torrent_add_args(item)
+            except (IOError, OSError) as err:
+                finished.append((item, ERROR, err))
+                continue
+            active[0] += 1
+            client._request('torrent-add', **args).add_done_callback(
+                lambda future, item=item: done(item, future))
+        while finished:
+            yield finished.popleft()
+        if exhausted and not active[0]:
+            return
+        poll(map=client._pool.map)
+
+def add_torrents(items, url=None, inflight=16, timeout=60):
+    """Add torrents from paths, directories, magnet links and URLs.
+
+    See add_torrents_async() for return value.  url is anything
+    TransmissionClient accepts.
+    """
+    client = AsyncTransmissionClient(url, max_connections=inflight, timeout=timeout)
+    return add_torrents_async(client, items, inflight)
@@ -0,0 +1,391 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Measure the RPCs a TransmissionClient sends.
+
+Instruments are attached with TransmissionClient.add_instrument().  Their
+before() and after() methods are called with an RPCCall around every
+request that goes through TransmissionClient._request().
+
+Classes:
+    Instrument: Base class with hooks that do nothing.
+    RPCCall: Method, daemon, latency, bytes, retries and error of one RPC.
+    Histogram: Bucketed observations since creation and of recent minutes.
+    RPCMetrics:
+        >>> metrics = RPCMetrics(window=300)
+        >>> client.add_instrument(metrics)
+        >>> client.torrents(keys=['id', 'name'])
+        >>> metrics.summary()  # Most time consuming first
+        [{'daemon': 'http://localhost:9091/transmission/rpc',
+          'method': 'torrent-get', 'requests': 1, 'errors': 0, 'retries': 0,
+          'seconds': 0.041, 'p50': 0.0375, 'p95': 0.04875, 'p99': 0.04975,
+          'bytes_sent': 71, 'bytes_received': 48211}]
+
+    Exporter:
+        >>> Exporter(metrics, path='/var/lib/node_exporter/transmission.prom').start(15)
+        >>> Exporter(metrics, format='statsd', address=('localhost', 8125)).start(10)
+"""
+
+import os
+import re
+import time
+import socket
+import threading
+from bisect import bisect_left
+
+# Upper bounds of histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Instrument(object):
+
+    """Base class of client instruments.
+
+    before() is called before a request is sent, after() when it returned
+    or failed.  Exceptions raised by either are not caught.
+    """
+
+    def before(self, call):
+        pass
+
+    def after(self, call):
+        pass
+
+
+class RPCCall(object):
+
+    """One RPC as seen by instruments.
+
+    daemon is the str() of the client's TransmissionURL.  duration,
+    bytes_sent, bytes_received and retries are set before after() is
+    called; error is the exception that was raised or None.  Bytes and
+    retries are read from the transport's stats and include concurrent
+    requests of other threads on the same client.
+    """
+
+    __slots__ = ('daemon', 'method', 'arguments', 'start', 'duration',
+                 'bytes_sent', 'bytes_received', 'retries', 'error')
+
+    def __init__(self, daemon, method, arguments):
+        self.daemon = daemon
+        self.method = method
+        self.arguments = arguments
+        self.start = None
+        self.duration = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<RPCCall %s %s %.3fs>' % (self.daemon, self.method, self.duration or 0)
+
+
+class Histogram(object):
+
+    """Count observations in buckets with upper bounds.
+
+    Totals since creation are kept for exporters; a ring of slots of
+    resolution seconds each covers the last window seconds for quantiles.
+    """
+
+    def __init__(self, bounds, window=300, resolution=10):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0
+        self.resolution = resolution
+        self._ring = [None] * max(1, int(window // resolution))  # [slot, buckets, sum]
+
+    def observe(self, value, now=None):
+        if now is None:
+            now = time.time()
+        i = bisect_left(self.bounds, value)
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+        slot = int(now // self.resolution)
+        entry = self._ring[slot % len(self._ring)]
+        if entry is None or entry[0] != slot:
+            entry = self._ring[slot % len(self._ring)] = [slot, [0] * len(self.buckets), 0]
+        entry[1][i] += 1
+        entry[2] += value
+
+    def recent(self, now=None):
+        """Return (buckets, count, sum) of the last window seconds."""
+        if now is None:
+            now = time.time()
+        slot = int(now // self.resolution)
+        oldest = slot - len(self._ring) + 1
+        buckets = [0] * len(self.buckets)
+        total = 0
+        for entry in self._ring:
+            if entry is not None and oldest <= entry[0] <= slot:
+                for i,n in enumerate(entry[1]):
+                    buckets[i] += n
+                total += entry[2]
+        return buckets, sum(buckets), total
+
+    def quantile(self, q, now=None):
+        """Estimate the q-quantile (0 <= q <= 1) of the last window seconds.
+
+        Values are interpolated within their bucket like Prometheus'
+        histogram_quantile() does.  Return None without observations.
+        """
+        buckets, count, total = self.recent(now)
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for i,n in enumerate(buckets):
+            if n and cumulative + n >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i-1] if i else 0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / float(n)
+            cumulative += n
+
+
+class _MethodStats(object):
+
+    """Histograms and counters of one method of one daemon."""
+
+    def __init__(self, window, resolution):
+        self.latency = Histogram(LATENCY_BUCKETS, window, resolution)
+        self.sent = Histogram(SIZE_BUCKETS, window, resolution)
+        self.received = Histogram(SIZE_BUCKETS, window, resolution)
+        self.errors = 0
+        self.retries = 0
+
+    def observe(self, call, now):
+        self.latency.observe(call.duration, now)
+        self.sent.observe(call.bytes_sent, now)
+        self.received.observe(call.bytes_received, now)
+        self.retries += call.retries
+        if call.error is not None:
+            self.errors += 1
+
+
+class RPCMetrics(Instrument):
+
+    """Rolling histograms of latency and request and response sizes per
+    daemon and method, plus error and retry counters.
+
+    One instance can be attached to any number of clients.
+    """
+
+    def __init__(self, window=300, resolution=10):
+        self.window = window
+        self.resolution = resolution
+        self.series = {}  # (daemon, method) -> _MethodStats
+        self._lock = threading.Lock()
+
+    def after(self, call):
+        key = (call.daemon, call.method)
+        with self._lock:
+            stats = self.series.get(key)
+            if stats is None:
+                stats = self.series[key] = _MethodStats(self.window, self.resolution)
+            stats.observe(call, call.start + call.duration)
+
+    def summary(self, now=None):
+        """Return a list of dicts, one per daemon and method, of the last
+        window seconds; the method that took the most time comes first.
+
+        Keys are daemon, method, requests, seconds, bytes_sent,
+        bytes_received, p50, p95 and p99 (latency in seconds) as well as
+        errors and retries (since creation).
+        """
+        if now is None:
+            now = time.time()
+        result = []
+        with self._lock:
+            for (daemon, method),stats in self.series.items():
+                buckets, requests, seconds = stats.latency.recent(now)
+                if not requests:
+                    continue
+                entry = {'daemon':daemon, 'method':method, 'requests':requests,
+                         'seconds':seconds, 'errors':stats.errors,
+                         'retries':stats.retries,
+                         'bytes_sent':stats.sent.recent(now)[2],
+                         'bytes_received':stats.received.recent(now)[2]}
+                for q in QUANTILES:
+                    entry['p%g' % (q * 100)] = stats.latency.quantile(q, now)
+                result.append(entry)
+        result.sort(key=lambda entry: entry['seconds'], reverse=True)
+        return result
+
+    def prometheus(self, prefix='transmissionhq_rpc'):
+        """Return all metrics in Prometheus' text exposition format."""
+        lines = []
+        def histogram(name, help, attr):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for labels,stats in series:
+                h = getattr(stats, attr)
+                cumulative = 0
+                for bound,n in zip(h.bounds + ('+Inf',), h.buckets):
+                    cumulative += n
+                    lines.append('%s_%s_bucket{%s,le="%s"} %d'
+                                 % (prefix, name, labels, bound, cumulative))
+                lines.append('%s_%s_sum{%s} %s' % (prefix, name, labels, h.sum))
+                lines.append('%s_%s_count{%s} %d' % (prefix, name, labels, h.count))
+        def counter(name, help, attr):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for labels,stats in series:
+                lines.append('%s_%s{%s} %d' % (prefix, name, labels, getattr(stats, attr)))
+
+        with self._lock:
+            series = [('daemon="%s",method="%s"' % (_escape(daemon), _escape(method)), stats)
+                      for (daemon, method),stats in sorted(self.series.items())]
+            histogram('duration_seconds', 'Time until the response was read.', 'latency')
+            histogram('request_bytes', 'Size of requests.', 'sent')
+            histogram('response_bytes', 'Size of responses.', 'received')
+            counter('errors_total', 'Failed requests.', 'errors')
+            counter('retries_total', 'Repeated requests.', 'retries')
+        return '\n'.join(lines) + '\n'
+
+    def statsd(self, prefix='transmissionhq.rpc', previous=None):
+        """Return list of statsd lines.
+
+        Counters are the increase since previous, a dict that is updated
+        with current totals.  Latency quantiles of the last window seconds
+        are gauges in milliseconds.
+        """
+        if previous is None:
+            previous = {}
+        now = time.time()
+        lines = []
+        with self._lock:
+            for (daemon, method),stats in sorted(self.series.items()):
+                name = '%s.%s.%s' % (prefix, _metric_name(daemon), _metric_name(method))
+                totals = (('requests', stats.latency.count), ('errors', stats.errors),
+                          ('retries', stats.retries), ('bytes_sent', stats.sent.sum),
+                          ('bytes_received', stats.received.sum))
+                for counter,total in totals:
+                    key = (daemon, method, counter)
+                    delta = total - previous.get(key, 0)
+                    previous[key] = total
+                    if delta:
+                        lines.append('%s.%s:%d|c' % (name, counter, delta))
+                for q in QUANTILES:
+                    value = stats.latency.quantile(q, now)
+                    if value is not None:
+                        lines.append('%s.latency_p%g:%.3f|g' % (name, q * 100, value * 1000))
+        return lines
+
+
+def _escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _metric_name(text):
+    return re.sub(r'[^A-Za-z0-9-]+', '_', re.sub(r'^[a-z+]+://', '', text)).strip('_')
+
+
+class Exporter(object):
+
+    """Write RPCMetrics to a file or socket in Prometheus or statsd format.
+
+    Exactly one of path and address must be given:
+        path: Prometheus text is written atomically (e.g. for
+              node_exporter's textfile collector); statsd lines are
+              appended.
+        address: A (host, port) tuple or the path of a Unix domain socket.
+                 Prometheus text is sent over a stream connection, statsd
+                 lines as datagrams.
+    """
+
+    FORMATS = ('prometheus', 'statsd')
+
+    def __init__(self, metrics, format='prometheus', path=None, address=None, prefix=None):
+        if format not in self.FORMATS:
+            raise ValueError('Unknown metrics format: %s' % format)
+        if (path is None) == (address is None):
+            raise ValueError('Either path or address is needed')
+        self.metrics = metrics
+        self.format = format
+        self.path = path
+        self.address = address
+        self.prefix = prefix
+        self._previous = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def render(self):
+        """Return the text that export() writes."""
+        if self.format == 'prometheus':
+            return self.metrics.prometheus(*filter(None, [self.prefix]))
+        lines = self.metrics.statsd(self.prefix or 'transmissionhq.rpc', self._previous)
+        return ''.join(line + '\n' for line in lines)
+
+    def export(self):
+        text = self.render()
+        if self.path is not None:
+            if self.format == 'prometheus':
+                tmp = '%s.%d.tmp' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    f.write(text)
+                os.rename(tmp, self.path)
+            elif text:
+                with open(self.path, 'a') as f:
+                    f.write(text)
+            return
+        family = socket.AF_UNIX if isinstance(self.address, basestring) else socket.AF_INET
+        if self.format == 'prometheus':
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+                sock.sendall(text)
+            finally:
+                sock.close()
+        elif text:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            try:
+                # Keep datagrams below common MTUs
+                packet = ''
+                for line in text.splitlines(True):
+                    if packet and len(packet) + len(line) > 1400:
+                        sock.sendto(packet, self.address)
+                        packet = ''
+                    packet += line
+                sock.sendto(packet, self.address)
+            finally:
+                sock.close()
+
+    def start(self, interval=15):
+        """Export every interval seconds in a daemon thread; return self."""
+        self._stop.clear()
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.export()
+                except (IOError, OSError, socket.error):
+                    pass  # Try again next time
+        self._thread = threading.Thread(target=run, name='MetricsExporter')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop exporting and write the metrics one last time."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.export()
@@ -0,0 +1,197 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Decoded 'pieces' bitfields.
+
+The daemon sends the pieces we have as a base64 encoded bitfield; the
+first piece is the most significant bit of the first byte.  All counting
+and comparing is done on one big integer, so it happens in C and not in a
+Python loop over bits.
+
+Classes:
+    PieceMap:
+        >>> pieces = PieceMap.from_base64('/+A=', count=12)
+        >>> len(pieces), pieces.have(), pieces[8], pieces[11]
+        (12, 11, True, False)
+        >>> pieces.runs()
+        [(True, 0, 11), (False, 11, 1)]
+        >>> pieces.heatmap(3)
+        [1.0, 1.0, 0.75]
+        >>> gained, lost = pieces.diff(PieceMap.from_base64('/wA=', count=12))
+        >>> gained.have(), lost.have()
+        (3, 0)
+
+Functions:
+    torrent_pieces:
+        >>> torrent_pieces(client.torrents(ids=[1], keys=['pieces', 'pieceCount'])[0])
+        PieceMap.from_base64('/+A=', count=12)
+"""
+
+import re
+import base64
+import binascii
+
+RE_RUN = re.compile(r'1+|0+')
+
+
+class PieceMap(object):
+
+    """Immutable bitfield of pieces we have."""
+
+    __slots__ = ('_bits', 'count', '_int')
+
+    def __init__(self, bits='', count=None):
+        """bits is a byte string; count is the number of pieces (all bits
+        of bits by default).
+        """
+        self._bits = bytes(bits)
+        if count is None:
+            count = len(self._bits) * 8
+        self.count = count
+        self._int = None  # Bitfield as integer, computed on first access
+
+    @classmethod
+    def from_base64(cls, data, count=None):
+        """Decode the 'pieces' value of a 'torrent-get' response."""
+        return cls(base64.b64decode(data), count)
+
+    @classmethod
+    def from_int(cls, value, count):
+        nbytes = (count + 7) // 8
+        value <<= nbytes * 8 - count
+        bits = binascii.unhexlify('%0*x' % (nbytes * 2, value)) if nbytes else ''
+        return cls(bits, count)
+
+    def resize(self, count):
+        """Return a PieceMap on the same bits with a piece count of count."""
+        return PieceMap(self._bits, count)
+
+    @property
+    def bits(self):
+        """The bitfield as a byte string."""
+        return self._bits
+
+    def as_int(self):
+        """Return the bitfield as integer; bit count-1 is the first piece."""
+        if self._int is None:
+            if not self.count:
+                self._int = 0
+            else:
+                nbytes = (self.count + 7) // 8
+                value = int(binascii.hexlify(self._bits[:nbytes].ljust(nbytes, '\0')), 16)
+                self._int = value >> (nbytes * 8 - self.count)
+        return self._int
+
+    def to_base64(self):
+        return base64.b64encode(self._bits)
+
+    def have(self, start=0, stop=None):
+        """Return number of pieces we have between start and stop."""
+        start, stop, step = slice(start, stop).indices(self.count)
+        if start >= stop:
+            return 0
+        value = self.as_int() >> (self.count - stop)
+        value &= (1 << (stop - start)) - 1
+        return bin(value).count('1')
+
+    def missing(self, start=0, stop=None):
+        """Return number of pieces we don't have between start and stop."""
+        start, stop, step = slice(start, stop).indices(self.count)
+        return max(0, stop - start) - self.have(start, stop)
+
+    def percent(self):
+        """Return fraction of pieces we have (0.0 - 1.0)."""
+        if not self.count:
+            return 0.0
+        return self.have() / float(self.count)
+
+    def bitstring(self):
+        """Return pieces as a string of '1' and '0'."""
+        if not self.count:
+            return ''
+        return format(self.as_int(), '0%db' % self.count)
+
+    def runs(self):
+        """Return run-length summary as list of (have, start, length)."""
+        return [(match.group()[0] == '1', match.start(), match.end() - match.start())
+                for match in RE_RUN.finditer(self.bitstring())]
+
+    def heatmap(self, buckets):
+        """Split pieces into buckets and return the fraction we have of each."""
+        buckets = max(1, min(buckets, self.count))
+        fractions = []
+        for i in range(buckets):
+            start = i * self.count // buckets
+            stop = (i + 1) * self.count // buckets
+            fractions.append(self.have(start, stop) / float(stop - start) if stop > start else 0.0)
+        return fractions
+
+    def diff(self, old):
+        """Compare with an older snapshot; return (gained, lost) PieceMaps."""
+        if old.count != self.count:
+            old = old.resize(self.count)
+        new_int, old_int = self.as_int(), old.as_int()
+        return (PieceMap.from_int(new_int & ~old_int, self.count),
+                PieceMap.from_int(old_int & ~new_int, self.count))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('piece index out of range')
+        return bool(ord(self._bits[index // 8]) & (0x80 >> (index % 8)))
+
+    def __iter__(self):
+        return (bit == '1' for bit in self.bitstring())
+
+    def __eq__(self, other):
+        if not isinstance(other, PieceMap):
+            return NotImplemented
+        return self.count == other.count and self.as_int() == other.as_int()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.count, self.as_int()))
+
+    def __unicode__(self):
+        return u'%d/%d pieces' % (self.have(), self.count)
+
+    def __str__(self):
+        return unicode(self).encode('ascii')
+
+    def __repr__(self):
+        return 'PieceMap.from_base64(%r, count=%d)' % (self.to_base64(), self.count)
+
+
+def torrent_pieces(torrent):
+    """Return PieceMap of a cached torrent with its real piece count.
+
+    The bitfield alone is padded to whole bytes; if the torrent also has a
+    'pieceCount' value, the padding is cut off.  Return None if the torrent
+    has no 'pieces' value.
+    """
+    pieces = torrent.value('pieces')
+    if pieces is None:
+        return None
+    count = torrent.value('pieceCount')
+    if count is None or count == pieces.count:
+        return pieces
+    return pieces.resize(count)
@@ -0,0 +1,306 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Refresh a client's cache in the background and report what changed.
+
+One poller serves any number of subscribers, so the daemon is polled only
+once per interval no matter how many parts of a program are interested.
+
+Classes:
+    TransmissionPoller:
+        >>> from transmissionhq.poller import TransmissionPoller
+        >>> poller = TransmissionPoller(client, intervals={'peers':5})
+        >>> def finished(torrent):
+        ...     print torrent['name'], 'is done'
+        >>> poller.subscribe('finished', finished)
+        >>> poller.start()
+        Some torrent is done
+        >>> poller.fetch(['files'])  # Once, with the next poll
+        >>> poller.stop()
+
+    RPCBudget:
+        >>> # Back off while nothing happens, never exceed 2 requests/s
+        >>> poller = TransmissionPoller(client, adaptive=True,
+        ...                             budget=RPCBudget(requests=2, bytes=512*1024))
+"""
+
+import time
+import threading
+from client import (ConnectionError, TransmissionError)
+
+# Seconds between refreshes of torrent fields; None means on demand only
+# (see TransmissionPoller.fetch()).  Fields that aren't listed are not polled.
+DEFAULT_INTERVALS = {
+    'id': 1, 'name': 60, 'hashString': 60, 'status': 1, 'error': 1,
+    'errorString': 1, 'percentDone': 1, 'eta': 1, 'recheckProgress': 1,
+    'rateDownload': 1, 'rateUpload': 1, 'uploadRatio': 5,
+    'totalSize': 60, 'leftUntilDone': 1, 'downloadDir': 60,
+    'peersConnected': 5, 'trackerStats': 60,
+    'files': None, 'fileStats': None, 'peers': None,
+}
+
+# Changes of these fields (or added/removed torrents) reset the backoff of an
+# adaptive poller
+ACTIVITY_FIELDS = ('rateDownload', 'rateUpload', 'status', 'recheckProgress')
+
+# Event names and the arguments subscribers are called with
+EVENTS = {
+    'added': 'torrent',
+    'removed': 'id',
+    'changed': 'torrent, changes',
+    'status-changed': 'torrent, old_status',
+    'finished': 'torrent',
+    'error': 'torrent',
+    'session-changed': 'session, changes',
+    'polled': 'poller, fields',
+    'poll-failed': 'poller, exception',
+}
+
+
+class RPCBudget(object):
+
+    """Limit the requests and bytes per second spent on one daemon."""
+
+    def __init__(self, requests=None, bytes=None):
+        """requests and bytes are rates per second; None means unlimited."""
+        self.requests = requests
+        self.bytes = bytes
+        self.ready_at = 0  # Time when the next poll may start
+
+    def charge(self, requests, bytes, now=None):
+        """Account for traffic of a poll that ended at now."""
+        if now is None:
+            now = time.time()
+        delay = 0
+        if self.requests:
+            delay = max(delay, requests / float(self.requests))
+        if self.bytes:
+            delay = max(delay, bytes / float(self.bytes))
+        self.ready_at = max(self.ready_at, now) + delay
+
+    def ready(self, now=None):
+        return (time.time() if now is None else now) >= self.ready_at
+
+
+class TransmissionPoller(object):
+
+    """Poll a TransmissionClient on per-field intervals and emit events.
+
+    Subscribers are called in the polling thread (or in the thread that
+    calls poll()).  'changes' arguments map changed keys to their previous
+    values, see TransmissionRPC.update().
+    """
+
+    def __init__(self, client, intervals=None, session_interval=10,
+                 adaptive=False, max_interval=60, budget=None):
+        """Create a poller for client.
+
+        intervals updates DEFAULT_INTERVALS; set a field to None to fetch it
+        only on demand, or remove it with False.  session_interval is the
+        number of seconds between 'session-get' requests, None to never
+        fetch session settings.
+
+        If adaptive is True, intervals are doubled (up to max_interval) after
+        every poll in which none of the ACTIVITY_FIELDS changed, and reset as
+        soon as one does.  budget is an RPCBudget; polls are delayed so that
+        the client's traffic stays within it.
+        """
+        self.client = client
+        self.intervals = dict(DEFAULT_INTERVALS)
+        for field,interval in (intervals or {}).items():
+            if interval is False:
+                self.intervals.pop(field, None)
+            else:
+                self.intervals[field] = interval
+        self.intervals['id'] = min([i for i in self.intervals.values() if i] or [None])
+        self.session_interval = session_interval
+        self.adaptive = adaptive
+        self.max_interval = max_interval
+        self.budget = budget
+        self.backoff = 1        # Factor for all intervals
+        self._active = False    # Whether the current poll saw activity
+        self._due = {}          # field -> time of next refresh
+        self._requested = set() # On demand fields for the next poll
+        self._added = []        # IDs of torrents added during this poll
+        self.now = None         # Time of the current or last poll
+        self._subscribers = dict((event, []) for event in EVENTS)
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()  # Set by fetch() and stop()
+        self._thread = None
+        client.add_observer(self._observe)
+
+    def subscribe(self, event, callback):
+        """Call callback whenever event happens.  See EVENTS."""
+        if event not in EVENTS:
+            raise ValueError('Unknown event: %s' % event)
+        self._subscribers[event].append(callback)
+
+    def unsubscribe(self, event, callback):
+        self._subscribers[event].remove(callback)
+
+    def emit(self, event, *args):
+        for callback in list(self._subscribers[event]):
+            callback(*args)
+
+    def fetch(self, fields):
+        """Request on demand fields (e.g. 'files') with the next poll."""
+        with self._lock:
+            self._requested.update(fields)
+        self._wakeup.set()
+
+    def due(self, now=None):
+        """Return list of fields that need a refresh at time now."""
+        if now is None:
+            now = time.time()
+        fields = set(self._requested)
+        for field,interval in self.intervals.items():
+            if interval and self._due.get(field, 0) <= now:
+                fields.add(field)
+        return sorted(fields)
+
+    def next_poll(self):
+        """Return time of the next scheduled refresh, or None if nothing is
+        scheduled until fields are requested with fetch()."""
+        times = [self._due.get(field, 0) for field,interval in self.intervals.items()
+                 if interval]
+        if self.session_interval:
+            times.append(self._due.get('session', 0))
+        if self._requested:
+            when = time.time()
+        elif times:
+            when = min(times)
+        else:
+            return None
+        if self.budget is not None:
+            when = max(when, self.budget.ready_at)
+        return when
+
+    def interval(self, field):
+        """Return current interval of field in seconds."""
+        if field == 'session':
+            interval = self.session_interval
+        else:
+            interval = self.intervals[field]
+        if self.backoff == 1:
+            return interval
+        return min(interval * self.backoff, max(interval, self.max_interval))
+
+    def poll(self, now=None):
+        """Refresh all fields that are due and emit events.
+
+        Return list of refreshed torrent fields.
+        """
+        if now is None:
+            now = time.time()
+        if self.budget is not None and not self.budget.ready(now):
+            return []
+        with self._lock:
+            self.now = now
+            fields = self.due(now)
+            self._requested.clear()
+            refresh_session = self.session_interval and self._due.get('session', 0) <= now
+            traffic = self._traffic()
+            self._active = False
+            try:
+                if refresh_session:
+                    self.client.session()
+                if fields:
+                    self._added = []
+                    # A complete list of IDs lets the client notice removals
+                    self.client.torrents(keys=fields)
+                    if self._added:
+                        # New torrents should have all polled fields right away
+                        self.client.torrents(ids=self._added,
+                                             keys=[f for f,i in self.intervals.items() if i])
+            except (ConnectionError, TransmissionError) as err:
+                failed = err
+            else:
+                failed = None
+            if self.adaptive and (failed or set(fields).intersection(ACTIVITY_FIELDS)):
+                if self._active and not failed:
+                    self.backoff = 1
+                else:
+                    self.backoff = min(self.backoff * 2, self.max_interval)
+            if self.budget is not None:
+                requests, bytes = self._traffic()
+                self.budget.charge(requests - traffic[0], bytes - traffic[1], now)
+            if refresh_session:
+                self._due['session'] = now + self.interval('session')
+            for field in fields:
+                if self.intervals.get(field):
+                    self._due[field] = now + self.interval(field)
+        if failed:
+            self.emit('poll-failed', self, failed)
+            return []
+        self.emit('polled', self, fields)
+        return fields
+
+    def _traffic(self):
+        """Return (requests, bytes) the client has exchanged so far."""
+        stats = getattr(self.client, 'transport', None)
+        if stats is None:
+            return (0, 0)
+        stats = stats.stats
+        return (stats['requests'], stats['bytes_sent'] + stats['bytes_received'])
+
+    def _observe(self, event, id, item, changes):
+        """Translate client notifications into events."""
+        if event == 'session':
+            self.emit('session-changed', item, changes)
+        elif event == 'removed':
+            self._active = True
+            self.emit('removed', id)
+        elif event == 'added':
+            self._active = True
+            self._added.append(id)
+            self.emit('added', item)
+        else:
+            if not self._active:
+                for field in ACTIVITY_FIELDS:
+                    if field in changes:
+                        self._active = True
+                        break
+            self.emit('changed', item, changes)
+            if 'status' in changes:
+                self.emit('status-changed', item, changes['status'])
+            if changes.get('percentDone') is not None and changes['percentDone'] < 1 \
+                    and item.value('percentDone') == 1:
+                self.emit('finished', item)
+            if 'error' in changes and item.value('error'):
+                self.emit('error', item)
+
+    def start(self):
+        """Poll in a daemon thread until stop() is called."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='TransmissionPoller')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            when = self.next_poll()
+            self._wakeup.wait(None if when is None else max(0, when - time.time()))
+            self._wakeup.clear()
@@ -0,0 +1,534 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Filter, sort and page cached torrents with a small expression language.
+
+A query is parsed once; literals are converted according to the spec type
+of their field, so sizes, rates, percentages, durations and dates can be
+written with units.  Every comparison is evaluated over a whole column of
+machine-readable values instead of per torrent object.
+
+Syntax:
+    field op value, combined with and, or, not and parentheses.
+    op is one of == (or =), !=, <, <=, >, >=, ~ (contains, case-insensitive),
+    ^= (starts with) and in [value, ...].  Values with spaces or special
+    characters need quotes.  For list fields (e.g. labels) == and in test
+    the items; a boolean field on its own means field == true.
+
+Exceptions:
+    QueryError: The query can't be parsed or uses unknown fields.
+
+Classes:
+    Query:
+        >>> q = Query('status == downloading and downloadDir == /data/tv '
+        ...           'and uploadRatio < 1', sort='eta', limit=50)
+        >>> q.fields  # For the 'torrent-get' that backs the query
+        ['id', 'status', 'downloadDir', 'uploadRatio', 'eta']
+        >>> client.torrents(keys=q.fields)
+        >>> q.run(client)
+        [{u'id': 12, u'status': 'downloading', ...}, ...]
+        >>> Query('totalSize > 1.5GB or (labels in [tv, film] and not isPrivate)',
+        ...       sort=['-rateDownload', 'name']).count(client)
+        214
+"""
+
+import re
+import heapq
+import datetime
+from rpc import (TransmissionRPC, TransmissionRPCValue, SPEC_INDEX, identity)
+from columnar import ColumnarTorrentStore
+from constants import BYTE_SIZES
+from transmission.json_utils import epoch_to_datetime  # transmission-fluid
+
+class QueryError(Exception): pass
+
+TOKENS = re.compile(r'''\s*(?:(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')'''
+                    r'''|(?P<op>==|!=|<=|>=|\^=|[=<>~(),\[\]])'''
+                    r'''|(?P<word>[^\s=!<>~^(),\[\]"']+))''')
+KEYWORDS = ('and', 'or', 'not', 'in')
+COMPARISONS = ('==', '=', '!=', '<', '<=', '>', '>=', '~', '^=', 'in')
+
+RE_NUMBER = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)(e[-+]?\d+)?$', re.I)
+RE_BYTES = re.compile(r'^(\d+\.?\d*|\.\d+)\s*(?:([kmgtp])(i)?)?b?(?:/s)?$', re.I)
+RE_TIMESPAN = re.compile(r'^(\d+\.?\d*)\s*([smhdw])$')
+TIMESPANS = {'s':1, 'm':60, 'h':3600, 'd':86400, 'w':604800}
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+STRING_TYPES = ('str', 'url', 'path_dir', 'path_file')
+
+
+### Literals
+
+def parse_number(text):
+    if not RE_NUMBER.match(text):
+        raise ValueError(text)
+    number = float(text)
+    return int(number) if number.is_integer() and 'e' not in text.lower() \
+        and '.' not in text else number
+
+def parse_bytes(text):
+    """Return number of bytes of e.g. '1.5GB', '700MiB', '100kB/s' or '512'."""
+    match = RE_BYTES.match(text)
+    if match is None:
+        raise ValueError(text)
+    number, symbol, binary = match.groups()
+    if symbol is None:
+        return int(float(number))
+    base = 1024 if binary else 1000
+    return int(float(number) * BYTE_SIZES[base]['kmgtp'.index(symbol.lower())])
+
+def parse_timespan(text):
+    """Return seconds of e.g. '90', '30m' or '1.5h'."""
+    match = RE_TIMESPAN.match(text)
+    if match is None:
+        return parse_number(text)
+    return int(float(match.group(1)) * TIMESPANS[match.group(2)])
+
+def parse_date(text):
+    """Return datetime of e.g. '2012-10-01' or a Unix time.
+
+    Like cached dates, the result is naive and in UTC.
+    """
+    for format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, format)
+        except ValueError:
+            pass
+    return epoch_to_datetime(parse_number(text))
+
+def _datetime(v):
+    """Return cached date v as datetime; caches filled without
+    transmission-fluid's decoder hold Unix times."""
+    if isinstance(v, (int, long, float)):
+        return epoch_to_datetime(v)
+    return v
+
+def parse_percent(text):
+    if text.endswith('%'):
+        return parse_number(text[:-1].strip()) / 100.0
+    return parse_number(text)
+
+def parse_boolean(text):
+    try:
+        return {'true':True, 'yes':True, '1':True,
+                'false':False, 'no':False, '0':False}[text.lower()]
+    except KeyError:
+        raise ValueError(text)
+
+# Spec type -> function that converts a literal to a machine-readable value
+PARSERS = {
+    'int': parse_number, 'number': parse_number, 'float': parse_number,
+    'ratio': parse_number, 'percent': parse_percent, 'timespan': parse_timespan,
+    'date': parse_date, 'bytes_size': parse_bytes, 'bytes_rate': parse_bytes,
+    'boolean': parse_boolean,
+    'path_dir': lambda text: text.rstrip('/') or text,
+    'path_file': lambda text: text.rstrip('/') or text,
+}
+
+
+### Columns
+
+def _normalize(type, op):
+    """Return function that prepares column values for op or None."""
+    if op == '~':
+        if type == 'list':
+            return lambda v: None if v is None else [unicode(item).lower() for item in v]
+        return lambda v: None if v is None else unicode(v).lower()
+    if type in ('path_dir', 'path_file'):
+        return lambda v: v.rstrip('/') or v if v else v
+    if type == 'date':
+        return _datetime
+    if type == 'list' and op in ('==', '!=', 'in'):
+        return lambda v: () if v is None else v
+
+def _sort_key(type):
+    if type in STRING_TYPES:
+        return lambda v: v.lower() if v else v
+    if type == 'list':
+        return lambda v: sorted(v) if v else v
+    if type == 'date':
+        return _datetime
+
+
+class _Table(object):
+
+    """Torrents of a cache and their values, read once per column."""
+
+    def __init__(self, torrents):
+        if hasattr(torrents, '_cache'):  # TransmissionClient
+            torrents = torrents._cache['torrents']
+        self.store = None
+        if isinstance(torrents, ColumnarTorrentStore):
+            self.store = torrents
+            self.ids = list(torrents._ids)
+            self.slots = [torrents._ids[id] for id in self.ids]
+            self.rows = None
+        elif hasattr(torrents, 'values'):
+            self.ids = torrents.keys()
+            self.rows = torrents.values()  # In the same order
+        else:
+            self.ids = None
+            self.rows = list(torrents)
+        if self.rows is not None:
+            # Plain cached torrents are read without the value() method call
+            self._plain = set(map(type, self.rows)) <= set([TransmissionRPC])
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.slots if self.store is not None else self.rows)
+
+    def column(self, field, normalize=None, rows=None):
+        """Return values of field indexable by row number.
+
+        If rows are given and few, only their values are read (as a dict)
+        unless the whole column has been read already.
+        """
+        key = (field, normalize)
+        column = self._columns.get(key)
+        if column is not None:
+            return column
+        if rows is not None and len(rows) * 2 < len(self):
+            return dict(zip(rows, self._values(field, normalize, rows)))
+        column = self._columns[key] = self._values(field, normalize, range(len(self)))
+        return column
+
+    def _values(self, field, normalize, rows):
+        if normalize is not None:
+            column = self._columns.get((field, None))
+            if column is None:
+                values = self._values(field, None, rows)
+            else:
+                values = [column[i] for i in rows]
+            return [normalize(v) for v in values]
+        if self.store is not None:
+            return self._store_values(field, rows)
+        if self._plain:
+            torrents = self.rows
+            try:  # Scalar values in all rows
+                return [torrents[i]._data[field]._value for i in rows]
+            except (KeyError, AttributeError):
+                pass
+            data = [torrents[i]._data.get(field) for i in rows]
+            return [v._value if type(v) is TransmissionRPCValue else
+                    (None if v is None else v.mr) for v in data]
+        return [self.rows[i].value(field) for i in rows]
+
+    def _store_values(self, field, rows):
+        store = self.store
+        data = store.columns.get(field)
+        if data is None:
+            return [None] * len(rows)
+        present = store._present[field]
+        slots = self.slots
+        values = [data[slots[i]] if present[slots[i]] else None for i in rows]
+        if store._spec[field].type == 'boolean':
+            return [None if v is None else bool(v) for v in values]
+        if store._spec[field].type in ('dict', 'list'):
+            return [v.mr if isinstance(v, TransmissionRPC) else v for v in values]
+        return values
+
+    def select(self, indexes):
+        """Return torrents at indexes."""
+        if self.store is not None:
+            return [self.store[self.ids[i]] for i in indexes]
+        return [self.rows[i] for i in indexes]
+
+
+### Expressions
+
+class _Comparison(object):
+
+    def __init__(self, field, op, value):
+        spec = SPEC_INDEX.get((('torrent',), field))
+        if spec is None:
+            raise QueryError('Unknown field: %s' % field)
+        if spec.type in ('dict', 'pieces'):
+            raise QueryError("Can't compare %s" % field)
+        if op == '^=' and spec.type not in STRING_TYPES:
+            raise QueryError("Can't use ^= with %s" % field)
+        if op == '=':
+            op = '=='
+        self.field = field
+        self.op = op
+        values = value if op == 'in' else [value]
+        parse = PARSERS.get(spec.type)
+        if parse is not None and op not in ('~', '^='):
+            try:
+                values = [parse(v) for v in values]
+            except ValueError as err:
+                # Values converted by onupdate (e.g. status names) are
+                # compared as they are
+                if spec.onupdate is identity:
+                    raise QueryError('Invalid value for %s: %s' % (field, err))
+        if op == '~':
+            values = [v.lower() for v in values]
+        self.normalize = _normalize(spec.type, op)
+        self.select = self._compile(spec.type, op, values)
+
+    def _compile(self, type, op, values):
+        field, normalize = self.field, self.normalize
+        x = values[0]
+        if type == 'list':
+            if op == '==':
+                return lambda t, rows: _members(t.column(field, normalize, rows), rows, x)
+            if op == '!=':
+                return lambda t, rows: _not_in(_members(t.column(field, normalize, rows), rows, x),
+                                               rows)
+            if op == 'in':
+                wanted = frozenset(values)
+                return lambda t, rows: _any(t.column(field, normalize, rows), rows, wanted)
+            if op == '~':
+                return lambda t, rows: _any_contains(t.column(field, normalize, rows), rows, x)
+            raise QueryError("Can't use %s with %s" % (op, field))
+        if op == 'in':
+            wanted = frozenset(values)
+            return lambda t, rows: _in(t.column(field, normalize, rows), rows, wanted)
+        try:
+            select = SELECTORS[op]
+        except KeyError:
+            raise QueryError('Unknown operator: %s' % op)
+        return lambda t, rows: select(t.column(field, normalize, rows), rows, x)
+
+    def fields(self):
+        return [self.field]
+
+
+def _members(col, rows, x):
+    return [i for i in rows if x in col[i]]
+
+def _any(col, rows, wanted):
+    return [i for i in rows if not wanted.isdisjoint(col[i])]
+
+def _any_contains(col, rows, x):
+    return [i for i in rows if col[i] and any(x in item for item in col[i])]
+
+def _in(col, rows, wanted):
+    return [i for i in rows if col[i] in wanted]
+
+def _not_in(selected, rows):
+    selected = set(selected)
+    return [i for i in rows if i not in selected]
+
+# Operator -> function(column, rows, value) that returns matching rows.
+# Missing values (None) never match an ordering comparison.
+SELECTORS = {
+    '==': lambda col, rows, x: [i for i in rows if col[i] == x],
+    '!=': lambda col, rows, x: [i for i in rows if col[i] != x],
+    '<':  lambda col, rows, x: [i for i in rows if col[i] is not None and col[i] < x],
+    '<=': lambda col, rows, x: [i for i in rows if col[i] is not None and col[i] <= x],
+    '>':  lambda col, rows, x: [i for i in rows if col[i] is not None and col[i] > x],
+    '>=': lambda col, rows, x: [i for i in rows if col[i] is not None and col[i] >= x],
+    '~':  lambda col, rows, x: [i for i in rows if col[i] is not None and x in col[i]],
+    '^=': lambda col, rows, x: [i for i in rows if col[i] and col[i].startswith(x)],
+}
+
+
+class _And(object):
+    def __init__(self, left, right):
+        self.left, self.right = left, right
+    def select(self, table, rows):
+        # The right side only looks at rows that passed the left side
+        return self.right.select(table, self.left.select(table, rows))
+    def fields(self):
+        return self.left.fields() + self.right.fields()
+
+class _Or(_And):
+    def select(self, table, rows):
+        left = self.left.select(table, rows)
+        right = self.right.select(table, _not_in(left, rows))
+        return sorted(left + right)
+
+class _Not(object):
+    def __init__(self, operand):
+        self.operand = operand
+    def select(self, table, rows):
+        return _not_in(self.operand.select(table, rows), rows)
+    def fields(self):
+        return self.operand.fields()
+
+
+def tokenize(text):
+    """Return list of (kind, value) tuples; kind is 'op', 'word' or 'string'."""
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = TOKENS.match(text, pos)
+        if match is None or match.end() == pos:
+            raise QueryError('Invalid query at %d: %s' % (pos, text[pos:]))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'word' and value.lower() in KEYWORDS:
+            kind, value = 'op', value.lower()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+class _Parser(object):
+
+    """Recursive descent parser for the grammar
+        expr := term ('or' term)*
+        term := factor ('and' factor)*
+        factor := 'not' factor | '(' expr ')' | field op value | field
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self, expected=None):
+        token = self.peek()
+        if token[0] is None:
+            raise QueryError('Unexpected end of query')
+        if expected is not None and token != ('op', expected):
+            raise QueryError('Expected %s instead of %s' % (expected, token[1]))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.expr()
+        if self.pos < len(self.tokens):
+            raise QueryError('Unexpected %s' % self.peek()[1])
+        return node
+
+    def expr(self):
+        node = self.term()
+        while self.peek() == ('op', 'or'):
+            self.next()
+            node = _Or(node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.peek() == ('op', 'and'):
+            self.next()
+            node = _And(node, self.factor())
+        return node
+
+    def factor(self):
+        if self.peek() == ('op', 'not'):
+            self.next()
+            return _Not(self.factor())
+        if self.peek() == ('op', '('):
+            self.next()
+            node = self.expr()
+            self.next(')')
+            return node
+        kind, field = self.next()
+        if kind != 'word':
+            raise QueryError('Expected a field instead of %s' % field)
+        spec = SPEC_INDEX.get((('torrent',), field))
+        if spec is not None and spec.type == 'boolean' and \
+                self.peek()[1] not in COMPARISONS:
+            return _Comparison(field, '==', 'true')  # e.g. 'not isPrivate'
+        kind, op = self.next()
+        if kind != 'op' or op not in COMPARISONS:
+            raise QueryError('Expected an operator after %s instead of %s' % (field, op))
+        if op == 'in':
+            return _Comparison(field, op, self.values())
+        return _Comparison(field, op, self.value())
+
+    def value(self):
+        kind, value = self.next()
+        if kind == 'op':
+            raise QueryError('Expected a value instead of %s' % value)
+        return value
+
+    def values(self):
+        close = {'[':']', '(':')'}.get(self.next()[1])
+        if close is None:
+            raise QueryError('Expected a list of values after in')
+        values = [self.value()]
+        while self.peek() == ('op', ','):
+            self.next()
+            values.append(self.value())
+        self.next(close)
+        return values
+
+
+class Query(object):
+
+    """A compiled filter with sort order and page."""
+
+    def __init__(self, where=None, sort=None, offset=0, limit=None):
+        """Compile a new query.
+
+        Arguments:
+            where: Expression (see module docstring) or None for all torrents.
+            sort: Field or list of fields; a leading '-' sorts in descending
+                  order.  Strings are compared case-insensitively, missing
+                  values come first.
+            offset, limit: Page of the sorted result.
+        """
+        self.where = where
+        self._filter = _Parser(where).parse() if where and where.strip() else None
+        if sort is None:
+            sort = []
+        elif isinstance(sort, basestring):
+            sort = [sort]
+        self.sort = []
+        for field in sort:
+            descending = field.startswith('-')
+            field = field.lstrip('-+')
+            spec = SPEC_INDEX.get((('torrent',), field))
+            if spec is None:
+                raise QueryError('Unknown field: %s' % field)
+            self.sort.append((field, descending, _sort_key(spec.type)))
+        self.offset = offset
+        self.limit = limit
+        self.fields = ['id']
+        for field in (self._filter.fields() if self._filter else []) + \
+                [field for field,descending,key in self.sort]:
+            if field not in self.fields:
+                self.fields.append(field)
+
+    def _matches(self, table):
+        rows = range(len(table))
+        if self._filter is not None:
+            rows = self._filter.select(table, rows)
+        return rows
+
+    def count(self, torrents):
+        """Return number of matching torrents; sort order and page don't
+        matter."""
+        return len(self._matches(_Table(torrents)))
+
+    def run(self, torrents):
+        """Return list of matching torrents, sorted and paged.
+
+        torrents can be a TransmissionClient, its torrent cache or a list of
+        torrents (anything with value(key)).  Only cached values are used.
+        """
+        table = _Table(torrents)
+        rows = self._matches(table)
+        end = None if self.limit is None else self.offset + self.limit
+        if len(self.sort) == 1 and end is not None and end < len(rows) // 4:
+            # Top n of a few thousand is cheaper with a heap than sorting
+            field, descending, key = self.sort[0]
+            column = table.column(field, key, rows)
+            top = heapq.nlargest if descending else heapq.nsmallest
+            rows = top(end, rows, key=column.__getitem__)
+        else:
+            for field,descending,key in reversed(self.sort):
+                rows.sort(key=table.column(field, key, rows).__getitem__,
+                          reverse=descending)
+        return table.select(rows[self.offset:end])
@@ -22,21 +22,79 @@ Exceptions:
 Classes:
     TransmissionRPCValue: An extension to any value like str/int/float/etc.
     TransmissionRPC: Basically a dict of TransmissionRPCValues.
+    DirtySet: Keys of a TransmissionRPC that need a push.
 """
 
 import os
 import re
-from rpcspec import RPC
-from constants import (ENCODING,
-                       BYTE_SYMBOLS, BYTE_SIZES,
-                       RE_HOMEDIR, RE_ONE)
+from operator import itemgetter
+from rpcspec import (RPC, IDENTITIES)
+from constants import ENCODING
+from formatters import (FORMATTERS, prettify,
+                        hr_ratio, hr_percent, hr_path, hr_bytes)
 
 class TransmissionRPCError(Exception): pass
 
+class _Removed(object):
+    def __repr__(self): return 'REMOVED'
+
+# Reported by TransmissionRPC.update() for list items that are gone
+REMOVED = _Removed()
+
+class DirtySet(set):
+
+    """Keys of a TransmissionRPC whose values were changed locally.
+
+    Values add their key on set(); the first key also marks the owner's
+    key in the parent set, so push() only visits changed branches.
+    """
+
+    __slots__ = ('parent', 'key')
+
+    def __init__(self, parent=None, key=None):
+        set.__init__(self)
+        self.parent = parent
+        self.key = key
+
+    def child(self, key):
+        """Return a new DirtySet for the object stored under key."""
+        return DirtySet(self, key)
+
+    def mark(self, key):
+        if not self and self.parent is not None:
+            self.parent.mark(self.key)
+        self.add(key)
+
+    def flush(self):
+        """Forget all keys and unmark the owner in the parent set."""
+        self.clear()
+        if self.parent is not None:
+            self.parent.discard(self.key)
+
+
+class RPCSpec(object):
+
+    """Specifications of one RPC value, resolved once and shared by all
+    TransmissionRPCValues of that key."""
+
+    __slots__ = ('key', 'type', 'mutable', 'onupdate', 'onwrite', 'prettify')
+
+    def __init__(self, key, **spec):
+        self.key = key
+        self.type = spec['type']
+        self.mutable = spec['mutable']
+        self.onupdate = spec.get('onupdate', identity)
+        self.onwrite = spec.get('onwrite', identity)
+        self.prettify = spec.get('prettify') or FORMATTERS.get(self.type, unicode)
+
+
 class TransmissionRPCValue(object):
 
     """Maintain one value according to its specifications in rpcspec.py."""
 
+    __slots__ = ('_key', '_spec', '_hooks', '_value', '_value_pretty',
+                 '_dirty', 'mutable', 'needs_push')
+
     def __init__(self, key, value=None, **spec):
         """Initialize new TransmissionRPCValue.
 
@@ -53,33 +111,54 @@ class TransmissionRPCValue(object):
                 prettify: See prettify method.
                 version: TODO
         """
+        self._init(key, value, RPCSpec(key, **spec))
 
+    @classmethod
+    def from_spec(cls, key, value, spec, dirty=None):
+        """Create new TransmissionRPCValue from a (shared) RPCSpec.
+
+        set() adds key to dirty, the DirtySet of the containing
+        TransmissionRPC.
+        """
+        self = cls.__new__(cls)
+        self._init(key, value, spec, dirty=dirty)
+        return self
+
+    @classmethod
+    def restore(cls, key, value, spec, dirty=None):
+        """Create new TransmissionRPCValue from a machine-readable value
+        (e.g. a saved .mr) without applying onupdate again."""
+        self = cls.__new__(cls)
+        self._init(key, value, spec, convert=False, dirty=dirty)
+        return self
+
+    def _init(self, key, value, spec, convert=True, dirty=None):
         self._key = key
-        self._type = spec['type']
-        self.mutable = spec['mutable']
+        self._spec = spec
+        self._hooks = None  # Hooks that differ from spec, created on demand
+        self._dirty = dirty
+        self.mutable = spec.mutable
         self.needs_push = False
-
-        self._hooks = {
-            'onupdate': lambda v: v,
-            'onwrite': lambda v: v,
-            'prettify': self._std_prettify
-        }
-        for name in ('onupdate','onwrite','prettify'):
-            if name in spec:
-                self._hooks[name] = spec[name]
-
-        self._value = self.onupdate(value)
-        self._value_pretty = self.prettify(self._value)
+        self._value = self.onupdate(value) if convert else value
+        self._value_pretty = None  # Computed on first access
 #        print "Created new TransmissionRPCValue: %s" % repr(self)
 
     def update(self, value):
         """This is supposed to be called whenever the DAEMON changes our value
-        so we can assimilate it properly."""
-        new_value = self.onupdate(value)
+        so we can assimilate it properly.
+
+        Return True if the value actually changed.
+        """
+        if self._hooks is None:
+            new_value = self._spec.onupdate(value)
+        else:
+            new_value = self.onupdate(value)
         if new_value != self._value:
             self._value = new_value
-            self._value_pretty = self.prettify(self._value)
+            self._value_pretty = None
 #            print 'daemon says: %s=%s' % (self._key, self._value)
+            return True
+        return False
 
     def set(self, new_value):
         """This is supposed to be called whenever the USER changes our value
@@ -88,15 +167,23 @@ class TransmissionRPCValue(object):
             raise TransmissionRPCError("Can't alter %s" % self._key)
         if new_value != self._value:
             self._value = new_value
-            self._value_pretty = self.prettify(self._value)
+            self._value_pretty = None
 #            print 'setting %s=%s' % (self._key, self._value)
             self.needs_push = True
+            if self._dirty is not None:
+                self._dirty.mark(self._key)
 
     def _hook(self, name, arg):
         if callable(arg):
+            if self._hooks is None:
+                self._hooks = {}
             self._hooks[name] = arg  # Set new hook
+            if name == 'prettify':
+                self._value_pretty = None
+        elif self._hooks is not None and name in self._hooks:
+            return self._hooks[name](arg)  # Execute own hook
         else:
-            return self._hooks[name](arg)  # Execute hook
+            return getattr(self._spec, name)(arg)  # Execute spec's hook
     def onupdate(self, func):
         """Set callback function for value updates from daemon.
 
@@ -112,44 +199,57 @@ class TransmissionRPCValue(object):
         """Set callback function for any value update.
 
         func will get the raw value. func's return value will
-        be used as the pretty/human-readable version.
+        be used as the pretty/human-readable version.  It is called lazily
+        when the human-readable value is needed for the first time after
+        a change.
         """
         return self._hook('prettify', func)
 
-    def _std_prettify(self, value):
-        if self._type == 'float':         pass
-        elif self._type == 'ratio':       value = hr_ratio(value)
-        elif self._type == 'int':         pass
-        elif self._type == 'str':         pass
-        elif self._type == 'percent':     value = hr_percent(value)
-        elif self._type == 'boolean':     value = unicode(value).lower()
-        elif self._type == 'path_dir':    value = hr_path(value) + '/'
-        elif self._type == 'path_file':   value = hr_path(value)
-        elif self._type == 'url':         pass
-        elif self._type == 'bytes_size':  value = hr_bytes(value)
-        elif self._type == 'bytes_rate':  value = hr_bytes(value) + '/s'
-        elif self._type == 'date':        pass
-        elif self._type == 'timespan':    pass
-        return unicode(value)
+    def _get_pretty(self):
+        if self._value_pretty is None:
+            self._value_pretty = self.prettify(self._value)
+        return self._value_pretty
 
     # Offer easy access to human-readable and machine-readable values
-    hr = property(fget=lambda self: self._value_pretty)
+    hr = property(fget=_get_pretty)
     mr = property(fget=lambda self: self._value)
 
-    def __unicode__(self): return self._value_pretty
-    def __str__(self): return self._value_pretty.encode(ENCODING)
+    def __unicode__(self): return self.hr
+    def __str__(self): return self.hr.encode(ENCODING)
     def __repr__(self): return repr(self._value)
     def __trunc__(self): return int(self._value)
     def __float__(self): return float(self._value)
-    def __len__(self): return len(self._value_pretty)
+    def __len__(self): return len(self.hr)
     def __eq__(self, other): return self._value == other
     def __ne__(self, other): return self._value != other
     def __lt__(self, other): return self._value < other
     def __le__(self, other): return self._value <= other
     def __gt__(self, other): return self._value > other
     def __ge__(self, other): return self._value >= other
-    def lower(self): return self._value_pretty.lower()
-    def upper(self): return self._value_pretty.upper()
+    def lower(self): return self.hr.lower()
+    def upper(self): return self.hr.upper()
+
+
+class FieldUsageTracker(object):
+
+    """Record which fields of cached torrents are actually read.
+
+    Reads are recorded even if the field wasn't fetched, so a forgotten field
+    is included in the next suggestion.
+    """
+
+    def __init__(self):
+        self.used = set()
+
+    def add(self, key):
+        self.used.add(key)
+
+    def reset(self):
+        self.used.clear()
+
+    def suggest(self, keys=()):
+        """Return sorted list of fields read so far plus keys and 'id'."""
+        return sorted(self.used.union(keys, ['id']))
 
 
 class TransmissionRPC(object):
@@ -157,7 +257,9 @@ class TransmissionRPC(object):
     """A dict or list of TransmissionRPCs and TransmissionRPCValues
     according to rpcspec.py."""
 
-    def __init__(self, section, data=None, setter=None):
+    __slots__ = ('_setter', '_tracker', '_section', '_path', '_data', '_dirty', '_keys')
+
+    def __init__(self, section, data=None, setter=None, tracker=None, dirty=None):
         """Create a new TransmissionRPC instance.
 
         Arguments:
@@ -166,12 +268,22 @@ class TransmissionRPC(object):
             data: Optional list or dict. Can be set later via update method.
             setter: Optional callable that will get called with changed items
                     via push method.
+            tracker: Optional FieldUsageTracker that records read keys.
+            dirty: Optional DirtySet for changed keys, usually the child()
+                   of the owner's DirtySet.
         """
         self._setter = setter
+        self._tracker = tracker
         if type(section) is list:
             self._section = section
         else:
             self._section = [section]
+        # Key prefix in SPEC_INDEX
+        self._path = tuple(s for s in self._section if type(s) is not int)
+        if dirty is None and self._path in MUTABLE_PATHS:
+            dirty = DirtySet()
+        self._dirty = dirty
+        self._keys = None  # Identities of list items, see _reconcile()
         if type(data) is list:
             self._data = []
         else:
@@ -182,47 +294,171 @@ class TransmissionRPC(object):
 
     def update(self, new):
         """Update or create TransmissionRPC(Value) instances from new
-        according to specs."""
+        according to specs.
+
+        Return a dict of keys whose values really changed.  It maps each key
+        to its previous machine-readable value (None for new keys) or, for
+        nested values, to a dict of nested changes.  Items that are missing
+        from a new list are removed and reported as REMOVED.  Items of lists
+        in rpcspec.IDENTITIES are matched and reported by identity (e.g.
+        u'10.0.0.1:51413' for peers), others by index.
+        """
+        if type(self._data) is list:
+            fields = IDENTITIES.get(self._path)
+            if fields is not None:
+                return self._reconcile(new, fields)
+        changed = {}
         for key,value in get_items(new):
             try:
-                # TransmissionRPC and TransmissionRPCValue conveniently have
-                # update() methods
-                self._data[key].update(value)
+                item = self._data[key]
             except (KeyError, IndexError):
                 if type(value) is dict or type(value) is list:
-                    add_key(self._data, key, TransmissionRPC(self._section+[key], value))
+                    add_key(self._data, key, TransmissionRPC(self._section+[key], value,
+                                                             dirty=self._child_dirty(key)))
                 else:
-                    spec = get_spec(self._section, key)
-                    add_key(self._data, key, TransmissionRPCValue(key, value, **spec))
+                    add_key(self._data, key,
+                            TransmissionRPCValue.from_spec(key, value, self._spec(key),
+                                                           self._dirty))
+                changed[key] = None
+                continue
+            # TransmissionRPC and TransmissionRPCValue conveniently have
+            # update() methods
+            if isinstance(item, TransmissionRPC):
+                nested = item.update(value)
+                if nested:
+                    changed[key] = nested
+            else:
+                old = item._value
+                if item.update(value):
+                    changed[key] = old
+        if type(self._data) is list and len(self._data) > len(new):
+            for index in range(len(new), len(self._data)):
+                changed[index] = REMOVED
+                if self._dirty:
+                    self._dirty.discard(index)
+            del self._data[len(new):]
+        return changed
+
+    def _reconcile(self, new, fields):
+        """Update a list of dicts whose items are identified by fields.
+
+        Known items are updated in place, so unchanged ones cost no
+        allocations no matter where they moved.
+        """
+        identify = itemgetter(*fields)  # A tuple if there are many fields
+        if len(fields) == 1:
+            label = lambda key: key
+        else:
+            label = lambda key: u':'.join(unicode(k) for k in key)
+        keys = map(identify, new)
+        if self._keys is None:
+            self._keys = [identify(item.mr) for item in self._data]
+        changed = {}
+        if keys == self._keys:
+            # Same items in the same order
+            for key,item,value in zip(keys, self._data, new):
+                nested = item.update(value)
+                if nested:
+                    changed[label(key)] = nested
+            return changed
+        current = dict(zip(self._keys, self._data))
+        data = []
+        for key,value in zip(keys, new):
+            item = current.pop(key, None)
+            if item is None:
+                item = TransmissionRPC(self._section+[len(data)], value)
+                changed[label(key)] = None
+            else:
+                nested = item.update(value)
+                if nested:
+                    changed[label(key)] = nested
+            data.append(item)
+        for key in current:
+            changed[label(key)] = REMOVED
+        self._data = data
+        self._keys = keys
+        return changed
+
+    @classmethod
+    def restore(cls, section, data, setter=None, tracker=None, dirty=None):
+        """Create a new TransmissionRPC instance from machine-readable values
+        (e.g. a saved .mr) without applying onupdate hooks again."""
+        self = cls(section, setter=setter, tracker=tracker, dirty=dirty)
+        if type(data) is list:
+            self._data = []
+        restore_value = TransmissionRPCValue.restore
+        for key,value in get_items(data):
+            if type(value) is dict or type(value) is list:
+                add_key(self._data, key, cls.restore(self._section+[key], value,
+                                                     dirty=self._child_dirty(key)))
+            else:
+                add_key(self._data, key, restore_value(key, value, self._spec(key),
+                                                       self._dirty))
+        return self
+
+    def _child_dirty(self, key):
+        """Return DirtySet for a nested TransmissionRPC or None if it can't
+        have changes."""
+        path = self._path if type(key) is int else self._path + (key,)
+        if path in MUTABLE_PATHS:
+            return self._dirty.child(key)
+
+    def _spec(self, key):
+        try:
+            return SPEC_INDEX[(self._path, None if type(key) is int else key)]
+        except KeyError:
+            return get_spec(self._section, key)  # Raises error
+
+    def changes(self, clear=False):
+        """Return altered values in the format the daemon expects.
+
+        Only keys in the DirtySet are visited.  If clear is True, the values
+        are considered pushed afterwards.
+        """
+        if not self._dirty:
+            return [] if type(self._data) is list else {}
+        if type(self._data) is list:
+            filtered = []
+            keys = sorted(self._dirty)
+        else:
+            filtered = {}
+            keys = list(self._dirty)  # Nested flush() discards keys
+        for key in keys:
+            try:
+                item = self._data[key]
+            except (KeyError, IndexError):
+                continue
+            if isinstance(item, TransmissionRPC):
+                nested = item.changes(clear)
+                if nested:
+                    add_key(filtered, key, nested)
+            elif item.needs_push:
+                add_key(filtered, key, item.onwrite(item.mr))
+                if clear:
+                    item.needs_push = False
+        if clear:
+            self._dirty.flush()
+        return filtered
+
+    # True if changes() may return anything
+    needs_push = property(fget=lambda self: bool(self._dirty))
 
     def push(self):
-        """Find altered values and update the daemon."""
+        """Find altered values and update the daemon.
+
+        Return whatever the setter returns, or None if nothing changed.
+        """
         if not callable(self._setter):
             return
-        def get_changed_items(data):
-            keyvalpairs = get_items(data)
-            if type(data) is list:
-                filtered = []
-            else:
-                filtered = {}
-            for key,value in keyvalpairs:
-                try:
-                    if value.needs_push:
-                        print 'writing', value.onwrite(value.mr)
-                        add_key(filtered, key, value.onwrite(value.mr))
-                        value.needs_push = False
-                except AttributeError:
-                    item = get_changed_items(data[key])
-                    if len(item):
-                        add_key(filtered, key, item)
-            return filtered
-        changed_items = get_changed_items(self._data)
+        changed_items = self.changes(clear=True)
         if changed_items:
             if self._section[0] == 'torrent':
                 changed_items['id'] = self._data['id'].mr
-            self._setter(**changed_items)
+            return self._setter(**changed_items)
 
     def __getitem__(self, key):
+        if self._tracker is not None:
+            self._tracker.add(key)
         return self._data[key]
     def __setitem__(self, key, value):
         self._data[key].set(value)
@@ -232,6 +468,22 @@ class TransmissionRPC(object):
     def items(self): return self._data.items()
     def keys(self): return self._data.keys()
 
+    def _get_value(self):
+        if type(self._data) is list:
+            return [value.mr for value in self._data]
+        return dict((key, value.mr) for key,value in self._data.items())
+    mr = property(fget=_get_value)
+
+    def value(self, key, default=None):
+        """Return machine-readable value of key or default.
+
+        Unlike item access, this isn't recorded by a FieldUsageTracker.
+        """
+        try:
+            return self._data[key].mr
+        except (KeyError, IndexError):
+            return default
+
 
 ### Helper functions
 
@@ -248,96 +500,48 @@ def add_key(dictorlist, key, value):
         dictorlist.append(value)
 
 def get_spec(sections, key):
-    """ Find specifications for RPC value. """
-    category = RPC
+    """ Find specifications for RPC value.
+
+    Return the shared RPCSpec from SPEC_INDEX.  Integer sections and keys
+    (list indexes) are not part of the index.
+    """
+    path = tuple(section for section in sections if type(section) is not int)
+    if type(key) is int:
+        key = None
     try:
-        for section in sections:
-            if type(section) is not int:
-                category = category[section]
-            if 'subspec' in category:
-                category = category['subspec']
+        return SPEC_INDEX[(path, key)]
     except KeyError:
         raise TransmissionRPCError('Missing RPC specifications: %s' % \
                                        (':'.join(str(s) for s in sections+[key])))
-    if type(key) is int:
-        return category
-    else:
-        return category[key]
-
 
-### Converters (machine-readable -> human-readable)
-
-def hr_ratio(v):
-    if v == -1: return 'n/a'
-    if v == -2: return 'inf'
-    try:
-        return u'%.2f' % v
-    except TypeError:
-        return u'0.00'
+def compile_specs(rpc):
+    """Flatten nested specifications into a dict that maps (path, key) to
+    RPCSpecs.
 
-def hr_percent(v):
-    try:
-        return u'%d %%' % (v*100)
-    except TypeError:
-        return u'0 %'
+    path is a tuple of section names, e.g. ('torrent', 'peers').  Specs of
+    list items that aren't dicts (e.g. 'priorities') have None as key.
+    """
+    index = {}
+    def walk(path, category):
+        for key,spec in category.items():
+            index[(path, key)] = RPCSpec(key, **spec)
+            subspec = spec.get('subspec')
+            if subspec is None:
+                continue
+            if isinstance(subspec.get('type'), basestring):
+                index[(path + (key,), None)] = RPCSpec(key, **subspec)
+            else:
+                walk(path + (key,), subspec)
+    for section,category in rpc.items():
+        walk((section,), category)
+    return index
 
-def hr_path(path):
-    try:
-        if RE_HOMEDIR.match(path):
-            path = '~' + RE_HOMEDIR.sub('', path, 1)
-        return path.rstrip('/')
-    except TypeError:
-        return u''
 
-def hr_bytes(bytes, base=1000, lengthy=False, format=None):
-    """
-    Adapted from:
-        Author: Giampaolo Rodola' <g.rodola [AT] gmail [DOT] com>
-        License: MIT
-        Link: http://code.activestate.com/recipes/578019-bytes-to-human-human-to-bytes-converter/
-    """
-    try:
-        bytes = int(bytes)
-    except TypeError:
-        return u'0 B'
-    if bytes < 0:
-        raise ValueError('bytes < 0: %d' % bytes)
+identity = lambda v: v
 
-    # Associate BYTE_SYMBOLS with BYTE_SIZES (e.g. 'k' -> 1000)
-    try:
-        byte_symbols = BYTE_SYMBOLS[base][('short','long')[lengthy]]
-        byte_sizes = dict(zip(byte_symbols, BYTE_SIZES[base]))
-    except KeyError:
-        raise ValueError('Unknown base for byte conversion: %s' % base)
-
-    # '5000' --> 'value=5 symbol=kilo'
-    value = bytes
-    symbol = ''
-    for s in reversed(byte_symbols):
-        if bytes >= byte_sizes[s]:
-            value = float(bytes) / byte_sizes[s]
-            symbol = s
-            break
-
-    # Cut everything after two decimal points
-    value = float('%.2f' % value)
-
-    if format is None:
-        # Use reasonable format depending on magnitude
-        if value < 10:      # 'n.nn' between 0 and 10
-            format = '%(value).2f %(symbol)s'
-        elif value < 100:   # 'n.n' between 10 and 100
-            format = '%(value).1f %(symbol)s'
-        else:               # 'n' between 100 and 1000/1024
-            format = '%(value)d %(symbol)s'
-
-    text = (format % dict(symbol=symbol, value=value)).replace('.0 ', ' ')
-
-    # Consider plural-s for lengthy notation
-    if lengthy:
-        unit_name = 'byte%s' % ('','s')[RE_ONE.match(text) is None]
-    else:
-        unit_name = 'B'
-
-    return text + unit_name
+SPEC_INDEX = compile_specs(RPC)
 
+# Paths of sections with mutable values, directly or nested.  Only these
+# get a DirtySet.
+MUTABLE_PATHS = frozenset(path[:i] for (path, key),spec in SPEC_INDEX.items()
+                          if spec.mutable for i in range(1, len(path) + 1))
@@ -13,6 +13,8 @@
 # http://www.gnu.org/licenses/gpl-3.0.txt                              #
 ########################################################################
 
+from pieces import PieceMap
+
 def kilo2bytes(kb):
     return kb*1000
 def bytes2kilo(b):
@@ -135,6 +137,8 @@ RPC = {
         'isFinished': { 'type':'boolean', 'mutable':False },
         'isPrivate': { 'type':'boolean', 'mutable':False },
         'isStalled': { 'type':'boolean', 'mutable':False },
+        'labels': { 'type':'list', 'mutable':False,
+                    'subspec': { 'type':'str', 'mutable':False } },
         'leftUntilDone': { 'type':'bytes_size', 'mutable':False },
         'magnetLink': { 'type':'number', 'mutable':False },  # TODO What is this?
         'manualAnnounceTime': { 'type':'timespan', 'mutable':False },
@@ -175,7 +179,7 @@ RPC = {
         'peersGettingFromUs': { 'type':'int', 'mutable':False },
         'peersSendingToUs': { 'type':'int', 'mutable':False },
         'percentDone': { 'type':'percent', 'mutable':False },
-        'pieces': { 'type':'str', 'mutable':False },  # TODO Can this be translated into Python?
+        'pieces': { 'onupdate':PieceMap.from_base64, 'type':'pieces', 'mutable':False },
         'pieceCount': { 'type':'int', 'mutable':False },
         'pieceSize': { 'type':'bytes_size', 'mutable':False },
         'priorities': { 'type':'list', 'mutable':False,
@@ -244,3 +248,39 @@ RPC = {
         # 'webseedsSendingToUs': { 'type':'number', 'mutable':False }
     }
 }
+
+
+# Named sets of 'torrent' fields for typical views
+PROJECTIONS = {
+    'list': ['id', 'name', 'status', 'error', 'errorString', 'eta',
+             'isFinished', 'leftUntilDone', 'metadataPercentComplete',
+             'peersConnected', 'percentDone', 'queuePosition', 'rateDownload',
+             'rateUpload', 'recheckProgress', 'sizeWhenDone', 'totalSize',
+             'uploadRatio'],
+    'detail': ['id', 'name', 'status', 'error', 'errorString', 'eta',
+               'isFinished', 'leftUntilDone', 'metadataPercentComplete',
+               'peersConnected', 'percentDone', 'queuePosition', 'rateDownload',
+               'rateUpload', 'recheckProgress', 'sizeWhenDone', 'totalSize',
+               'uploadRatio', 'activityDate', 'addedDate', 'bandwidthPriority',
+               'comment', 'corruptEver', 'creator', 'dateCreated',
+               'desiredAvailable', 'doneDate', 'downloadDir', 'downloadedEver',
+               'downloadLimit', 'downloadLimited', 'hashString', 'haveUnchecked',
+               'haveValid', 'honorsSessionLimits', 'isPrivate', 'peer-limit',
+               'peersGettingFromUs', 'peersSendingToUs', 'pieceCount',
+               'pieceSize', 'secondsDownloading', 'secondsSeeding',
+               'seedIdleLimit', 'seedIdleMode', 'seedRatioLimit',
+               'seedRatioMode', 'startDate', 'torrentFile', 'uploadedEver',
+               'uploadLimit', 'uploadLimited'],
+    'files': ['id', 'files', 'fileStats', 'priorities', 'wanted'],
+    'peers': ['id', 'peers', 'peersConnected', 'peersFrom'],
+    'trackers': ['id', 'trackers', 'trackerStats'],
+}
+
+# Fields that identify an item of a list across updates, e.g. peer
+# '10.0.0.1:51413'.  Other lists are merged by position.
+IDENTITIES = {
+    ('torrent', 'peers'): ('address', 'port'),
+    ('torrent', 'files'): ('name',),
+    ('torrent', 'trackers'): ('id',),
+    ('torrent', 'trackerStats'): ('id',),
+}
@@ -0,0 +1,259 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Save a client's cache to disk and load it again for a warm start.
+
+A snapshot file is MAGIC, the length of the header, the marshalled header
+(daemon URL, rpc-version, time of saving, cache format) and the marshalled
+cache.  Values are stored machine-readable and restored without onupdate
+hooks, so loading doesn't repeat any conversions.  The file is mapped into
+memory for loading; the typed arrays of a columnar cache are copied
+straight from it.
+
+Exceptions:
+    SnapshotError: The file is not a snapshot or belongs to another daemon.
+
+Functions:
+    save_snapshot, load_snapshot:
+        >>> from transmissionhq.snapshot import (save_snapshot, load_snapshot)
+        >>> save_snapshot(client, '/var/cache/hq/seedbox.snap')
+        >>> client = TransmissionClient('seedbox:9091')
+        >>> load_snapshot(client, '/var/cache/hq/seedbox.snap')
+        {'url': 'http://seedbox:9091/transmission/rpc', 'rpc-version': 15, ...}
+
+    warm_start: Load a snapshot and reconcile with the daemon in a thread.
+        >>> thread = warm_start(client, '/var/cache/hq/seedbox.snap')
+        >>> client.find_torrents(status='seeding')  # Served from the snapshot
+"""
+
+import gc
+import os
+import time
+import mmap
+import marshal
+import struct
+import calendar
+import datetime
+import threading
+from rpc import TransmissionRPC
+from rpcspec import PROJECTIONS
+from pieces import PieceMap
+
+MAGIC = 'TRHQSNAP\x01'
+HEADER_LENGTH = struct.Struct('!I')
+
+# Spec types of columnar list columns that may need encode_value()
+ENCODED_TYPES = ('date', 'pieces', 'dict', 'list')
+
+
+class SnapshotError(Exception): pass
+
+
+### Values marshal can't handle are stored as tagged tuples (JSON has no
+### tuples, so they are unambiguous)
+
+def encode_value(value):
+    """Return value with everything converted to types marshal supports."""
+    if type(value) is dict:
+        return dict((k, encode_value(v)) for k,v in value.iteritems())
+    if type(value) is list:
+        return [encode_value(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        return ('datetime', calendar.timegm(value.utctimetuple()))
+    if isinstance(value, PieceMap):
+        return ('pieces', value.bits, value.count)
+    return value
+
+def decode_value(value):
+    """Reverse encode_value()."""
+    if type(value) is dict:
+        return dict((k, decode_value(v)) for k,v in value.iteritems())
+    if type(value) is list:
+        return [decode_value(v) for v in value]
+    if type(value) is tuple:
+        if value[0] == 'datetime':
+            return datetime.datetime.utcfromtimestamp(value[1])
+        if value[0] == 'pieces':
+            return PieceMap(value[1], value[2])
+    return value
+
+
+def save_snapshot(client, path):
+    """Write session settings and cached torrents of client to path.
+
+    The file is replaced atomically.
+    """
+    cache = client._cache
+    session = cache['session'].mr
+    header = {
+        'url': str(client.transport.url),
+        'rpc-version': session.get('rpc-version'),
+        'time': time.time(),
+        'columnar': client._columnar,
+        'count': len(cache['torrents']),
+    }
+    if client._columnar:
+        store = cache['torrents']
+        torrents = store.dump()
+        for key,(typecode, data, present) in torrents['columns'].items():
+            if typecode is None and store._spec[key].type in ENCODED_TYPES:
+                torrents['columns'][key] = (typecode, encode_value(data), present)
+    else:
+        torrents = [encode_value(t.mr) for t in cache['torrents'].values()]
+    header = marshal.dumps(header)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        marshal.dump({ 'session':encode_value(session), 'torrents':torrents,
+                       'index':client.index.dump() }, f)
+    os.rename(tmp, path)
+
+def _read_header(data, path):
+    """Return (header, offset of cache) of a snapshot in data."""
+    start = len(MAGIC) + HEADER_LENGTH.size
+    if len(data) < start or data[:len(MAGIC)] != MAGIC:
+        raise SnapshotError('Not a snapshot: %s' % path)
+    length, = HEADER_LENGTH.unpack(data[len(MAGIC):start])
+    try:
+        return marshal.loads(data[start:start+length]), start + length
+    except (EOFError, ValueError, TypeError):
+        raise SnapshotError('Snapshot %s is corrupt' % path)
+
+def read_header(path):
+    """Return header of the snapshot at path."""
+    with open(path, 'rb') as f:
+        start = f.read(len(MAGIC) + HEADER_LENGTH.size)
+        if len(start) == len(MAGIC) + HEADER_LENGTH.size:
+            start += f.read(HEADER_LENGTH.unpack(start[len(MAGIC):])[0])
+        return _read_header(start, path)[0]
+
+def load_snapshot(client, path, check_url=True):
+    """Fill the cache of a fresh client from the snapshot at path.
+
+    Return the snapshot's header.  Raise SnapshotError if the snapshot was
+    taken from another daemon (unless check_url is False) or doesn't fit
+    the client's cache format, and IOError if it can't be read.
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):  # Empty file
+            raise SnapshotError('Not a snapshot: %s' % path)
+        try:
+            header, offset = _read_header(data, path)
+            if check_url and header['url'] != str(client.transport.url):
+                raise SnapshotError('Snapshot %s belongs to %s' % (path, header['url']))
+            if header['columnar'] != client._columnar:
+                raise SnapshotError('Snapshot %s has the wrong cache format' % path)
+            try:
+                snapshot = marshal.loads(buffer(data, offset))
+            except (EOFError, ValueError, TypeError):
+                raise SnapshotError('Snapshot %s is corrupt' % path)
+        finally:
+            data.close()
+
+    # Creating lots of objects at once triggers pointless garbage collections
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        _restore(client, snapshot)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return header
+
+def _restore(client, snapshot):
+    cache = client._cache
+    cache['session'] = TransmissionRPC.restore('session', decode_value(snapshot['session']),
+                                               setter=client.session)
+    torrents = snapshot['torrents']
+    if client._columnar:
+        store = cache['torrents']
+        for key,(typecode, data, present) in torrents['columns'].items():
+            if typecode is None and store._spec[key].type in ENCODED_TYPES:
+                torrents['columns'][key] = (typecode, decode_value(data), present)
+        store.restore(torrents)
+    else:
+        cache['torrents'].clear()
+        client._dirty.clear()
+        for t in torrents:
+            cache['torrents'][t['id']] = TransmissionRPC.restore(
+                'torrent', decode_value(t), setter=client._torrentsetter,
+                tracker=client.field_usage, dirty=client._dirty.child(t['id']))
+    if not client.index.restore(snapshot['index']):
+        for id,torrent in cache['torrents'].items():
+            client.index.reindex(id, torrent)
+
+def reconcile(client, header, keys=None):
+    """Bring a cache loaded from a snapshot up to date.
+
+    If the daemon's rpc-version changed, the snapshot is dropped and keys
+    are fetched (by default the 'list' projection), like for an empty cache.
+    Otherwise a listing of IDs and hashStrings tells removed torrents, which
+    are forgotten, from new ones, which are fetched with all fields found in
+    the snapshot; an ID that now has another hashString is both.  The other
+    torrents get only the snapshot's fields of the 'list' projection again:
+    these change while nobody is watching, the rest is refreshed by the
+    next request for it.  Only values that differ are changed, so observers
+    see the real changes.
+    """
+    session = client.session()
+    cache = client._cache['torrents']
+    fields = set()
+    with client.lock:
+        if session.value('rpc-version') != header['rpc-version']:
+            for id in list(cache):
+                client._forget_torrent(id)
+        for torrent in cache.values():
+            fields.update(torrent.keys())
+    if not fields:
+        client.torrents(keys=keys or 'list')
+        return
+
+    listing = client._request('torrent-get', fields=['id', 'hashString'])['torrents']
+    with client.lock:
+        known = set()
+        for t in listing:
+            id, hash = t['id'], t['hashString']
+            if id in cache and cache[id].value('hashString', hash) == hash:
+                known.add(id)
+        client._prune_torrents(known)
+    new = [t['id'] for t in listing if t['id'] not in known]
+    if new:
+        client.torrents(ids=new, keys=sorted(fields))
+    volatile = fields.intersection(PROJECTIONS['list'])
+    if known and volatile != set(['id']):
+        client.torrents(ids=sorted(known), keys=sorted(volatile))
+
+def warm_start(client, path, keys=None):
+    """Load the snapshot at path (if there is a usable one) and reconcile
+    with the daemon in a daemon thread.
+
+    keys are fetched if there is no usable snapshot; by default the 'list'
+    projection.  Return the started thread.  Until it is done, use only
+    find_torrents(), query() and other methods that hold client.lock.
+    """
+    try:
+        header = load_snapshot(client, path)
+    except (IOError, SnapshotError):
+        target = lambda: client.torrents(keys=keys or 'list')
+    else:
+        target = lambda: reconcile(client, header, keys)
+    thread = threading.Thread(target=target, name='warm_start')
+    thread.daemon = True
+    thread.start()
+    return thread
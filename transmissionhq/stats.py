@@ -0,0 +1,233 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+Aggregate statistics over cached torrents.
+
+Numbers are read straight from the arrays of a ColumnarTorrentStore
+instead of from value objects.  If NumPy is installed, the arrays are
+wrapped without copying and all arithmetic happens in NumPy; otherwise a
+pure Python implementation computes the same results.
+
+Functions:
+    aggregate:
+        >>> from transmissionhq.stats import aggregate
+        >>> client = TransmissionClient(columnar=True)
+        >>> client.torrents(keys=['id', 'status', 'rateUpload', 'uploadRatio'])
+        >>> aggregate(client, ['rateUpload', 'uploadRatio'], by='status',
+        ...           percentiles=(50, 90))
+        {'seeding': {'count': 812,
+                     'rateUpload': {'count': 812, 'sum': 48213452.0, 'mean': 59376.2,
+                                    'min': 0.0, 'max': 2350021.0,
+                                    'p50': 1022.0, 'p90': 180233.4},
+                     'uploadRatio': {...}},
+         'downloading': {...}}
+"""
+
+import math
+from urlparse import urlsplit
+from array import array
+from rpc import TransmissionRPC
+from columnar import ColumnarTorrentStore
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Pseudo-fields for the 'by' argument of aggregate(), besides real fields
+GROUPINGS = {
+    'tracker': 'trackers',  # Host of each tracker; torrents count for each one
+}
+
+
+def tracker_hosts(trackers):
+    """Return sorted list of hosts from a 'trackers' value."""
+    hosts = set()
+    for tracker in trackers or ():
+        host = urlsplit(tracker.get('announce') or '').hostname
+        if host:
+            hosts.add(host)
+    return sorted(hosts)
+
+def percentile(values, p):
+    """Return p-th percentile of sorted values (linear interpolation)."""
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    f = int(math.floor(k))
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def _values(store, rows, field):
+    """Return list of machine-readable values of field (None if missing)."""
+    if store is None:
+        return [row.value(field) for row in rows]
+    column = store.columns.get(field)
+    if column is None:
+        return [None] * len(rows)
+    present = store._present[field]
+    if isinstance(column, array):
+        return [column[slot] if present[slot] else None for slot in rows]
+    return [value.mr if isinstance(value, TransmissionRPC) else value
+            for value in (column[slot] for slot in rows)]
+
+def _rows(torrents, by):
+    """Return (store or None, list of rows, list of group keys).
+
+    Rows are slots of a ColumnarTorrentStore or torrent objects.  A torrent
+    appears once per group it belongs to.
+    """
+    if hasattr(torrents, '_cache'):  # TransmissionClient
+        torrents = torrents._cache['torrents']
+    if isinstance(torrents, ColumnarTorrentStore):
+        store = torrents
+        rows = store._ids.values()
+    else:
+        store = None
+        rows = list(torrents.values() if hasattr(torrents, 'values') else torrents)
+
+    if by is None:
+        return store, rows, [None] * len(rows)
+    if by in GROUPINGS:
+        keys = [tracker_hosts(trackers) for trackers in _values(store, rows, GROUPINGS[by])]
+    else:
+        keys = _values(store, rows, by)
+    if not any(type(key) is list for key in keys):
+        return store, rows, keys
+    # List values (e.g. labels): a torrent belongs to a group per item
+    grouped_rows, grouped_keys = [], []
+    for row,key in zip(rows, keys):
+        for item in (key or [None]) if type(key) is list else [key]:
+            grouped_rows.append(row)
+            grouped_keys.append(item)
+    return store, grouped_rows, grouped_keys
+
+
+def _summarize_python(values, percentiles):
+    """Return summary of a list of values or None if it is empty."""
+    if not values:
+        return None
+    total = math.fsum(values)
+    summary = {'count':len(values), 'sum':total, 'mean':total / len(values),
+               'min':float(min(values)), 'max':float(max(values))}
+    if percentiles:
+        values = sorted(values)
+        for p in percentiles:
+            summary['p%g' % p] = float(percentile(values, p))
+    return summary
+
+def _column_numpy(store, rows, field):
+    """Return float array of field for rows, NaN where missing."""
+    if store is not None:
+        column = store.columns.get(field)
+        if column is None:
+            return numpy.full(len(rows), numpy.nan)
+        if isinstance(column, array):
+            values = numpy.frombuffer(column, dtype=column.typecode)[rows].astype(float)
+            present = numpy.frombuffer(store._present[field], dtype=numpy.uint8)[rows]
+            values[present == 0] = numpy.nan
+            return values
+    data = _values(store, rows, field)
+    return numpy.array([numpy.nan if v is None else v for v in data], dtype=float)
+
+def _summarize_numpy(inverse, ngroups, values, percentiles):
+    valid = ~numpy.isnan(values)
+    groups, values = inverse[valid], values[valid]
+    counts = numpy.bincount(groups, minlength=ngroups)
+    sums = numpy.bincount(groups, weights=values, minlength=ngroups)
+    order = numpy.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    bounds = numpy.searchsorted(groups, numpy.arange(ngroups + 1))
+    summaries = {}
+    for g in range(ngroups):
+        if not counts[g]:
+            continue
+        group = values[bounds[g]:bounds[g+1]]
+        summary = {'count':int(counts[g]), 'sum':float(sums[g]),
+                   'mean':float(sums[g]) / counts[g],
+                   'min':float(group[0]), 'max':float(group[-1])}
+        if percentiles:
+            for p,v in zip(percentiles, numpy.percentile(group, percentiles)):
+                summary['p%g' % p] = float(v)
+        summaries[g] = summary
+    return summaries
+
+
+def aggregate(torrents, fields, by=None, percentiles=(), use_numpy=None):
+    """Return statistics of numeric fields, optionally grouped.
+
+    Arguments:
+        torrents: A TransmissionClient, its torrent cache or a list of
+                  torrents (anything with value(key)).
+        fields: List of numeric 'torrent-get' fields.
+        by: None, a field (e.g. 'status' or 'downloadDir') or 'tracker'
+            (the host of each tracker in 'trackers').  If the field's value
+            is a list (e.g. 'labels'), torrents count for each item.
+        percentiles: E.g. (50, 90, 99); reported as 'p50', 'p90', 'p99'.
+        use_numpy: Force (True) or avoid (False) NumPy.  By default it is
+                   used if it is installed.
+
+    Return {group: {'count': torrents, field: {'count', 'sum', 'mean',
+    'min', 'max', 'pN'}}}; the group is None if by is None.  Missing values
+    are skipped, fields without any value in a group are left out.
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ValueError('NumPy is not installed')
+    store, rows, keys = _rows(torrents, by)
+
+    result = {}
+    for key in keys:
+        try:
+            result[key]['count'] += 1
+        except KeyError:
+            result[key] = {'count':1}
+
+    if use_numpy and rows:
+        names = list(result)
+        index = dict((key, i) for i,key in enumerate(names))
+        inverse = numpy.array([index[key] for key in keys], dtype=numpy.intp)
+        if store is not None:
+            rows = numpy.array(rows, dtype=numpy.intp)
+        for field in fields:
+            values = _column_numpy(store, rows, field)
+            for g,summary in _summarize_numpy(inverse, len(names), values,
+                                              percentiles).items():
+                result[names[g]][field] = summary
+        return result
+
+    groups = {}
+    for row,key in zip(rows, keys):
+        try:
+            groups[key].append(row)
+        except KeyError:
+            groups[key] = [row]
+    for field in fields:
+        column = store.columns.get(field) if store is not None else None
+        for key,group in groups.items():
+            if column is not None:
+                present = store._present[field]
+                values = [column[slot] for slot in group if present[slot]]
+            elif store is not None:
+                continue
+            else:
+                values = [value for value in (row.value(field) for row in group)
+                          if value is not None]
+            summary = _summarize_python(values, percentiles)
+            if summary is not None:
+                result[key][field] = summary
+    return result
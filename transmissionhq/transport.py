@@ -0,0 +1,819 @@
+########################################################################
+# This file is part of transmission-hq.                                #
+#                                                                      #
+# This program is free software: you can redistribute it and/or modify #
+# it under the terms of the GNU General Public License as published by #
+# the Free Software Foundation, either version 3 of the License, or    #
+# (at your option) any later version.                                  #
+#                                                                      #
+# This program is distributed in the hope that it will be useful,      #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of       #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the        #
+# GNU General Public License for more details:                         #
+# http://www.gnu.org/licenses/gpl-3.0.txt                              #
+########################################################################
+"""
+HTTP plumbing for Transmission's RPC interface.
+
+Requests are encoded and responses decoded exactly like transmission-fluid
+does it, so values look the same no matter which transport delivered them.
+
+Classes:
+    HTTPTransport: Pool of blocking keep-alive connections to one daemon.
+    ResponseStream: Incrementally decoded response.
+    RPCFuture: The result of an RPC that may not have arrived yet.
+    AsyncRPCPool: Non-blocking HTTP connections to one daemon.
+
+Functions:
+    encode_request, decode_response: JSON (de)serialization.
+    poll: Run one iteration of the event loop.
+"""
+
+import asyncore
+import base64
+import httplib
+import json
+import re
+import select
+import socket
+import ssl
+import sys
+import threading
+import time
+from collections import deque
+from transmission import (BadRequest, CSRF_HEADER)  # transmission-fluid
+from transmission.json_utils import (TransmissionJSONEncoder,
+                                     TransmissionJSONDecoder)
+
+CSRF_ERROR_CODE = 409
+
+
+def encode_request(method, tag, **kwargs):
+    """Return JSON body of an RPC request."""
+    # As Python can't accept dashes in kwargs keys, replace any
+    # underscores with them here.
+    arguments = dict((k.replace('_', '-'), v) for k,v in kwargs.items())
+    return json.dumps({ 'method':method, 'tag':tag, 'arguments':arguments },
+                      cls=TransmissionJSONEncoder)
+
+def decode_response(body, tag):
+    """Return 'arguments' of an RPC response or raise BadRequest."""
+    doc = json.loads(body, cls=TransmissionJSONDecoder)
+    if doc['result'] != 'success':
+        raise BadRequest("Request failed: '%s'" % doc['result'])
+    if doc.get('tag') != tag:
+        raise BadRequest('Tag mismatch: (got %s, expected %s)' % (doc.get('tag'), tag))
+    return doc.get('arguments') or None
+
+def auth_header(username, password):
+    """Return value of an 'Authorization' header or None."""
+    if not (username or password):
+        return None
+    return 'Basic ' + base64.b64encode('%s:%s' % (username, password))
+
+
+def unix_connection(path, timeout=None):
+    """Return a socket connected to the Unix domain socket at path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def connection_dropped(conn):
+    """Return True if an idle connection (httplib or asyncore) was closed
+    by the daemon."""
+    sock = getattr(conn, 'sock', None) or getattr(conn, 'socket', None)
+    if sock is None:
+        return True
+    try:
+        # An idle connection is readable only at EOF (or on garbage)
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class HTTPTransport(object):
+
+    """Send RPCs over a pool of keep-alive HTTP connections.
+
+    The stats attribute counts requests, new connections ('connections')
+    and reused ones ('reused'), requests repeated because of a new session
+    ID ('session_id_retries') or a failed connection ('retries') as well
+    as bytes sent and received.
+    """
+
+    def __init__(self, url, headers=None):
+        """Create a new transport.
+
+        Arguments:
+            url: A TransmissionURL.  Besides host, port, path, username,
+                 password and ssl, the following keys are used:
+                     max_connections: Maximum number of open connections.
+                     keepalive: Reuse connections if True.
+                     connect_timeout, read_timeout: Seconds or None.
+                     retries: How often a request is repeated on failure.
+                     socket: Path of a Unix domain socket to connect to
+                             instead of host and port.
+            headers: Optional dict of extra headers.  It is updated with
+                     the daemon's session ID.
+        """
+        self.url = url
+        self.headers = {} if headers is None else headers
+        self._auth = auth_header(url['username'], url['password'])
+        self._tag = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(url['max_connections'])
+        self.stats = dict.fromkeys(('requests', 'connections', 'reused',
+                                    'session_id_retries', 'retries',
+                                    'bytes_sent', 'bytes_received'), 0)
+
+    def _connect(self):
+        url = self.url
+        if url['ssl']:
+            # Like transmission-fluid, don't verify certificates
+            conn = httplib.HTTPSConnection(url['host'], url['port'],
+                                           timeout=url['connect_timeout'],
+                                           context=ssl._create_unverified_context())
+        else:
+            conn = httplib.HTTPConnection(url['host'], url['port'],
+                                          timeout=url['connect_timeout'])
+        if url['socket']:
+            conn._create_connection = \
+                lambda address, timeout, source: unix_connection(url['socket'], timeout)
+        conn.connect()
+        conn.sock.settimeout(url['read_timeout'])
+        self.stats['connections'] += 1
+        return conn
+
+    def _acquire(self, fresh=False):
+        """Return (connection, reused)."""
+        self._slots.acquire()
+        try:
+            while not fresh:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn = self._idle.pop()
+                if connection_dropped(conn):
+                    conn.close()
+                    continue
+                self.stats['reused'] += 1
+                return conn, True
+            return self._connect(), False
+        except:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, reusable):
+        if reusable and self.url['keepalive']:
+            with self._lock:
+                self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _next_tag(self):
+        with self._lock:
+            self._tag += 1
+            return self._tag
+
+    def post(self, body):
+        """Send body and return the raw HTTP response.
+
+        Handle the session ID handshake and repeat the request on a new
+        connection if sending it fails (up to 'retries' times, once more if
+        a reused connection turns out to be closed).  Once the request is
+        sent, it is never repeated: the daemon may have carried it out.
+        The response must be read and then passed to done().
+        """
+        retries = self.url['retries']
+        fresh = False
+        while True:
+            try:
+                conn, reused = self._acquire(fresh)
+            except socket.error:
+                if retries > 0:
+                    retries -= 1
+                    self.stats['retries'] += 1
+                    continue
+                raise
+            headers = { 'Content-Type':'application/json' }
+            if not self.url['keepalive']:
+                headers['Connection'] = 'close'
+            if self._auth:
+                headers['Authorization'] = self._auth
+            headers.update(self.headers)
+            try:
+                conn.request('POST', self.url['path'], body, headers)
+            except (socket.error, httplib.HTTPException):
+                # The body didn't get through completely, so the daemon
+                # can't have seen the request
+                self._release(conn, False)
+                if reused and not fresh:
+                    # The daemon closed an idle keep-alive connection
+                    fresh = True
+                    continue
+                if retries > 0:
+                    retries -= 1
+                    self.stats['retries'] += 1
+                    continue
+                raise
+            try:
+                response = conn.getresponse()
+            except:
+                self._release(conn, False)
+                raise
+            self.stats['requests'] += 1
+            self.stats['bytes_sent'] += len(body)
+            if response.status == CSRF_ERROR_CODE and response.getheader(CSRF_HEADER):
+                self.headers[CSRF_HEADER] = response.getheader(CSRF_HEADER)
+                response.read()
+                self._release(conn, not response.will_close)
+                self.stats['session_id_retries'] += 1
+                continue
+            response.connection = conn
+            return response
+
+    def done(self, response, received):
+        """Give the connection of a completely read response back."""
+        self.stats['bytes_received'] += received
+        self._release(response.connection, not response.will_close)
+
+    def request(self, method, **kwargs):
+        """Send an RPC and return its 'arguments'.
+
+        Raise socket.error or httplib.HTTPException if the daemon can't be
+        reached and BadRequest if it rejects the request.
+        """
+        tag = self._next_tag()
+        response = self.post(encode_request(method, tag, **kwargs))
+        try:
+            body = response.read()
+        except:
+            self._release(response.connection, False)
+            raise
+        self.done(response, len(body))
+        if response.status != 200:
+            raise BadRequest('HTTP error %d' % response.status)
+        return decode_response(body, tag)
+
+    def stream(self, method, list_key='torrents', chunk_size=65536, **kwargs):
+        """Send an RPC and return a ResponseStream that yields the items of
+        the list_key argument while the response is still arriving.
+        """
+        tag = self._next_tag()
+        response = self.post(encode_request(method, tag, **kwargs))
+        if response.status != 200:
+            try:
+                body = response.read()
+            except:
+                self._release(response.connection, False)
+                raise
+            self.done(response, len(body))
+            raise BadRequest('HTTP error %d' % response.status)
+        return ResponseStream(self, response, tag, list_key, chunk_size)
+
+
+RE_WHITESPACE = re.compile(r'\s*')
+
+class ResponseStream(object):
+
+    """Incrementally decode an RPC response.
+
+    Iterating yields the items of one list in 'arguments' (e.g. the
+    'torrents' of 'torrent-get') one at a time, so only one item needs to be
+    in memory at once.  All other arguments (e.g. 'removed') are in the
+    arguments attribute when iteration has finished.  The connection is
+    given back when the response is exhausted or close() is called.
+    """
+
+    def __init__(self, transport, response, tag, list_key, chunk_size=65536):
+        self.arguments = {}
+        self._transport = transport
+        self._response = response
+        self._tag = tag
+        self._list_key = list_key
+        self._chunk_size = chunk_size
+        self._decoder = TransmissionJSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._received = 0
+        self._eof = False
+        self._items = self._parse()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise
+        except:
+            self.close(False)
+            raise
+
+    def close(self, reusable=False):
+        """Stop reading and give the connection back."""
+        if self._response is not None:
+            response, self._response = self._response, None
+            self._transport.stats['bytes_received'] += self._received
+            self._transport._release(response.connection,
+                                     reusable and not response.will_close)
+
+    def _fill(self, size):
+        """Read until at least size unparsed bytes are buffered."""
+        if self._pos > len(self._buf) // 2:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        while not self._eof and len(self._buf) - self._pos < size:
+            chunk = self._response.read(self._chunk_size)
+            if not chunk:
+                self._eof = True
+                break
+            self._received += len(chunk)
+            self._buf += chunk
+
+    def _skip(self):
+        """Skip whitespace and return next character."""
+        while True:
+            self._pos = RE_WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                raise BadRequest('Truncated response')
+            self._fill(1)
+
+    def _expect(self, chars):
+        char = self._skip()
+        if char not in chars:
+            raise BadRequest('Malformed response: got %r, expected %r' % (char, chars))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decode next JSON value, reading more data until it is complete."""
+        self._skip()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise BadRequest('Malformed response')
+                # Double the buffer instead of re-parsing after every chunk
+                self._fill(max(self._chunk_size, 2 * (len(self._buf) - self._pos)))
+                continue
+            # A number may be cut off at the end of the buffer
+            if end == len(self._buf) and not self._eof and \
+                    isinstance(value, (int, long, float)):
+                self._fill(len(self._buf) - self._pos + 1)
+                continue
+            self._pos = end
+            return value
+
+    def _members(self):
+        """Yield keys of a JSON object; the caller consumes the values."""
+        self._expect('{')
+        if self._skip() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def _parse(self):
+        doc = {}
+        for key in self._members():
+            if key != 'arguments':
+                doc[key] = self._value()
+                continue
+            if self._skip() == 'n':  # null
+                self._value()
+                continue
+            for arg in self._members():
+                if arg != self._list_key:
+                    self.arguments[arg] = self._value()
+                    continue
+                self._expect('[')
+                if self._skip() == ']':
+                    self._pos += 1
+                    continue
+                while True:
+                    yield self._value()
+                    if self._expect(',]') == ']':
+                        break
+        # Read the rest so the connection can be reused
+        while not self._eof:
+            self._fill(len(self._buf) - self._pos + self._chunk_size)
+        self.close(True)
+        if doc.get('result') != 'success':
+            raise BadRequest("Request failed: '%s'" % doc.get('result'))
+        if doc.get('tag') != self._tag:
+            raise BadRequest('Tag mismatch: (got %s, expected %s)' % (doc.get('tag'), self._tag))
+
+
+class RPCFuture(object):
+
+    """The result of an RPC that may not have arrived yet.
+
+    Callbacks are run by whoever drives the event loop, e.g. result() or
+    poll().
+    """
+
+    def __init__(self, map=None):
+        self._map = map
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        if self._done:
+            return
+        self._result, self._error, self._done = result, error, True
+        callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+    def add_done_callback(self, func):
+        """Call func with this future as soon as it is done."""
+        if self._done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def then(self, func, errback=None):
+        """Return a new future that resolves to func(result).
+
+        If func returns another RPCFuture, the new future resolves to its
+        result.  Exceptions are passed through unless errback is given, in
+        which case the new future resolves to errback(exception).
+        """
+        chained = RPCFuture(self._map)
+        def run(future):
+            try:
+                if future._error is None:
+                    value = func(future._result)
+                elif errback is not None:
+                    value = errback(future._error)
+                else:
+                    raise future._error
+            except Exception as err:
+                chained.set_exception(err)
+                return
+            if isinstance(value, RPCFuture):
+                value.add_done_callback(lambda f: chained._finish(f._result, f._error))
+            else:
+                chained.set_result(value)
+        self.add_done_callback(run)
+        return chained
+
+    def result(self, timeout=None):
+        """Run the event loop until the result is available and return it.
+
+        Raise the exception the RPC failed with, or socket.timeout if timeout
+        seconds have passed.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self._done:
+            if timeout is not None and time.time() >= deadline:
+                raise socket.timeout('No result after %s seconds' % timeout)
+            poll(map=self._map)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def gather(futures, map=None):
+    """Return a future that resolves to a list of the results of futures."""
+    futures = list(futures)
+    gathered = RPCFuture(map)
+    results = [None] * len(futures)
+    pending = [len(futures)]
+    def collect(index, future):
+        if future._error is not None:
+            gathered.set_exception(future._error)
+            return
+        results[index] = future._result
+        pending[0] -= 1
+        if not pending[0]:
+            gathered.set_result(results)
+    for index,future in enumerate(futures):
+        future.add_done_callback(lambda f, i=index: collect(i, f))
+    if not futures:
+        gathered.set_result(results)
+    return gathered
+
+def poll(timeout=0.05, map=None):
+    """Run one iteration of the event loop and expire timed out requests."""
+    if map is None:
+        map = asyncore.socket_map
+    if map:
+        asyncore.loop(timeout=timeout, use_poll=True, map=map, count=1)
+    else:
+        time.sleep(timeout)
+    now = time.time()
+    for dispatcher in map.values():
+        if isinstance(dispatcher, AsyncRPCConnection):
+            dispatcher.check_timeout(now)
+
+
+class HTTPResponse(object):
+
+    """Incrementally parse an HTTP response."""
+
+    def __init__(self):
+        self._buffer = ''
+        self._length = None
+        self._chunked = False
+        self._chunks = []
+        self.status = None
+        self.headers = {}
+        self.body = None
+        self.keep_alive = True
+
+    def feed(self, data):
+        """Add received data; return True once the response is complete."""
+        self._buffer += data
+        if self.status is None:
+            end = self._buffer.find('\r\n\r\n')
+            if end == -1:
+                return False
+            head, self._buffer = self._buffer[:end], self._buffer[end+4:]
+            lines = head.split('\r\n')
+            version, status = lines[0].split(' ', 2)[:2]
+            self.status = int(status)
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                self.headers[name.strip().lower()] = value.strip()
+            self._chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+            if 'content-length' in self.headers:
+                self._length = int(self.headers['content-length'])
+            connection = self.headers.get('connection', '').lower()
+            self.keep_alive = connection != 'close' and \
+                (version != 'HTTP/1.0' or connection == 'keep-alive') and \
+                (self._chunked or self._length is not None)
+        if self._chunked:
+            return self._feed_chunks()
+        if self._length is not None and len(self._buffer) >= self._length:
+            self.body = self._buffer[:self._length]
+            return True
+        return False
+
+    def _feed_chunks(self):
+        while True:
+            end = self._buffer.find('\r\n')
+            if end == -1:
+                return False
+            size = int(self._buffer[:end].split(';')[0], 16)
+            if size == 0:
+                if self._buffer.find('\r\n', end+2) == -1:
+                    return False
+                self.body = ''.join(self._chunks)
+                return True
+            if len(self._buffer) < end + 2 + size + 2:
+                return False
+            self._chunks.append(self._buffer[end+2:end+2+size])
+            self._buffer = self._buffer[end+2+size+2:]
+
+    def finish(self):
+        """Connection was closed; return True if the response is complete."""
+        if self.status is not None and self._length is None and not self._chunked:
+            self.body = self._buffer
+            return True
+        return self.body is not None
+
+
+class _Job(object):
+    def __init__(self, method, kwargs, future, timeout):
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.timeout = timeout
+        self.tag = None
+        self.deadline = None
+
+
+class AsyncRPCConnection(asyncore.dispatcher):
+
+    """One keep-alive HTTP connection that handles one request at a time."""
+
+    def __init__(self, pool):
+        asyncore.dispatcher.__init__(self, map=pool.map)
+        self._pool = pool
+        self._job = None
+        self._outbuf = ''
+        self._response = None
+        self.requests = 0
+        if pool.socket_path:
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connect(pool.socket_path)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connect((pool.host, pool.port))
+
+    def start(self, job):
+        self._job = job
+        self._job.tag = self._pool.next_tag()
+        if job.timeout is not None:
+            job.deadline = time.time() + job.timeout
+        self._response = HTTPResponse()
+        self._outbuf = self._pool.build_request(job)
+        self.requests += 1
+        self._pool.stats['requests'] += 1
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self._outbuf) or not self.connected
+
+    def readable(self):
+        return True
+
+    def handle_write(self):
+        sent = self.send(self._outbuf)
+        self._outbuf = self._outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if self._job is None:
+            return
+        if data and self._response.feed(data):
+            self._done()
+
+    def handle_close(self):
+        job, response = self._job, self._response
+        self._job = None
+        self.close()
+        self._pool.forget(self)
+        if job is None:
+            return
+        if response is not None and response.finish():
+            self._job, self._response = job, response
+            self._done(reusable=False)
+        elif self.requests > 1 and self._outbuf:
+            # The daemon closed an idle keep-alive connection before it got
+            # the whole request.  Once it is sent, it is never repeated: the
+            # daemon may have carried it out.
+            self._pool.stats['retries'] += 1
+            self._pool.submit(job, front=True)
+        else:
+            job.future.set_exception(socket.error('Connection closed by %s' % \
+                (self._pool.socket_path or '%s:%s' % (self._pool.host, self._pool.port))))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        job, self._job = self._job, None
+        self.close()
+        self._pool.forget(self)
+        if job is not None:
+            job.future.set_exception(error)
+
+    def check_timeout(self, now):
+        if self._job is not None and self._job.deadline is not None \
+           and now >= self._job.deadline:
+            job, self._job = self._job, None
+            self.close()
+            self._pool.forget(self)
+            job.future.set_exception(socket.timeout('Timeout after %s seconds' % job.timeout))
+
+    def _done(self, reusable=True):
+        job, response = self._job, self._response
+        self._job = self._response = None
+        reusable = reusable and response.keep_alive
+        self._pool.stats['bytes_received'] += len(response.body or '')
+        # Give the connection back first, so a repeated request can use it
+        if reusable:
+            self._pool.release(self)
+        else:
+            self.close()
+            self._pool.forget(self)
+        if response.status == CSRF_ERROR_CODE and CSRF_HEADER.lower() in response.headers:
+            self._pool.headers[CSRF_HEADER] = response.headers[CSRF_HEADER.lower()]
+            self._pool.stats['session_id_retries'] += 1
+            self._pool.submit(job, front=True)
+        else:
+            try:
+                if response.status != 200:
+                    raise BadRequest('HTTP error %d' % response.status)
+                job.future.set_result(decode_response(response.body, job.tag))
+            except Exception as err:
+                job.future.set_exception(err)
+
+
+class AsyncRPCPool(object):
+
+    """Queue RPCs to one daemon and spread them over up to max_connections
+    non-blocking HTTP connections.
+
+    The stats attribute counts like HTTPTransport.stats.  socket_path is a
+    Unix domain socket to connect to instead of host and port.
+    """
+
+    def __init__(self, host, port, path, headers, username=None, password=None,
+                 max_connections=4, timeout=None, map=None, socket_path=None):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.path = path
+        self.headers = headers  # Shared with the client for the session ID
+        self.map = asyncore.socket_map if map is None else map
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._auth = auth_header(username, password)
+        self._tag = 0
+        self._queue = deque()
+        self._idle = []
+        self._connections = set()
+        self.stats = dict.fromkeys(('requests', 'connections', 'reused',
+                                    'session_id_retries', 'retries',
+                                    'bytes_sent', 'bytes_received'), 0)
+
+    def next_tag(self):
+        self._tag += 1
+        return self._tag
+
+    def submit(self, job, front=False):
+        if front:
+            self._queue.appendleft(job)
+        else:
+            self._queue.append(job)
+        self._dispatch()
+
+    def request(self, method, **kwargs):
+        """Queue an RPC and return an RPCFuture for its 'arguments'."""
+        future = RPCFuture(self.map)
+        self.submit(_Job(method, kwargs, future, self.timeout))
+        return future
+
+    def release(self, connection):
+        self._idle.append(connection)
+        self._dispatch()
+
+    def forget(self, connection):
+        self._connections.discard(connection)
+        if connection in self._idle:
+            self._idle.remove(connection)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._queue:
+            if self._idle:
+                connection = self._idle.pop()
+                if connection_dropped(connection):
+                    connection.close()
+                    self._connections.discard(connection)
+                    continue
+                self.stats['reused'] += 1
+            elif len(self._connections) < self.max_connections:
+                try:
+                    connection = AsyncRPCConnection(self)
+                except socket.error as err:
+                    self._queue.popleft().future.set_exception(err)
+                    continue
+                self._connections.add(connection)
+                self.stats['connections'] += 1
+            else:
+                return
+            connection.start(self._queue.popleft())
+
+    def build_request(self, job):
+        body = encode_request(job.method, job.tag, **job.kwargs)
+        self.stats['bytes_sent'] += len(body)
+        lines = ['POST %s HTTP/1.1' % self.path,
+                 'Host: %s:%s' % (self.host, self.port),
+                 'Content-Type: application/json',
+                 'Content-Length: %d' % len(body),
+                 'Connection: keep-alive']
+        if self._auth:
+            lines.append('Authorization: %s' % self._auth)
+        for name,value in self.headers.items():
+            lines.append('%s: %s' % (name, value))
+        return '\r\n'.join(lines) + '\r\n\r\n' + body